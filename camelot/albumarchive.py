@@ -0,0 +1,114 @@
+from django.utils import timezone
+from mimetypes import guess_extension
+from os import fstat
+from os.path import basename, splitext
+from zipfile import ZipFile, ZipInfo, ZIP_STORED
+import json
+import logging
+from .constants import DOWNLOAD_CHUNK_SIZE
+from .models import Photo
+
+"""
+Album downloads
+
+An album is sent as a zip of the original files, generated while it is sent so that nothing is
+written to disk and memory use does not grow with the size of the photos. Photos are already
+compressed, so they are stored as they are. zipfile switches to zip64 for files and archives over 4GB.
+The archive ends with manifest.json, listing the original name and description of every photo.
+"""
+
+MANIFEST_NAME = "manifest.json"
+
+log = logging.getLogger(__name__)
+
+
+class _ZipStream:
+    """
+    Write only file object collecting what zipfile writes until it is handed to the client
+    Having no tell() or seek(), zipfile writes sizes and checksums after each file's data
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def archive_name(photo, taken):
+    """
+    Name of a photo within the archive, the name it was uploaded with where we have it
+    :param photo: photo object
+    :param taken: set of lower case names used so far, the new name is added
+    :return: name unique within the archive
+    """
+    name = basename(photo.name.replace("\\", "/")).strip()
+    if not name or name.startswith("."):
+        name = "{}{}".format(photo.id, guess_extension(photo.imgtype) or "")
+    stem, ext = splitext(name)
+    copy = 1
+    while name.lower() in taken:
+        copy += 1
+        name = "{} ({}){}".format(stem, copy, ext)
+    taken.add(name.lower())
+    return name
+
+
+def _zipinfo(name, when):
+    zinfo = ZipInfo(name, date_time=max(timezone.localtime(when).timetuple()[:6], (1980, 1, 1, 0, 0, 0)))
+    zinfo.compress_type = ZIP_STORED
+    zinfo.external_attr = 0o644 << 16
+    return zinfo
+
+
+def stream_album_zip(album, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    Generate a zip of every photo in an album, for a StreamingHttpResponse
+    The caller must have checked that the user may view the album
+    Photos whose file is gone, deleted while the archive was being sent, are left out
+    :param album: album object
+    :param chunk_size: bytes of a photo read at a time
+    :return: generator of bytes
+    """
+    out = _ZipStream()
+    taken = {MANIFEST_NAME}
+    manifest = []
+    photos = Photo.objects.filter(album=album).select_related('uploader__user').order_by('pub_date', 'id')
+
+    with ZipFile(out, 'w', ZIP_STORED) as zf:
+        for photo in photos.iterator():
+            try:
+                f = open(photo.filename, 'rb')
+            except FileNotFoundError:
+                log.warning("file of photo %s is missing, left out of album download", photo.id)
+                continue
+
+            with f:
+                name = archive_name(photo, taken)
+                zinfo = _zipinfo(name, photo.pub_date)
+                # known up front so that zipfile can decide on zip64 before writing the header
+                zinfo.file_size = fstat(f.fileno()).st_size
+                with zf.open(zinfo, 'w') as dest:
+                    while True:
+                        data = f.read(chunk_size)
+                        if not data:
+                            break
+                        dest.write(data)
+                        yield out.drain()
+
+            manifest.append({'file': name, 'name': photo.name, 'description': photo.description,
+                             'uploader': str(photo.uploader) if photo.uploader else None,
+                             'pub_date': photo.pub_date.isoformat(), 'type': photo.imgtype})
+
+        zf.writestr(_zipinfo(MANIFEST_NAME, timezone.now()),
+                    json.dumps({'album': album.name, 'description': album.description, 'photos': manifest},
+                               indent=2))
+    yield out.drain()
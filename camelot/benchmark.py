@@ -0,0 +1,293 @@
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.shortcuts import reverse
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from io import BytesIO
+from PIL import Image
+import random
+import statistics
+import time
+import tracemalloc
+from .constants import ALBUM_PUBLIC, ALBUM_ALLFRIENDS, ALBUM_GROUPS, ALBUM_PRIVATE
+from .controllers.albumcontroller import albumcontroller
+from .models import Album, FriendGroup, Friendship, Photo, Profile
+
+"""
+Synthetic data and request benchmarks, run by the benchmark management command
+
+generate_dataset() builds a social graph of the requested size: friend degrees follow a power law
+(preferential attachment), every profile has its default groups with some friends in them, and albums of
+every access type hold small real jpegs added through albumcontroller, so thumbnails and feeds are
+produced the same way as in production.
+run_benchmarks() requests each page through the django test client as randomly chosen users and reports
+latency percentiles, query counts and peak python memory per scenario.
+"""
+
+PASSWORD = "benchmark"
+USERNAME_PREFIX = "bench"
+
+# access type of a new album, with weights
+ACCESS_WEIGHTS = {ALBUM_PUBLIC: 2, ALBUM_ALLFRIENDS: 5, ALBUM_GROUPS: 2, ALBUM_PRIVATE: 1}
+# share of friend requests left unconfirmed
+PENDING_SHARE = 0.1
+
+
+class Dataset:
+    """
+    Ids of what generate_dataset() created, for picking request targets
+    """
+    def __init__(self):
+        self.userids = []
+        self.albumids = []
+        self.photoids = []
+
+
+def _jpegs(count, rng):
+    """
+    :return: list of small jpeg files as bytes, each a different colour and size
+    """
+    images = []
+    for i in range(count):
+        buf = BytesIO()
+        size = (rng.randint(160, 640), rng.randint(120, 480))
+        colour = tuple(rng.randint(0, 255) for _ in range(3))
+        Image.new("RGB", size, colour).save(buf, "JPEG", quality=80)
+        images.append(buf.getvalue())
+    return images
+
+
+def _power_law_edges(users, degree, rng):
+    """
+    Friend pairs by preferential attachment, every new user befriends degree existing users,
+    picked in proportion to how many friends they already have
+    :return: set of (requester index, requestee index)
+    """
+    edges = set()
+    # every user appears once per friend, so sampling it is sampling by degree
+    weighted = list(range(min(users, degree + 1)))
+    for new in range(len(weighted), users):
+        targets = set()
+        while len(targets) < min(degree, new):
+            targets.add(rng.choice(weighted))
+        for target in targets:
+            edges.add((new, target))
+            weighted += [new, target]
+    return edges
+
+
+def generate_dataset(users=1000, degree=3, albums=2, photos=4, seed=0, log=None):
+    """
+    Fill the database with synthetic users, friendships, groups, albums and photos
+    Photo files are written below the current directory like real uploads
+    :param users: number of users
+    :param degree: friends made by each new user, the average degree is about twice this
+    :param albums: average number of albums per user
+    :param photos: average number of photos per album
+    :param seed: random seed, the same arguments and seed give the same data
+    :param log: optional callable taking progress messages
+    :return: Dataset
+    """
+    rng = random.Random(seed)
+    log = log or (lambda message: None)
+    data = Dataset()
+
+    log("creating {} users".format(users))
+    password = make_password(PASSWORD)
+    with transaction.atomic():
+        User.objects.bulk_create([User(username="{}{}".format(USERNAME_PREFIX, i), password=password,
+                                       email="{}{}@example.com".format(USERNAME_PREFIX, i))
+                                  for i in range(users)])
+        created = list(User.objects.filter(username__startswith=USERNAME_PREFIX).order_by('id'))
+        Profile.objects.bulk_create([Profile(user=user, dname=user.username, email_confirmed=True)
+                                     for user in created])
+    profiles = list(Profile.objects.filter(user__in=created).order_by('user_id'))
+    data.userids = [profile.user_id for profile in profiles]
+
+    log("creating friendships")
+    friends = {i: [] for i in range(users)}
+    with transaction.atomic():
+        for requester, requestee in sorted(_power_law_edges(users, degree, rng)):
+            confirmed = rng.random() >= PENDING_SHARE
+            # saved one by one so the FriendLink rows are created by the post_save receiver
+            Friendship.objects.create(requester=profiles[requester], requestee=profiles[requestee],
+                                      confirmed=confirmed)
+            if confirmed:
+                friends[requester].append(requestee)
+                friends[requestee].append(requester)
+
+    log("creating groups")
+    with transaction.atomic():
+        FriendGroup.objects.bulk_create([FriendGroup(owner=profile, name=name) for profile in profiles
+                                         for name in ("Family", "Coworkers", "School Friends")])
+        groups = {}
+        for group in FriendGroup.objects.filter(owner__in=profiles).order_by('id'):
+            groups.setdefault(group.owner_id, []).append(group)
+        members = []
+        for i, profile in enumerate(profiles):
+            for group in groups[profile.id]:
+                for friend in rng.sample(friends[i], min(len(friends[i]), rng.randint(0, 5))):
+                    members.append(FriendGroup.members.through(friendgroup=group, profile=profiles[friend]))
+        FriendGroup.members.through.objects.bulk_create(members)
+
+    log("creating albums and photos")
+    images = _jpegs(8, rng)
+    accesstypes, weights = zip(*ACCESS_WEIGHTS.items())
+    for i, profile in enumerate(profiles):
+        albumcontrol = albumcontroller(profile.user_id)
+        for a in range(rng.randint(0, 2 * albums)):
+            album = albumcontrol.create_album("album {}".format(a), "synthetic")
+            accesstype = rng.choices(accesstypes, weights)[0]
+            albumcontrol.set_accesstype(album, accesstype)
+            if accesstype == ALBUM_GROUPS:
+                albumcontrol.add_group_to_album(album, rng.choice(groups[profile.id]))
+            data.albumids.append(album.id)
+            for p in range(rng.randint(1, 2 * photos)):
+                photo = albumcontrol.add_photo_to_album(album.id, "photo {}".format(p),
+                                                        BytesIO(rng.choice(images)))
+                data.photoids.append(photo.id)
+        if i % 100 == 99:
+            log("{} of {} users done".format(i + 1, users))
+
+    return data
+
+
+def _percentile(values, share):
+    """
+    Nearest rank percentile
+    :param values: non empty list of numbers
+    :param share: between 0 and 1
+    """
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(share * len(ordered))) - 1))]
+
+
+def summarize(latencies, queries, peaks):
+    """
+    :param latencies: seconds of each request
+    :param queries: queries of each request
+    :param peaks: peak bytes allocated during each request
+    :return: dict of statistics for the report
+    """
+    return {
+        "requests": len(latencies),
+        "p50_ms": round(_percentile(latencies, 0.5) * 1000, 3),
+        "p95_ms": round(_percentile(latencies, 0.95) * 1000, 3),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 3),
+        "queries_p50": _percentile(queries, 0.5),
+        "queries_max": max(queries),
+        "peak_kib_max": round(max(peaks) / 1024, 1),
+    }
+
+
+def _scenarios(data, images, rng):
+    """
+    Each scenario picks a request for a viewer, returning (method, url, post data) or None to skip the viewer
+    """
+    def visible_album(viewer):
+        albums = list(Album.objects.visible_to(viewer.profile).filter(id__in=data.albumids)
+                      .exclude(owner=viewer.profile).order_by('id').values_list('id', flat=True)[:50])
+        return rng.choice(albums) if albums else None
+
+    def visible_photo(viewer):
+        albumid = visible_album(viewer)
+        if albumid is None:
+            return None
+        return rng.choice(list(Photo.objects.filter(album=albumid).order_by('id').values_list('id', flat=True)))
+
+    def user_home(viewer):
+        return "get", reverse("user_home"), None
+
+    def display_albums(viewer):
+        return "get", reverse("show_albums", kwargs={'userid': rng.choice(data.userids)}), None
+
+    def display_album(viewer):
+        albumid = visible_album(viewer)
+        if albumid is None:
+            return None
+        return "get", reverse("show_album", kwargs={'id': albumid}), None
+
+    def display_photo(viewer):
+        photoid = visible_photo(viewer)
+        if photoid is None:
+            return None
+        return "get", reverse("present_photo", kwargs={'photoid': photoid}), None
+
+    def return_photo_file_http(viewer):
+        photoid = visible_photo(viewer)
+        if photoid is None:
+            return None
+        return "get", reverse("show_photo", kwargs={'photoid': photoid}), None
+
+    def upload_photo(viewer):
+        albumid = Album.objects.filter(owner=viewer.profile).values_list('id', flat=True).first()
+        if albumid is None:
+            return None
+        image = BytesIO(rng.choice(images))
+        image.name = "upload.jpg"
+        return "post", reverse("uploadphotoapi", kwargs={'id': albumid}), {'image': image}
+
+    return [user_home, display_albums, display_album, display_photo, return_photo_file_http, upload_photo]
+
+
+def _send(client, request):
+    """
+    Make a request and read the whole response
+    :return: response
+    """
+    method, url, postdata = request
+    response = client.post(url, postdata) if method == "post" else client.get(url)
+    if response.streaming:
+        b"".join(response.streaming_content)
+    if response.status_code >= 400:
+        raise RuntimeError("{} {} returned {}".format(method.upper(), url, response.status_code))
+    return response
+
+
+def run_benchmarks(data, requests=100, memory_samples=10, seed=0, log=None):
+    """
+    Request every scenario as random users through the test client
+    Latency and queries are measured on every request, memory on a few extra requests because
+    tracing allocations slows python down
+    :param data: Dataset from generate_dataset()
+    :param requests: number of timed requests per scenario
+    :param memory_samples: number of requests per scenario made with memory tracing
+    :param seed: random seed for picking viewers and targets
+    :param log: optional callable taking progress messages
+    :return: dict of scenario name to summarize() output
+    """
+    rng = random.Random(seed)
+    log = log or (lambda message: None)
+    images = _jpegs(4, rng)
+    users = list(User.objects.filter(id__in=data.userids).select_related('profile').order_by('id'))
+    client = Client()
+    results = {}
+
+    for scenario in _scenarios(data, images, rng):
+        log("benchmarking {}".format(scenario.__name__))
+        latencies, queries, peaks = [], [], []
+        attempts = 0
+        while (len(latencies) < requests or len(peaks) < memory_samples) and attempts < (requests + memory_samples) * 10:
+            attempts += 1
+            viewer = rng.choice(users)
+            request = scenario(viewer)
+            if request is None:
+                continue
+            client.force_login(viewer)
+
+            if len(latencies) < requests:
+                with CaptureQueriesContext(connection) as captured:
+                    start = time.perf_counter()
+                    _send(client, request)
+                    latencies.append(time.perf_counter() - start)
+                queries.append(len(captured))
+            else:
+                tracemalloc.start()
+                _send(client, request)
+                peaks.append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+        if latencies:
+            results[scenario.__name__] = summarize(latencies, queries, peaks or [0])
+
+    return results
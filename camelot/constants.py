@@ -7,6 +7,10 @@ GROUPNAMELEN=30
 MAXPHOTODESC=150
 MAXDISPLAYNAME=100
 MAX_UPLOAD_SIZE=31457280  # 30 MB
+UPLOAD_CHUNK_SIZE=1048576  # 1 MB, uploads are streamed to disk in chunks of this size
+DOWNLOAD_CHUNK_SIZE=1048576  # 1 MB, album downloads are streamed in chunks of this size
+# most photos in one request to the batch upload api, below django's DATA_UPLOAD_MAX_NUMBER_FILES
+UPLOAD_BATCH_MAX_FILES=50
 
 ALBUM_PUBLIC=1
 ALBUM_ALLFRIENDS=2
@@ -18,10 +22,72 @@ ACCESSTYPES = {ALBUM_PUBLIC: "public",
                ALBUM_GROUPS: "specified groups",
                ALBUM_PRIVATE: "owner and contributors"}
 
+# albums without a chosen cover show a random photo on every visit, if False the newest photo
+ALBUM_COVER_ROTATE=True
+
+# photo processing states, derivatives (thumb and mid size) are generated in the background
+PHOTO_PROCESSING=1
+PHOTO_READY=2
+
 PREFIX=""
 
+# uploads are spooled here, on the same partition as the photos so they can be renamed into place
+UPLOAD_TEMP_DIR=PREFIX + "userphotos/tmp"
+
+# resumable uploads, see uploadsessions.py
+# part files, on the data partition so that finished uploads can be renamed into the photo store
+UPLOAD_SESSION_DIR=PREFIX + "userphotos/sessions"
+# seconds an upload session is kept after its last chunk
+UPLOAD_SESSION_LIFETIME=24 * 60 * 60
+# largest chunk accepted in one request
+UPLOAD_SESSION_MAX_CHUNK=8 * 1048576
+# the image header is checked once this much of the file, or all of it, has arrived
+UPLOAD_SESSION_HEADER_BYTES=262144
+
+# content addressed photo store, see photostorage.py, also on the data partition
+PHOTO_STORE_DIR=PREFIX + "userphotos/store"
+# directory levels, each named by two hex digits of the sha256, 2 levels give 65536 directories
+PHOTO_STORE_FANOUT=2
+
+# derivatives still missing this many seconds after they were queued are queued again by manage.py repairderivatives
+DERIVATIVE_RETRY_AGE=15 * 60
+# times the derivatives of a file are attempted before we give up on it
+DERIVATIVE_MAX_ATTEMPTS=3
+
+# files deleted per transaction by the file reaper, see reaper.py
+REAPER_BATCH_SIZE=500
+# seconds a file must have gone unused before the orphan sweep deletes it, newer ones may be mid upload
+ORPHAN_MIN_AGE=60 * 60
+
+# number of photos per page of an album, html and api
+ALBUM_PAGE_SIZE=60
+
+# seconds a profile's friendships stay in the shared cache, if FRIENDGRAPH_CACHE is set
+FRIENDGRAPH_CACHE_TIMEOUT=60 * 60
+
+# number of profiles per page of friend search results
+SEARCH_PAGE_SIZE=20
+
+# most database queries a request to each view may run, by url name, see instrumentation.py
+# these must not grow with the number of albums, photos or friends shown
+# the counts include the session and user lookups done by the middleware
+QUERY_BUDGETS = {
+    'user_home': 6,
+    'show_albums': 6,
+    'getalbumsapi': 5,
+    'show_album': 10,
+    'getphotosapi': 7,
+}
+
+# number of entries shown in the home page activity feed
+FEED_LENGTH=15
+
 THUMBHEIGHT=180
 MIDHEIGHT=600
 
+# signed thumbnail and mid size urls, expiry is rounded up to the bucket so urls stay stable and cacheable
+SIGNED_PHOTO_URL_LIFETIME = 7 * 24 * 60 * 60   # seconds
+SIGNED_PHOTO_URL_BUCKET = 24 * 60 * 60          # seconds
+
 MIN_FREE_THRES = 1024 * 1024 * 1024  # 1 GB
 DATA_PARTITION_PATH = "/"
\ No newline at end of file
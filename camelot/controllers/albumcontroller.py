@@ -1,16 +1,27 @@
-from ..models import Album, Photo, Profile
+from ..models import Album, FileTombstone, Photo, PhotoBlob, Profile
 from .utilities import *
-from .friendcontroller import are_friends
 from .genericcontroller import genericcontroller
-from .groupcontroller import is_in_group
 from ..constants import *
 from ..constants2 import *
+from ..friendfeed import fan_out_photos, refresh_album_feed
+from ..jobqueue import submit_job
+from ..photostorage import file_checksum, get_store
+from ..requestcontext import get_album, get_photo
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import F, Q, Subquery
+from django.db.models.functions import Coalesce
 from django.utils import timezone
-from os import makedirs, unlink
-from io import BytesIO
+from datetime import datetime, timedelta, timezone as dt_timezone
+from os import replace, unlink
+from os.path import basename, isfile
 from PIL import Image
+import logging
+import math
 import shutil
 
+log = logging.getLogger(__name__)
+
 
 class albumcontroller(genericcontroller):
     """
@@ -43,58 +54,79 @@ class albumcontroller(genericcontroller):
         Check if the current user has permission to view the specified album
         :param album: the album who's permissions to check
         :return: boolean
-        Damn this is some overhead...
         """
         # if public, can view
         if album.accesstype == ALBUM_PUBLIC:
             return True
 
-        # owner and contributors can view, checks for ALBUM_PRIVATE access type
-        if self.uprofile == album.owner or self.uprofile in album.contributors.all():
+        # owner can view without going to the db
+        if self.uprofile is not None and self.uprofile.id == album.owner_id:
             return True
 
-        # this may need to be a bit more fleshed out
-        # what if owner wants to show to all friends, but contributor only to a group?
-        if album.accesstype == ALBUM_ALLFRIENDS:
-            for i in collate_owner_and_contrib(album):
-                if are_friends(self.uprofile, i):
-                    return True
-
-        elif album.accesstype == ALBUM_GROUPS:
-            # check uprofile against all groups
-            for group in album.groups.all():
-                if is_in_group(group, self.uprofile):
-                    return True
+        # everything else is answered by the visibility filter in a single query
+        return Album.objects.visible_to(self.uprofile).filter(id=album.id).exists()
 
-        # if we have not returned True, no access
-        return False
+    def filter_visible(self, albums):
+        """
+        Narrow a batch of albums down to the ones the current user can view
+        Use this instead of calling has_permission_to_view() in a loop
+        :param albums: queryset or iterable of albums
+        :return: list of viewable albums, in the order given
+        """
+        albums = list(albums)
+        visibleids = set(Album.objects.visible_to(self.uprofile)
+                         .filter(id__in=[album.id for album in albums])
+                         .values_list('id', flat=True))
+        return [album for album in albums if album.id in visibleids]
 
-    def return_albums(self, profile=None, contrib=False):
+    def return_albums(self, profile=None, contrib=False, covers=False):
         """
         Return albums owned or contributed to by a given profile, verifying permissions for albums to return
         Eventually we will want to return albums the profile contributes to as well
         :param profile: profile to find albums of
         :param contrib: If true, return albums contributed to, if false, owned
+        :param covers: If true, annotate each album with cover_photo_id, see load_covers()
         :return: list of albums
         """
         if profile is None:
             profile = self.uprofile
 
-        try:
-            if contrib:
-                albumset = Album.objects.filter(contributors=profile)
-            else:
-                albumset = Album.objects.filter(owner=profile)
-        except Exception as e:
-            raise e
-
-        albums = []
-        for album in albumset:
-            if self.has_permission_to_view(album):
-                albums.append(album)
-
-        return albums
-        
+        if contrib:
+            albumset = Album.objects.filter(contributors=profile)
+        else:
+            albumset = Album.objects.filter(owner=profile)
+
+        if covers:
+            albumset = albumset.with_cover(rotate=ALBUM_COVER_ROTATE)
+
+        return list(albumset.visible_to(self.uprofile))
+
+    def load_covers(self, albums):
+        """
+        Fetch the cover photos of albums returned by return_albums(covers=True) in a single query
+        Sets album.coverphoto to the photo, or None for empty albums
+        :param albums: list of albums annotated with cover_photo_id, permissions must already be checked
+        :return: None
+        """
+        covers = Photo.objects.only('id', 'status', 'checksum')\
+            .in_bulk([album.cover_photo_id for album in albums if album.cover_photo_id is not None])
+        for album in albums:
+            album.coverphoto = covers.get(album.cover_photo_id)
+
+    def set_album_cover(self, photo):
+        """
+        Use a photo as the cover of its album, only the album owner can do this
+        :param photo: photo to use as cover
+        :return: boolean of success or failure
+        """
+        album = photo.album
+        if self.uprofile is not None and self.uprofile == album.owner:
+            album.cover = photo
+            album.save(update_fields=['cover'])
+            return True
+        else:
+            return False
+
     def return_album(self, id):
         """
         Return an album by id, verifying permissions for album
@@ -103,7 +135,7 @@ class albumcontroller(genericcontroller):
         """
         # we could reference this by primary key, depending on what we can get easiest from the front end
         try:
-            album = Album.objects.get(id=id)
+            album = get_album(id)
         except:
             raise
         if self.has_permission_to_view(album):
@@ -114,12 +146,23 @@ class albumcontroller(genericcontroller):
     def add_photo_to_album(self, albumid, description, fi):
         """
         Saves photo to disk and adds it to the given album
-        this could be done in something like celery
+        Thumbnail and mid size images are generated in the background by the job queue,
+        until they are done the photo is in the PHOTO_PROCESSING state
         :param albumid: id of the album to add to
         :param description: description of the photo
-        :param fi: the image file
+        :param fi: the image file, uploads that were streamed to disk are moved into place instead of copied
         :return: reference to the newly created photo object
         """
+        return self.add_photos_to_album(albumid, [(description, fi)])[0]
+
+    def add_photos_to_album(self, albumid, uploads):
+        """
+        Saves several photos to disk and adds them to the given album, see add_photo_to_album()
+        The album, permission and free space are checked once, and the photos are inserted in one transaction
+        :param albumid: id of the album to add to
+        :param uploads: list of (description, file) tuples
+        :return: list of the newly created photo objects, in the order of uploads
+        """
         album = self.return_album(albumid)
 
         # check that user has permission to add to album
@@ -130,56 +173,69 @@ class albumcontroller(genericcontroller):
         if MIN_FREE_THRES > shutil.disk_usage(DATA_PARTITION_PATH)[2]:
             raise DiskExceededException("Don't have enough space to store new photos")
 
-        # add file to database
-        newphoto = Photo(description=description, album=album, uploader=self.uprofile)
-        newphoto.save()
-
-        # create filename with primary key
-        # will it reuse ids?  I think it will.  But does that matter?  Maybe not..
-        fname = PREFIX + 'userphotos/{}/{}/{}'.format(self.uprofile.user.id, album.id, newphoto.id)
-        thumbname = PREFIX + 'thumbs/{}/{}/{}.jpg'.format(self.uprofile.user.id, album.id, newphoto.id)
-        midname = PREFIX + 'mid/{}/{}/{}.jpg'.format(self.uprofile.user.id, album.id, newphoto.id)
-
-        # update filename in db now that we have our primary key
-        newphoto.filename = fname
-        newphoto.thumb = thumbname
-        newphoto.midsize = midname
-
-        fi.seek(0)
-        with Image.open(BytesIO(fi.read())) as img:
-            newphoto.imgtype = Image.MIME[img.format]
-
-        # save data structure to db
-        newphoto.save()
-
-        # well now we definitely depend on python 3.2+
-        makedirs("/".join(fname.split("/")[:-1]), exist_ok=True)
-        makedirs("/".join(thumbname.split("/")[:-1]), exist_ok=True)
-        makedirs("/".join(midname.split("/")[:-1]), exist_ok=True)
-
-        # save file in chunks to save memory
-        fi.seek(0)
-        CHUNK_SIZE = 430        # bytes
-        with open(fname, 'wb+') as destination:
-            chunk = fi.read(CHUNK_SIZE)
-            while chunk:  # loop until the chunk is empty (the file is exhausted)
-                destination.write(chunk)
-                chunk = fi.read(CHUNK_SIZE)  # read the next chunk
+        # files are stored under their sha256, photos with the same contents share the files
+        store = get_store()
+        newphotos = []
+        spooled = []
+        try:
+            for description, fi in uploads:
+                newphoto = Photo(description=description, album=album, uploader=self.uprofile,
+                                 name=basename(getattr(fi, 'name', None) or '')[:200])
+
+                # Image.open() only reads the header, the image data is decoded later by the derivative job
+                fi.seek(0)
+                with Image.open(fi) as img:
+                    newphoto.imgtype = Image.MIME[img.format]
+
+                src, digest, owned = store.spool(fi)
+                spooled.append((src, digest, owned))
+                newphoto.filename = store.path(digest)
+                newphoto.thumb = store.path(digest, "thumb")
+                newphoto.midsize = store.path(digest, "mid")
+                newphoto.checksum = digest
+                newphotos.append(newphoto)
+
+            with transaction.atomic():
+                digests = [newphoto.checksum for newphoto in newphotos]
+                blobs = PhotoBlob.objects.acquire(digests)
+                # the files of an earlier copy may still be waiting for the reaper, they are in use again
+                revived = [path for digest, blob in blobs.items() if blob.refcount == digests.count(digest)
+                           for path in store.paths(digest)]
+                if revived:
+                    FileTombstone.objects.filter(path__in=revived).delete()
+                stored = []
+                try:
+                    for src, digest, owned in spooled:
+                        if store.put(src, digest, owned):
+                            stored.append(digest)
+                    for newphoto in newphotos:
+                        newphoto.status = PHOTO_READY if blobs[newphoto.checksum].ready else PHOTO_PROCESSING
+                    Photo.objects.bulk_create(newphotos)
+                except Exception:
+                    # the insert is rolled back, so are the files it brought into the store
+                    # while we hold the PhotoBlob locks no other upload can have started using them,
+                    # a file left by a failed commit is picked up by the orphan sweep
+                    for digest in stored:
+                        unlink(store.path(digest))
+                    raise
+        except Exception:
+            for src, digest, owned in spooled:
+                if owned and isfile(src):
+                    unlink(src)
+            raise
 
         # do we need to adjust size parameters in exif tags?
 
-        # save thumbnail
-        fi.seek(0)
-        ThumbFromBuffer(fi, thumbname)
-
-        # save mid size image
-        fi.seek(0)
-        ThumbFromBuffer(fi, midname, MIDHEIGHT)
+        # generate thumbnail and mid size images outside of the request, once per file, unless an earlier upload did
+        queue_derivatives([digest for digest, blob in blobs.items() if not blob.ready])
 
         # We will not set the rotation in the db with get_rotation() at this point.
         # It will be set upon first photo access.
 
-        return newphoto
+        # push the photos into the feeds of everyone who can see them
+        fan_out_photos(newphotos)
+
+        return newphotos
 
     def get_photos_for_album(self, album):
         """
@@ -196,6 +252,60 @@ class albumcontroller(genericcontroller):
         except:
             raise
 
+    def get_photos_page(self, album, after=None, limit=None):
+        """
+        Return one page of an album's photos in upload order
+        Pages are keyed on (pub_date, id) rather than offsets, so every page is an index range scan
+        and photos added while paging do not shift the pages
+        :param album: album model object, can feed straight from return_album()
+        :param after: cursor returned with the previous page, None for the first page
+        :param limit: maximum number of photos on the page, default ALBUM_PAGE_SIZE
+        :return: tuple of (list of photos, cursor for the next page or None on the last page)
+        """
+        if not self.has_permission_to_view(album):
+            raise PermissionException
+
+        limit = limit or ALBUM_PAGE_SIZE
+        photos = Photo.objects.filter(album=album).order_by('pub_date', 'id')
+        if after is not None:
+            pub_date, photoid = decode_photo_cursor(after)
+            photos = photos.filter(Q(pub_date__gt=pub_date) | Q(pub_date=pub_date, id__gt=photoid))
+
+        # fetch one extra to find out if there is another page
+        photos = list(photos[:limit + 1])
+        if len(photos) > limit:
+            return photos[:limit], encode_photo_cursor(photos[limit - 1])
+        return photos, None
+
+    def set_desc_edit_perm(self, album, photos):
+        """
+        Bulk version of check_permission_to_update_photo_description() for photos of one album
+        Compares ids, so no uploader or album rows are loaded
+        :param album: the album the photos belong to
+        :param photos: photos to annotate with desc_edit_perm
+        :return: None
+        """
+        profileid = self.uprofile.id if self.uprofile is not None else None
+        isowner = profileid is not None and album.owner_id == profileid
+        for photo in photos:
+            photo.desc_edit_perm = isowner or (profileid is not None and photo.uploader_id == profileid)
+
+    def get_photo_neighbours(self, photo):
+        """
+        Find the previous and next photo in the album, wrapping around at either end
+        Each neighbour is a keyset lookup on the album's photo ids, so the cost does not depend on album size
+        Permission to view the album must already be checked
+        :param photo: photo to find neighbours of
+        :return: tuple of (previous photo id, next photo id)
+        """
+        photos = Photo.objects.filter(album=photo.album_id).values('id')
+        following = Coalesce(Subquery(photos.filter(id__gt=photo.id).order_by('id')[:1]),
+                             Subquery(photos.order_by('id')[:1]))
+        preceding = Coalesce(Subquery(photos.filter(id__lt=photo.id).order_by('-id')[:1]),
+                             Subquery(photos.order_by('-id')[:1]))
+        return Photo.objects.filter(id=photo.id)\
+            .annotate(previous=preceding, next=following).values_list('previous', 'next').get()
+
     def return_photo(self, photoid):
         """
         make unit test
@@ -203,7 +313,7 @@ class albumcontroller(genericcontroller):
         :return: a single photo
         """
         try:
-            photo = Photo.objects.get(id=photoid)
+            photo = get_photo(photoid)
             return photo
         except:
             raise
@@ -252,9 +362,9 @@ class albumcontroller(genericcontroller):
         # check permission
         if self.uprofile == photo.album.owner or self.uprofile == photo.uploader:
 
-            # remove from db
+            # remove from db (cascades to feed entries)
             status = photo.delete()
-            if status[0] == 1:
+            if status[0] >= 1:
                 return True
             elif status[0] == 0:
                 return False
@@ -271,30 +381,35 @@ class albumcontroller(genericcontroller):
         if self.uprofile == album.owner and ALBUM_PUBLIC <= type <= ALBUM_PRIVATE and isinstance(type, int):
             album.accesstype = type
             album.save()
+            refresh_album_feed(album)
             return True
         else:
             return False
 
-    def add_contributor_to_album(self, album, contributor):
+    def add_contributor_to_album(self, album, contributor, refresh_feed=True):
         """
         Add a contributor to album
         :param album: album to add contributor to
         :param contributor: Profile of user to add as contributor
+        :param refresh_feed: False when adding several, the caller then calls refresh_album_feed() once at the end
         :return: False if not friends, True on success
         """
         # check if users are friends?
-        if not are_friends(album.owner, contributor):
+        if not self.friendgraph.are_friends(album.owner, contributor):
             return False
         # todo: what happens if we add a contributor twice?
         album.contributors.add(contributor)
+        if refresh_feed:
+            refresh_album_feed(album)
         return True
 
-    def add_group_to_album(self, album, group):
+    def add_group_to_album(self, album, group, refresh_feed=True):
         """
         Add a friendgroup access to an album
         Prevent adding group to album that is not own or contributor
         :param album:
         :param group:
+        :param refresh_feed: False when adding several, the caller then calls refresh_album_feed() once at the end
         :return: boolean indicating success of failure
         """
         # if we don't own the group, no bueno
@@ -305,6 +420,8 @@ class albumcontroller(genericcontroller):
             return False
 
         album.groups.add(group)
+        if refresh_feed:
+            refresh_album_feed(album)
         return True
 
     def remove_group_from_album(self, album, group):
@@ -351,30 +468,144 @@ def collate_owner_and_contrib(album):
     return lst
 
 
-def ThumbFromBuffer(buf, filename, baseheight=THUMBHEIGHT):
+def encode_photo_cursor(photo):
     """
-    Take an image buffer, scale and exif rotate, and return a thumbnail
-    :param buf: raw image data buffer
-    :param filename: file name to save as
-    :return: PIL Image thumbnail
+    Opaque pagination cursor for get_photos_page()
+    :param photo: last photo on the page
+    :return: cursor string
     """
-    img = Image.open(BytesIO(buf.read()))
-    img = exif_rotate_image(img)
+    micros = int(photo.pub_date.timestamp()) * 1000000 + photo.pub_date.microsecond
+    return "{}.{}".format(micros, photo.id)
 
-    # if the image is smaller than our target height, don't resize it
-    # this will leave us double saving sometimes, but right now, we need to do that for png uniformity
-    # todo; resolve this redundancy
-    if img.size[1] <= baseheight:
-        newimg = img.convert('RGB')
-        newimg.save(filename, 'jpeg')
-        return newimg
 
-    hpercent = (baseheight / float(img.size[1]))
-    wsize = int((float(img.size[0]) * float(hpercent)))         # we can change 0 to 1 for a square
+def decode_photo_cursor(cursor):
+    """
+    Inverse of encode_photo_cursor()
+    :param cursor: cursor string from the client
+    :return: tuple of (pub_date, photo id), raise ValidationError if the cursor is malformed
+    """
+    try:
+        micros, photoid = (int(part) for part in cursor.split("."))
+        pub_date = datetime.fromtimestamp(micros // 1000000, tz=dt_timezone.utc).replace(microsecond=micros % 1000000)
+    except (ValueError, OverflowError, OSError):
+        raise ValidationError("Invalid page cursor")
+    return pub_date, photoid
+
 
-    # will this return approach leak memory?
-    newimg = img.resize((wsize, baseheight), Image.LANCZOS).convert('RGB')
+def make_photo_derivatives(src, targets):
+    """
+    Job queue entry point, generate the scaled down copies of an uploaded photo
+    Runs in a worker process, so it must not use the database
+    :param src: file name of the original image
+    :param targets: list of (file name, height) tuples to generate
+    :return: None
+    """
+    # don't send the images back to the web process, they are on disk
+    make_derivatives(src, targets)
+
+
+def queue_derivatives(digests, submit=None):
+    """
+    Queue the jobs generating the thumbnail and mid size image of stored files
+    :param digests: hex sha256 of the originals
+    :param submit: submit() of a particular job queue backend, default submit_job()
+    :return: None
+    """
+    if not digests:
+        return
+    submit = submit or submit_job
+    PhotoBlob.objects.filter(sha256__in=digests).update(queued=timezone.now(), failed=False,
+                                                        attempts=F('attempts') + 1)
+    store = get_store()
+    for digest in digests:
+        submit(make_photo_derivatives, store.path(digest),
+               [(store.path(digest, "thumb"), THUMBHEIGHT), (store.path(digest, "mid"), MIDHEIGHT)],
+               on_success=lambda result, digest=digest: mark_blob_ready(digest),
+               on_failure=lambda e, digest=digest: mark_blob_failed(digest))
+
+
+def retry_derivatives(min_age=DERIVATIVE_RETRY_AGE, max_attempts=DERIVATIVE_MAX_ATTEMPTS, submit=None):
+    """
+    Queue the derivatives again for stored files that never got them, because the job failed,
+    or its worker or the web process went away before it finished
+    Until then their photos are processing and views serve the original
+    :param min_age: seconds since unfinished jobs were queued, failed jobs are retried right away
+    :param max_attempts: files attempted this many times are left alone
+    :param submit: submit() of a particular job queue backend, default submit_job()
+    :return: list of the hashes queued
+    """
+    cutoff = timezone.now() - timedelta(seconds=min_age)
+    digests = list(PhotoBlob.objects.filter(ready=False, attempts__lt=max_attempts)
+                   .filter(Q(failed=True) | Q(queued__lt=cutoff)).values_list('sha256', flat=True))
+    queue_derivatives(digests, submit)
+    return digests
+
+
+def mark_blob_failed(digest):
+    """
+    Called when the derivative job of a stored file failed, retry_derivatives() queues it again
+    :param digest: hex sha256 of the original
+    :return: None
+    """
+    log.error("could not generate the derivatives of %s", digest)
+    PhotoBlob.objects.filter(sha256=digest).update(failed=True)
 
-    newimg.save(filename, 'jpeg')
 
-    return newimg
+def mark_blob_ready(digest):
+    """
+    Called once the derivatives of a stored file have been written
+    Every photo sharing the file was waiting on them
+    :param digest: hex sha256 of the original
+    :return: None
+    """
+    PhotoBlob.objects.filter(sha256=digest).update(ready=True, failed=False)
+    Photo.objects.filter(filename=get_store().path(digest), status=PHOTO_PROCESSING).update(status=PHOTO_READY)
+
+
+def make_derivatives(src, targets):
+    """
+    Decode an image once and write every requested size as jpeg
+    JPEGs are decoded at a reduced scale with draft(), the image is exif rotated once,
+    and each size is resized from the previous (larger) one rather than from full resolution
+    :param src: file name or file object of the original image
+    :param targets: list of (file name, height) tuples, in any order
+    :return: dict of file name to the PIL image written
+    """
+    targets = sorted(targets, key=lambda target: target[1], reverse=True)
+    written = {}
+
+    with Image.open(src) as img:
+        if img.format == "JPEG":
+            # ask the decoder for the smallest scale that is still at least as big as our largest target
+            # orientations 6 and 8 are rotated by 90 degrees, so the final height is the current width
+            orientation = img.getexif().get(EXIF_ORIENTATION_TAG)
+            finalheight = img.size[0] if orientation in (6, 8) else img.size[1]
+            scale = min(1.0, targets[0][1] / finalheight)
+            img.draft("RGB", (math.ceil(img.size[0] * scale), math.ceil(img.size[1] * scale)))
+
+        current = exif_rotate_image(img).convert('RGB')
+
+    for filename, baseheight in targets:
+        # if the image is smaller than our target height, don't resize it
+        # this will leave us double saving sometimes, but right now, we need to do that for jpeg uniformity
+        if current.size[1] > baseheight:
+            hpercent = (baseheight / float(current.size[1]))
+            wsize = int((float(current.size[0]) * float(hpercent)))         # we can change 0 to 1 for a square
+            current = current.resize((wsize, baseheight), Image.LANCZOS)
+
+        # write under a temporary name, photos sharing the file may be served while it is generated
+        current.save(filename + ".tmp", 'jpeg')
+        replace(filename + ".tmp", filename)
+        written[filename] = current
+
+    return written
+
+
+def ThumbFromBuffer(buf, filename, baseheight=THUMBHEIGHT):
+    """
+    Take an image buffer, scale and exif rotate, and return a thumbnail
+    :param buf: raw image data buffer
+    :param filename: file name to save as
+    :return: PIL Image thumbnail
+    """
+    return make_derivatives(buf, [(filename, baseheight)])[filename]
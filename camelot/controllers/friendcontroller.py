@@ -1,8 +1,11 @@
 from .genericcontroller import genericcontroller
-from ..models import Friendship, Profile, FriendGroup
+from ..models import Friendship, FriendLink, Profile, FriendGroup
+from ..friendfeed import rebuild_feed
+from ..friendgraph import invalidate as invalidate_friendgraph
+from ..requestcontext import request_friendgraph
+from ..usersearch import search_profiles
 from .utilities import AlreadyExistsException, AddSelfException
-from django.db.models import Q
-from itertools import chain
+from django.db import transaction
 
 class friendcontroller(genericcontroller):
 
@@ -17,22 +20,17 @@ class friendcontroller(genericcontroller):
         if profile == self.uprofile:
             raise AddSelfException("Tried to add self as friend")
 
-        try:
-            # check if a friendship already exists
-            try:
-                Friendship.objects.get(requester=self.uprofile, requestee=profile)
-            except Friendship.DoesNotExist:
-                # check reverse case
-                try:
-                    Friendship.objects.get(requester=profile, requestee=self.uprofile)
-                # ok, we can make friendship, yay!
-                except Friendship.DoesNotExist:
-                    newfriendship = Friendship(requester=self.uprofile, requestee=profile, confirmed=False)
-                    newfriendship.save()
-                    return newfriendship
+        # check if a friendship already exists, in either direction
+        if FriendLink.objects.filter(profile=self.uprofile, friend=profile).exists():
             raise AlreadyExistsException("Already friends")
-        except:
-            raise
+
+        # ok, we can make friendship, yay!
+        newfriendship = Friendship(requester=self.uprofile, requestee=profile, confirmed=False)
+        # the friendship and its FriendLink rows go in together
+        with transaction.atomic():
+            newfriendship.save()
+        invalidate_friendgraph(self.uprofile, profile)
+        return newfriendship
 
     def confirm(self, profile):
         # in this method we will confirm the friendship and add the profile to the profile's friends
@@ -52,8 +50,12 @@ class friendcontroller(genericcontroller):
         # this second clause is probably redundant
         if not relation.confirmed and relation.requestee == self.uprofile:
             relation.confirmed = True
-            relation.save()
+            with transaction.atomic():
+                relation.save()
+            invalidate_friendgraph(self.uprofile, profile)
             # need to add friend to profile?
+            rebuild_feed(self.uprofile)
+            rebuild_feed(profile)
             return True
         else:
             return False
@@ -65,16 +67,18 @@ class friendcontroller(genericcontroller):
         :return: boolean, True if friendship does not exist anymore
         """
         try:
-            relation = Friendship.objects.get(requester=profile, requestee=self.uprofile)
-        except Friendship.DoesNotExist:
-            # if that doesn't work, try reverse before deciding friendship doesn't exist
-            try:
-                relation = Friendship.objects.get(requester=self.uprofile, requestee=profile)
-            except Friendship.DoesNotExist:
-                return True
+            relation = FriendLink.objects.select_related('friendship').get(profile=self.uprofile,
+                                                                            friend=profile).friendship
+        except FriendLink.DoesNotExist:
+            return True
 
         status = relation.delete()
-        if status[0] == 1:
+        invalidate_friendgraph(self.uprofile, profile)
+        if relation.confirmed:
+            rebuild_feed(self.uprofile)
+            rebuild_feed(profile)
+        # the FriendLink rows are deleted along with the friendship
+        if status[0] >= 1:
             return True
         elif status[0] == 0:
             return False
@@ -86,7 +90,7 @@ class friendcontroller(genericcontroller):
         :return: queryset containing all Friendships for the profile
         """
         # make sure to check uprofile has permission to see the profile's friend list
-        return Friendship.objects.all().filter((Q(requestee=profile) | Q(requester=profile)) & Q(confirmed=True))
+        return Friendship.objects.filter(links__profile=profile, confirmed=True)
 
     def return_pending_requests(self):
         """
@@ -95,71 +99,37 @@ class friendcontroller(genericcontroller):
         """
         return Friendship.objects.all().filter(requestee=self.uprofile, confirmed=False)
 
-    def filter_friendships(self, qset, refprofile):
-        """
-        Converts a list of friendships to the relevant profiles
-        Called in return_friend_list
-        Really should be a private method
-        :param qset: queryset of friendship objects
-        :param refprofile: the profile that we are referencing the friends from, e.g. return the friend in the friendship
-        who is not this profile.  As in, we view a profile's friend list in the UI, we get the friendships, we filter the
-        friendships by returning whoever is not the refprofile.  We return refprofile's friends from the queryset returned
-        by return_friend_list().
-        ... maybe we want to just call this in return_friend_list and return this for that
-        :return: list of profile objects corresponding to the friendship objects
-        """
-        # this long loop makes me wary
-        profiles = []
-        for friendship in qset:
-            if friendship.requestee == refprofile:
-                profiles.append(friendship.requester)
-            else:
-                profiles.append(friendship.requestee)
-        return profiles
-
     def return_friend_list(self, profile):
         """
         Return the friend list for a given profile as a list of profiles
+        One query, with the users joined in
         :param profile: profile to get friend list of
         :return: list of profiles
         """
-        return self.filter_friendships(self.return_friendship_list(profile), profile)
+        return list(Profile.objects.filter(friendof__profile=profile, friendof__confirmed=True)
+                    .select_related('user').order_by('friendof__friendship'))
 
-    def findfriends(self, searchstr):
+    def findfriends(self, searchstr, limit=None, offset=0):
         """
         Search for friends by display name and username, filtering out existing friends
         :param searchstr: string to search for
-        :return: queryset of profiles
+        :param limit: maximum number of results, defaults to SEARCH_PAGE_SIZE
+        :param offset: number of results to skip, for paging
+        :return: list of profiles, best match first
         """
-        def _defaultsearch(str):
-            return Profile.objects.filter(dname__icontains=str)\
-                .union(Profile.objects.filter(user__username__icontains=str))
+        return search_profiles(searchstr, exclude_friends_of=self.uprofile, limit=limit, offset=offset)
 
-        def _pgsearch(str):
-            # postgres specific search
-            # todo: test, maybe create environment with postgres
-            return Profile.objects.filter(dname__unaccent__lower__trigram_similar=searchstr)\
-                .union(Profile.objects.filter(user__username__unaccent__lower__trigram_similar=str))
 
-        profiles = _defaultsearch(searchstr)
-        return profiles
-
-
-def are_friends(profile1, profile2, confirmed=True):
+def are_friends(profile1, profile2, confirmed=True, graph=None):
     """
     Test if two users are friends or pending
     :param profile1:
     :param profile2:
     :param confirmed: boolean, if True will only return True if friendship is confirmed
                       if False will only return True if friendship is pending
+    :param graph: FriendGraph to answer from, pass the controller's graph when checking in a loop
     :return: boolean, True if friends
     """
-    try:
-        Friendship.objects.get(requester=profile1, requestee=profile2, confirmed=confirmed)
-    except Friendship.DoesNotExist:
-        try:
-            Friendship.objects.get(requester=profile2, requestee=profile1, confirmed=confirmed)
-        except Friendship.DoesNotExist:
-            return False
-    return True
-
+    if graph is None:
+        graph = request_friendgraph()
+    return graph.are_friends(profile1, profile2, confirmed=confirmed)
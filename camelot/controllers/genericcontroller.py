@@ -1,6 +1,7 @@
 from django.http import Http404
 from .utilities import *
 from ..models import Profile
+from ..requestcontext import request_friendgraph
 
 
 class genericcontroller:
@@ -16,6 +17,9 @@ class genericcontroller:
         else:
             self.uprofile = None
 
+        # friendships are loaded at most once for each profile over the request, shared by all its controllers
+        self.friendgraph = request_friendgraph()
+
     # may not belong here, but let's just drop it here for a sec
     #def validate_permission(self):
     #    """
@@ -1,7 +1,7 @@
-from ..models import FriendGroup
+from ..models import Album, FriendGroup
 from .utilities import *
 from .genericcontroller import genericcontroller
-from .friendcontroller import are_friends
+from ..friendfeed import rebuild_feed
 
 
 class groupcontroller(genericcontroller):
@@ -41,7 +41,7 @@ class groupcontroller(genericcontroller):
         # although who knows, maybe you do want to give someone who isn't your friend certain view access
         # todo: try to hack this using pending friends
         try:
-            assert (are_friends(profile, self.uprofile, confirmed=True) or are_friends(profile, self.uprofile, confirmed=False))
+            assert self.friendgraph.are_friends_or_pending(profile, self.uprofile)
         except Exception as e:
             # log
             return False
@@ -61,6 +61,9 @@ class groupcontroller(genericcontroller):
 
         group.members.add(profile)
         group.save()
+        # membership only changes the feed if the group grants access to an album
+        if group.albumgroup.exists():
+            rebuild_feed(profile)
         return True
 
     def delete_group(self, group):
@@ -71,7 +74,11 @@ class groupcontroller(genericcontroller):
         """
         # check permission
         if group.owner == self.uprofile:
+            # collect the members before the cascade so we can fix up their feeds
+            members = list(group.members.all()) if group.albumgroup.exists() else []
             status = group.delete()
+            for member in members:
+                rebuild_feed(member)
             # cascades to membership
             if status[0] >= 1:
                 return True
@@ -88,9 +95,11 @@ class groupcontroller(genericcontroller):
         :return: true on success, permissionexception on invalid access
         """
         # check permission
-        if group.owner == self.uprofile and member in group.members.all():
+        if group.owner == self.uprofile and is_in_group(group, member):
             group.members.remove(member)
             group.save()
+            if group.albumgroup.exists():
+                rebuild_feed(member)
             return True
         raise PermissionException("Must own group to remove member, member must be in group")
 
@@ -109,6 +118,17 @@ class groupcontroller(genericcontroller):
 
         return groups
 
+    def return_groups_of(self, profiles):
+        """
+        Bulk version of return_groups(), the groups owned by each of several profiles in one query
+        :param profiles: iterable of profiles
+        :return: dict of profile id to list of groups, profiles without groups map to an empty list
+        """
+        groups = {profile.id: [] for profile in profiles}
+        for group in FriendGroup.objects.filter(owner__in=list(groups)).order_by('id'):
+            groups[group.owner_id].append(group)
+        return groups
+
 
 def is_in_group(group, profile):
     """
@@ -124,6 +144,54 @@ def is_in_group(group, profile):
         return False
 
 
+def is_in_groups(groups, profile):
+    """
+    Bulk version of is_in_group(), one query for any number of groups
+    :param groups: iterable of groups or group ids
+    :param profile: profile to test membership of
+    :return: set of the ids of the given groups that profile is a member of
+    """
+    if not profile:
+        return set()
+    groupids = [getattr(group, 'id', group) for group in groups]
+    return set(FriendGroup.members.through.objects.filter(profile=profile, friendgroup__in=groupids)
+               .values_list('friendgroup', flat=True))
+
+
+def member_group_ids(profile):
+    """
+    Every group a profile is a member of
+    Intersect with album_group_ids() to check access to many ALBUM_GROUPS albums in memory
+    :param profile: profile to look up, None if not logged in
+    :return: set of group ids
+    """
+    if not profile:
+        return set()
+    return set(FriendGroup.members.through.objects.filter(profile=profile).values_list('friendgroup', flat=True))
+
+
+def member_ids(group):
+    """
+    Every member of a group, for membership tests in a loop
+    :param group: group to look up
+    :return: set of profile ids
+    """
+    return set(group.members.values_list('id', flat=True))
+
+
+def album_group_ids(albums):
+    """
+    The groups attached to each of several albums, in one query
+    :param albums: iterable of albums or album ids
+    :return: dict of album id to set of group ids, albums without groups map to an empty set
+    """
+    groups = {getattr(album, 'id', album): set() for album in albums}
+    for albumid, groupid in Album.groups.through.objects.filter(album__in=list(groups))\
+            .values_list('album', 'friendgroup'):
+        groups[albumid].add(groupid)
+    return groups
+
+
 def return_group_from_id(id):
     # todo: unit test
     """
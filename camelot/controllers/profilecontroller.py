@@ -1,10 +1,12 @@
-from django.db.models import Q
+from django.contrib.auth.models import User
+from django.db.models import Q, Count, Max
+from django.db.models.functions import TruncDate
 from .genericcontroller import genericcontroller
 from .utilities import get_profile_from_uid, PermissionException
-from .friendcontroller import friendcontroller, are_friends
 from .groupcontroller import groupcontroller
-from .albumcontroller import albumcontroller, collate_owner_and_contrib
-from ..models import Photo
+from .albumcontroller import collate_owner_and_contrib
+from ..models import Album, FeedEntry, Photo, Profile
+from ..requestcontext import get_photo
 from ..constants import *
 
 
@@ -26,10 +28,10 @@ class profilecontroller(genericcontroller):
                 # friendstatus is None
                 pass
             # check friendship
-            elif are_friends(self.uprofile, profile):
+            elif self.friendgraph.are_friends(self.uprofile, profile):
                 friendstatus = "friends"
             # check pending
-            elif are_friends(self.uprofile, profile, confirmed=False):
+            elif self.friendgraph.are_friends(self.uprofile, profile, confirmed=False):
                 friendstatus = "pending"
             # default not friends
             else:
@@ -81,7 +83,7 @@ class profilecontroller(genericcontroller):
         :return: True if valid photo and success, else False
         """
 
-        photo = Photo.objects.get(id=photoid)
+        photo = get_photo(photoid)
 
         if self.uprofile in collate_owner_and_contrib(photo.album):
             self.uprofile.profile_pic = photo
@@ -90,21 +92,53 @@ class profilecontroller(genericcontroller):
         else:
             return False
 
-    def get_feed(self):
+    def get_feed(self, limit=None, before=None):
         """
-        Returns all photos from friends that the user has permission to view
+        Returns photos from friends that the user has permission to view, newest first
+        Reads the materialized feed maintained by friendfeed.py
+        :param limit: maximum number of photos to return
+        :param before: (pub_date, photo id) cursor, only return photos older than this
         :return: A list of photo model objects
         """
-        # initialize our controllers
-        friendcontrol = friendcontroller(self.uprofile.user.id)
-        friendlist = friendcontrol.return_friend_list(self.uprofile)
-        albumcontrol = albumcontroller(self.uprofile.user.id)
+        entries = FeedEntry.objects.filter(owner=self.uprofile)
+        if before is not None:
+            pub_date, photoid = before
+            entries = entries.filter(Q(pub_date__lt=pub_date) | Q(pub_date=pub_date, photo__lt=photoid))
+        entries = entries.select_related('photo').order_by('-pub_date', '-photo')
 
-        # get all photos owned or uploaded by friends
-        allfriendphotos = Photo.objects.filter(Q(uploader__in=friendlist) | Q(uploader=self.uprofile))\
-            .order_by('-pub_date')
+        if limit is not None:
+            entries = entries[:limit]
 
-        # filter the photos based on if our user has permission to view them
-        feedphotos = [photo for photo in allfriendphotos if albumcontrol.has_permission_to_view(photo.album)]
+        return [entry.photo for entry in entries]
 
-        return feedphotos
+    def get_feed_summary(self, limit=None, before=None):
+        """
+        Count the photos in the feed per day, uploader and album
+        The grouping is done by the database in a single GROUP BY query, joined with the names we display
+        :param limit: maximum number of rows to return
+        :param before: (day, latest) cursor taken from the last row of the previous page
+        :return: list of (day, uploader, album, count, latest) tuples, newest first
+                 uploader and album are display only model instances, they only carry names and ids
+        """
+        rows = FeedEntry.objects.filter(owner=self.uprofile)\
+            .annotate(day=TruncDate('pub_date'))\
+            .values('day', 'photo__uploader', 'photo__uploader__dname', 'photo__uploader__user',
+                    'photo__uploader__user__username', 'photo__album', 'photo__album__name')\
+            .annotate(count=Count('id'), latest=Max('pub_date'))\
+            .order_by('-day', '-latest')
+
+        if before is not None:
+            day, latest = before
+            rows = rows.filter(Q(day__lt=day) | Q(day=day, latest__lt=latest))
+
+        if limit is not None:
+            rows = rows[:limit]
+
+        summary = []
+        for row in rows:
+            uploader = Profile(id=row['photo__uploader'], dname=row['photo__uploader__dname'],
+                               user=User(id=row['photo__uploader__user'],
+                                         username=row['photo__uploader__user__username']))
+            album = Album(id=row['photo__album'], name=row['photo__album__name'])
+            summary.append((row['day'], uploader, album, row['count'], row['latest']))
+        return summary
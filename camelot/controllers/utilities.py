@@ -1,9 +1,18 @@
 from django.contrib.auth.models import User
 from PIL.ExifTags import TAGS
+from ..requestcontext import get_profile
+
+# exif tag number of the Orientation field
+EXIF_ORIENTATION_TAG = 0x0112
 
 
 def get_profile_from_uid(id):
-    return User.objects.get(id=id).profile
+    """
+    Profile of a user, looked up once per request, see requestcontext.py
+    :param id: user id
+    :return: profile, raises Profile.DoesNotExist
+    """
+    return get_profile(id)
 
 
 def get_profid_from_username(username):
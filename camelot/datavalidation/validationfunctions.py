@@ -2,6 +2,7 @@ from django.core.exceptions import ValidationError
 from django.template.defaultfilters import filesizeformat
 from PIL import Image
 from html import escape
+import os
 from ..constants import MAX_UPLOAD_SIZE, MAXPHOTODESC
 
 """
@@ -19,23 +20,32 @@ def validate_image(data):
     Validate image
     Check for size
     Check for valid image file
-    :param data: bytesio object representing raw image
+    The image is read from disk in chunks by PIL, it is never loaded into memory as a whole
+    :param data: path or file object of the raw image
     :return:
     """
     # size check
-    fsize = data.getbuffer().nbytes
+    if isinstance(data, str):
+        fsize = os.path.getsize(data)
+    else:
+        fsize = data.seek(0, os.SEEK_END)
+        data.seek(0)
     if fsize > MAX_UPLOAD_SIZE:
         raise ValidationError(
             "Please keep file size under {}. Current file size {}".format(filesizeformat(str(MAX_UPLOAD_SIZE)),
                                                                           filesizeformat(fsize)))
 
     # confirm valid image
-    img = Image.open(data)
     try:
-        img.verify()
+        # open() raises for data PIL does not recognise at all, verify() for a broken image
+        with Image.open(data) as img:
+            img.verify()
     except Exception as e:
         print(e)
         raise ValidationError("Invalid image file")
+    finally:
+        if not isinstance(data, str):
+            data.seek(0)
 
 
 def validate_photo_description(data):
@@ -0,0 +1,149 @@
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe
+from urllib.parse import quote
+import os
+import re
+
+"""
+Hand stored photo files to the client once a view has authorized the request
+
+Backends, chosen with settings.FILE_DELIVERY_BACKEND:
+ - "django": stream the file from python with FileResponse, the wsgi server can use sendfile() (default)
+ - "x-accel-redirect": nginx serves the file from an internal location, see deploy-debian
+ - "x-sendfile": apache (mod_xsendfile) or lighttpd serve the file from its absolute path
+
+With either of the proxy backends the worker is free as soon as the headers are written,
+and the proxy takes care of Range requests
+"""
+
+DELIVERY_DJANGO = "django"
+DELIVERY_X_ACCEL_REDIRECT = "x-accel-redirect"
+DELIVERY_X_SENDFILE = "x-sendfile"
+
+RANGE_CHUNK_SIZE = 64 * 1024
+
+# we only serve single ranges, clients asking for several get the whole file
+SINGLE_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def serve_file(path, content_type, request=None, etag=None, last_modified=None):
+    """
+    Build the response that delivers a file
+    The caller is responsible for the permission check, path must never come from the client
+    :param path: path of the file, relative to the working directory
+    :param content_type: mime type of the file
+    :param request: the request, needed to answer Range requests
+    :param etag: quoted etag of the file, if any
+    :param last_modified: modification time of the file as a timestamp, if any
+    :return: http response
+    """
+    backend = getattr(settings, 'FILE_DELIVERY_BACKEND', DELIVERY_DJANGO)
+
+    if backend == DELIVERY_DJANGO:
+        response = _django_response(path, content_type, request, etag, last_modified)
+    else:
+        response = HttpResponse(content_type=content_type)
+        if backend == DELIVERY_X_ACCEL_REDIRECT:
+            response['X-Accel-Redirect'] = quote(settings.FILE_DELIVERY_ACCEL_PREFIX + os.path.normpath(path))
+        elif backend == DELIVERY_X_SENDFILE:
+            response['X-Sendfile'] = os.path.abspath(path)
+        else:
+            raise ValueError("Unknown file delivery backend {}".format(backend))
+
+    if etag:
+        response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+def _django_response(path, content_type, request, etag, last_modified):
+    """
+    Stream the file from python, honouring a single byte range
+    """
+    f = open(path, "rb")
+    size = os.fstat(f.fileno()).st_size
+
+    byterange = None
+    if request is not None and _range_applies(request, etag, last_modified):
+        byterange = parse_range(request.META['HTTP_RANGE'], size)
+
+    if byterange is None:
+        response = FileResponse(f, content_type=content_type)
+    elif byterange is False:
+        f.close()
+        response = HttpResponse(status=416, content_type=content_type)
+        response['Content-Range'] = "bytes */{}".format(size)
+    else:
+        start, end = byterange
+        response = StreamingHttpResponse(_read_range(f, start, end - start + 1), status=206,
+                                         content_type=content_type)
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = "bytes {}-{}/{}".format(start, end, size)
+
+    response['Accept-Ranges'] = "bytes"
+    return response
+
+
+def _range_applies(request, etag, last_modified):
+    """
+    A Range header is only honoured if there is no If-Range, or the If-Range still matches the file
+    """
+    if 'HTTP_RANGE' not in request.META:
+        return False
+    ifrange = request.META.get('HTTP_IF_RANGE')
+    if ifrange is None:
+        return True
+    if ifrange.startswith('"'):
+        # weak etags must not be used for If-Range
+        return etag is not None and not etag.startswith('W/') and ifrange == etag
+    ifdate = parse_http_date_safe(ifrange)
+    return ifdate is not None and last_modified is not None and int(last_modified) == ifdate
+
+
+def parse_range(header, size):
+    """
+    Parse a Range header for a single byte range
+    :param header: value of the Range header
+    :param size: size of the file in bytes
+    :return: (start, end) inclusive, None to ignore the header and serve the whole file,
+             or False if the range cannot be satisfied
+    """
+    match = SINGLE_RANGE_RE.match(header.replace(' ', ''))
+    if match is None:
+        return None
+    first, last = match.groups()
+    if first == '' and last == '':
+        return None
+
+    if first == '':
+        # suffix range, the last n bytes
+        if int(last) == 0:
+            return False
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last != '' else size - 1
+        if last != '' and int(last) < start:
+            return None
+
+    if start >= size:
+        return False
+    return start, end
+
+
+def _read_range(f, start, length):
+    """
+    Yield length bytes of f starting at start, closes the file when done
+    """
+    try:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(RANGE_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
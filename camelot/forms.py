@@ -4,7 +4,7 @@ from django.core.exceptions import ValidationError
 from django.contrib.auth.models import User
 from .constants import *
 from .constants2 import SITEDOMAIN
-from .controllers.groupcontroller import groupcontroller
+from .controllers.groupcontroller import groupcontroller, member_ids
 from .controllers.friendcontroller import friendcontroller
 from .logs import log_exception
 from .user_emailing import send_registration_email
@@ -77,6 +77,8 @@ class EditProfileForm(forms.Form):
 
 class SearchForm(forms.Form):
     searchtext = forms.CharField(label='Friend Search', max_length=MAXDISPLAYNAME)
+    # number of results already shown, for the next page
+    offset = forms.IntegerField(min_value=0, required=False, widget=forms.HiddenInput)
 
 
 class ManageGroupsForm(forms.Form):
@@ -144,7 +146,9 @@ class AddContributorForm(forms.Form):
         super(AddContributorForm, self).__init__(*args, **kwargs)
         control = friendcontroller(myuid)
         # todo: change this to str(x) rather than x.user.username, look for other instances
-        ch = lambda: [(x.id, x.user.username) for x in control.return_friend_list(control.uprofile) if x not in album.contributors.all()]
+        contributorids = set(album.contributors.values_list('id', flat=True))
+        ch = lambda: [(x.id, x.user.username) for x in control.return_friend_list(control.uprofile)
+                      if x.id not in contributorids]
         self.fields['idname'] = forms.MultipleChoiceField(
             label='New Contributor', choices=ch)
 
@@ -155,15 +159,17 @@ class ManageGroupMemberForm(forms.Form):
         super(ManageGroupMemberForm, self).__init__(*args, **kwargs)
 
         friendcontrol = friendcontroller(myprofile.user.id)
+        # membership is loaded once rather than queried for every friend
+        members = member_ids(group)
         if not remove:
             # add friend to group
             ch = lambda: [(x.user.id, str(x)) for x in friendcontrol.return_friend_list(myprofile) if
-                          x not in group.members.all()]
+                          x.id not in members]
             label = "Add Friends"
         else:
             # remove friend from group
             ch = lambda: [(x.user.id, str(x)) for x in friendcontrol.return_friend_list(myprofile) if
-                          x in group.members.all()]
+                          x.id in members]
             label = "Remove Friends"
 
         self.fields['idname'] = forms.MultipleChoiceField(
@@ -1,43 +1,133 @@
 #! /usr/bin/env python
-from collections import OrderedDict
 from datetime import datetime, timedelta
+from django.db import connection, transaction
+from django.db.models import Q
+from .models import Album, FeedEntry, Friendship, Photo, Profile
 
+"""
+The home feed is materialized in the FeedEntry table (fan out on write)
+Anything that changes who can see a photo must call one of the maintenance functions below:
+ - new photos                                 -> fan_out_photo(), fan_out_photos()
+ - album access type, groups or contributors  -> refresh_album_feed()
+ - friendship or group membership of profile  -> rebuild_feed()
+Deleting photos, albums or profiles cascades to the feed by foreign key
+"""
 
-def generate_feed(profilecontrol):
+# how many feed rows we insert per statement
+FEED_BATCH_SIZE = 500
+
+
+def _feed_audience(uploaderid):
+    """
+    Everyone whose feed can contain photos uploaded by a profile: the uploader and their friends
+    :param uploaderid: id of the uploading profile
+    :return: queryset of profiles
+    """
+    return Profile.objects.filter(Q(id=uploaderid) | Q(id__in=Friendship.objects.friend_ids(uploaderid)))
+
+
+def fan_out_photo(photo):
+    """
+    Add a newly uploaded photo to the feed of everyone who should see it
+    :param photo: the new photo
+    :return: None
+    """
+    fan_out_photos([photo])
+
+
+def fan_out_photos(photos):
+    """
+    Add newly uploaded photos to the feeds of everyone who should see them
+    Who can see them is looked up once per uploader and album, not once per photo
+    :param photos: the new photos
+    :return: None
+    """
+    groups = {}
+    for photo in photos:
+        if photo.uploader_id is not None:
+            groups.setdefault((photo.uploader_id, photo.album_id), []).append(photo)
+
+    for (uploaderid, albumid), group in groups.items():
+        viewerids = list(_feed_audience(uploaderid).can_view(group[0].album).values_list('id', flat=True))
+        FeedEntry.objects.bulk_create([FeedEntry(owner_id=viewerid, photo=photo, pub_date=photo.pub_date)
+                                       for photo in group for viewerid in viewerids],
+                                      batch_size=FEED_BATCH_SIZE, ignore_conflicts=True)
+
+
+def refresh_album_feed(album):
+    """
+    Recompute the feed rows for every photo in an album
+    Called when who can view the album changes, once per change however many groups or contributors it adds
+    The rows are written by the database, one INSERT ... SELECT per uploader, so that no photo x viewer
+    rows are built in python however large the album and its audience
+    :param album: album whose permissions changed
+    :return: None
+    """
+    with transaction.atomic():
+        FeedEntry.objects.filter(photo__album=album).delete()
+
+        uploaderids = Photo.objects.filter(album=album, uploader__isnull=False)\
+            .order_by().values_list('uploader', flat=True).distinct()
+        for uploaderid in uploaderids:
+            viewers = _feed_audience(uploaderid).can_view(album).order_by().values('id')
+            photos = Photo.objects.filter(album=album, uploader=uploaderid).order_by().values('id', 'pub_date')
+            _insert_feed_entries(viewers, photos)
+
+
+def _insert_feed_entries(viewers, photos):
+    """
+    Add every one of photos to the feed of every one of viewers, in a single statement
+    :param viewers: profile queryset of values('id')
+    :param photos: photo queryset of values('id', 'pub_date')
+    :return: None
+    """
+    viewersql, viewerparams = viewers.query.sql_with_params()
+    photosql, photoparams = photos.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute("INSERT INTO {} (owner_id, photo_id, pub_date) "
+                       "SELECT viewer.id, photo.id, photo.pub_date FROM ({}) viewer CROSS JOIN ({}) photo"
+                       .format(connection.ops.quote_name(FeedEntry._meta.db_table), viewersql, photosql),
+                       viewerparams + photoparams)
+
+
+def rebuild_feed(profile):
+    """
+    Recompute the whole feed of one profile
+    Called when the profile's friendships or group memberships change
+    :param profile: profile whose feed to rebuild
+    :return: None
+    """
+    with transaction.atomic():
+        FeedEntry.objects.filter(owner=profile).delete()
+
+        photos = Photo.objects.filter(Q(uploader__in=Friendship.objects.friend_ids(profile)) | Q(uploader=profile))\
+            .filter(album__in=Album.objects.visible_to(profile))\
+            .values_list('id', 'pub_date')
+
+        FeedEntry.objects.bulk_create([FeedEntry(owner=profile, photo_id=photoid, pub_date=pub_date)
+                                       for photoid, pub_date in photos.iterator()],
+                                      batch_size=FEED_BATCH_SIZE)
+
+
+def generate_feed(profilecontrol, limit=None, before=None):
     """
     Generate a feed of the number of photos uploaded by a particular uploader to a particular album on
     a given day
     :param profilecontrol: a profilecontroller object
+    :param limit: maximum number of entries to return
+    :param before: cursor to continue from, see profilecontroller.get_feed_summary()
     :return: a list of tuples in order of day string (relative to current), uploader, album, and the count of photos
              under the previous criteria
     """
-    feedphotos = profilecontrol.get_feed()
-    grouped = OrderedDict()
-
-    for p in feedphotos:
-        uploadeddate = p.pub_date.date()
-        if uploadeddate not in grouped.keys():
-            grouped[uploadeddate] = {p.uploader: {p.album: 1}}
-        else:
-            if p.uploader not in grouped[uploadeddate].keys():
-                grouped[uploadeddate][p.uploader] = {p.album: 1}
-            else:
-                if p.album not in grouped[uploadeddate][p.uploader].keys():
-                    grouped[uploadeddate][p.uploader][p.album] = 1
-                else:
-                    grouped[uploadeddate][p.uploader][p.album] += 1
-
     feedentries = []
     today = datetime.today().date()
-    for date, up in grouped.items():
-        for uploader, alb in up.items():
-            for album, count in alb.items():
-                if date == today:
-                    daytext = "today"
-                elif date == today - timedelta(days=1):
-                    daytext = "yesterday"
-                else:
-                    daytext = "{} days ago".format(abs((today - date).days))
-                feedentries.append((daytext, uploader, album, count))
+    for date, uploader, album, count, latest in profilecontrol.get_feed_summary(limit=limit, before=before):
+        if date == today:
+            daytext = "today"
+        elif date == today - timedelta(days=1):
+            daytext = "yesterday"
+        else:
+            daytext = "{} days ago".format(abs((today - date).days))
+        feedentries.append((daytext, uploader, album, count))
 
     return feedentries
@@ -0,0 +1,136 @@
+from django.conf import settings
+from django.core.cache import caches
+import time
+from .constants import FRIENDGRAPH_CACHE_TIMEOUT
+from .models import FriendLink
+
+"""
+In memory view of the friendship graph
+
+A FriendGraph loads a profile's adjacency (confirmed friends and pending requests in either direction)
+with one query the first time it is needed and answers every later check from memory.
+Controllers create one per request, so a request checks any number of friendships for a profile with one query.
+A change made through friendcontroller in this process makes every graph reload.
+
+If settings.FRIENDGRAPH_CACHE names a cache in CACHES the adjacency is also shared between requests.
+That cache must be shared by all processes (memcached, redis, database), not the per process LocMemCache.
+Entries are versioned per profile, friendcontroller.add/confirm/remove call invalidate() to bump the version.
+"""
+
+
+def _profile_id(profile):
+    return getattr(profile, 'id', profile)
+
+
+def _query_adjacency(profileid):
+    """
+    :param profileid: id of the profile
+    :return: tuple of (frozenset of confirmed friend ids, frozenset of ids with a pending request either way)
+    """
+    confirmed, pending = set(), set()
+    for friendid, isconfirmed in FriendLink.objects.filter(profile=profileid).values_list('friend', 'confirmed'):
+        (confirmed if isconfirmed else pending).add(friendid)
+    return frozenset(confirmed), frozenset(pending)
+
+
+def _shared_cache():
+    alias = getattr(settings, 'FRIENDGRAPH_CACHE', None)
+    return caches[alias] if alias else None
+
+
+def _version_key(profileid):
+    return "friendgraph:version:{}".format(profileid)
+
+
+def _load_adjacency(profileid):
+    cache = _shared_cache()
+    if cache is None:
+        return _query_adjacency(profileid)
+
+    # a missing version is started from the clock, so entries written before it was lost can never match
+    cache.add(_version_key(profileid), time.time_ns(), None)
+    key = "friendgraph:{}:{}".format(profileid, cache.get(_version_key(profileid)))
+    adjacency = cache.get(key)
+    if adjacency is None:
+        adjacency = _query_adjacency(profileid)
+        cache.set(key, adjacency, FRIENDGRAPH_CACHE_TIMEOUT)
+    return adjacency
+
+
+# bumped on every change in this process, graphs that loaded before a change reload
+_generation = 0
+
+
+def invalidate(*profiles):
+    """
+    Drop the shared adjacency of profiles whose friendships changed
+    :param profiles: profiles or profile ids
+    :return: None
+    """
+    global _generation
+    _generation += 1
+
+    cache = _shared_cache()
+    if cache is None:
+        return
+    for profile in profiles:
+        key = _version_key(_profile_id(profile))
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, time.time_ns(), None)
+
+
+class FriendGraph:
+    def __init__(self):
+        self._adjacency = {}
+        self._generation = _generation
+
+    def _get(self, profile):
+        if self._generation != _generation:
+            self._adjacency.clear()
+            self._generation = _generation
+        profileid = _profile_id(profile)
+        if profileid not in self._adjacency:
+            self._adjacency[profileid] = _load_adjacency(profileid)
+        return self._adjacency[profileid]
+
+    def friend_ids(self, profile):
+        """
+        :param profile: profile or profile id
+        :return: frozenset of ids of the profile's confirmed friends
+        """
+        return self._get(profile)[0]
+
+    def pending_ids(self, profile):
+        """
+        :param profile: profile or profile id
+        :return: frozenset of ids of profiles with an unconfirmed request to or from the profile
+        """
+        return self._get(profile)[1]
+
+    def are_friends(self, profile1, profile2, confirmed=True):
+        """
+        Same semantics as friendcontroller.are_friends()
+        :param confirmed: if True only confirmed friendships count, if False only pending ones
+        :return: boolean
+        """
+        adjacency = self.friend_ids(profile1) if confirmed else self.pending_ids(profile1)
+        return _profile_id(profile2) in adjacency
+
+    def are_friends_or_pending(self, profile1, profile2):
+        """
+        :return: True if the profiles are friends or either has a pending request to the other
+        """
+        otherid = _profile_id(profile2)
+        return otherid in self.friend_ids(profile1) or otherid in self.pending_ids(profile1)
+
+    def friends_among(self, profile, candidates):
+        """
+        Which of the candidates are confirmed friends of profile
+        :param profile: profile or profile id
+        :param candidates: iterable of profiles or profile ids
+        :return: list of the candidates that are friends, in the given order
+        """
+        friends = self.friend_ids(profile)
+        return [candidate for candidate in candidates if _profile_id(candidate) in friends]
@@ -0,0 +1,179 @@
+from contextlib import ExitStack
+from django.conf import settings
+from django.db import connections
+import logging
+import re
+import threading
+import time
+import uuid
+from .constants import QUERY_BUDGETS
+from .logs import reset_request, set_request
+
+"""
+Per view instrumentation
+
+InstrumentationMiddleware records, for every request, keyed by the url name from camelot/urls.py:
+ - the number of database queries, and how many of them repeat a query already run in the request
+ - time spent in the database and the rest of the time, spent in python
+ - size of the response body
+Each request is logged on the "camelot.instrumentation" logger, a JSON line with settings.LOGGING, and the
+totals are exported in the prometheus text format by view.internal.metrics.
+The middleware also gives each request an id, taken from the X-Request-ID header set by the front proxy
+if there is one, which is returned in the response and added to every log record of the request.
+Totals are per process, the scraper sees each worker separately.
+
+Views listed in constants.QUERY_BUDGETS have a maximum number of queries. Going over it logs a warning,
+or raises QueryBudgetExceeded if settings.QUERY_BUDGET_ENFORCE is set, which tests.runner.QueryBudgetTestRunner
+does for the whole test suite.
+Queries run while a streaming response is being sent are not counted.
+"""
+
+log = logging.getLogger(__name__)
+
+# request ids accepted from the front proxy
+_REQUEST_ID = re.compile(r'^[\w\-]{1,64}$')
+
+# (prometheus metric name, help text, stats field)
+_COUNTERS = [
+    ("camelot_view_requests_total", "Requests handled", "requests"),
+    ("camelot_view_queries_total", "Database queries run", "queries"),
+    ("camelot_view_duplicate_queries_total", "Queries repeating an earlier query of the same request",
+     "duplicates"),
+    ("camelot_view_sql_seconds_total", "Time spent in the database", "sql_seconds"),
+    ("camelot_view_python_seconds_total", "Time spent outside the database", "python_seconds"),
+    ("camelot_view_response_bytes_total", "Response body bytes", "response_bytes"),
+]
+
+_lock = threading.Lock()
+_stats = {}
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryRecorder:
+    """
+    Database execute wrapper counting and timing the queries of one request
+    """
+    def __init__(self):
+        self.queries = 0
+        self.duplicates = 0
+        self.seconds = 0.0
+        self.seen = set()
+
+    def __call__(self, execute, sql, params, many, context):
+        key = (sql, repr(params))
+        if key in self.seen:
+            self.duplicates += 1
+        else:
+            self.seen.add(key)
+        self.queries += 1
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+
+def _response_size(response):
+    if response.streaming:
+        return int(response.get('Content-Length', 0))
+    return len(response.content)
+
+
+def record(view, queries, duplicates, sql_seconds, python_seconds, response_bytes):
+    """
+    Add one request to the totals of a view
+    :return: None
+    """
+    with _lock:
+        stats = _stats.setdefault(view, {field: 0 for _, _, field in _COUNTERS})
+        stats['requests'] += 1
+        stats['queries'] += queries
+        stats['duplicates'] += duplicates
+        stats['sql_seconds'] += sql_seconds
+        stats['python_seconds'] += python_seconds
+        stats['response_bytes'] += response_bytes
+
+
+def reset():
+    """
+    Forget all totals
+    :return: None
+    """
+    with _lock:
+        _stats.clear()
+
+
+def prometheus_text():
+    """
+    :return: the totals of every view in the prometheus text exposition format
+    """
+    with _lock:
+        stats = {view: dict(values) for view, values in _stats.items()}
+    lines = []
+    for name, helptext, field in _COUNTERS:
+        lines.append("# HELP {} {}".format(name, helptext))
+        lines.append("# TYPE {} counter".format(name))
+        for view in sorted(stats):
+            lines.append('{}{{view="{}"}} {}'.format(name, view, stats[view][field]))
+    return "\n".join(lines) + "\n"
+
+
+def check_budget(view, queries):
+    """
+    Compare the number of queries of a request with the budget of its view
+    :param view: url name
+    :param queries: number of queries the request ran
+    :return: None, raises QueryBudgetExceeded if over budget and settings.QUERY_BUDGET_ENFORCE is set
+    """
+    budget = QUERY_BUDGETS.get(view)
+    if budget is None or queries <= budget:
+        return
+    message = "{} ran {} queries, its budget is {}".format(view, queries, budget)
+    if getattr(settings, 'QUERY_BUDGET_ENFORCE', False):
+        raise QueryBudgetExceeded(message)
+    log.warning(message)
+
+
+class InstrumentationMiddleware:
+    """
+    Measure every request, should be the first middleware so that it sees all queries
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        requestid = request.META.get('HTTP_X_REQUEST_ID', '')
+        if not _REQUEST_ID.match(requestid):
+            requestid = uuid.uuid4().hex
+        tokens = set_request(request, requestid)
+        try:
+            response = self._measure(request)
+        finally:
+            reset_request(tokens)
+        response['X-Request-ID'] = requestid
+        return response
+
+    def _measure(self, request):
+        recorder = QueryRecorder()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - start
+
+        match = request.resolver_match
+        view = match.url_name if match is not None and match.url_name else "unresolved"
+        size = _response_size(response)
+        record(view, recorder.queries, recorder.duplicates, recorder.seconds, elapsed - recorder.seconds, size)
+        log.info("%s %s", request.method, view,
+                 extra={'data': {"view": view, "method": request.method, "status": response.status_code,
+                                 "queries": recorder.queries, "duplicate_queries": recorder.duplicates,
+                                 "sql_ms": round(recorder.seconds * 1000, 3),
+                                 "python_ms": round((elapsed - recorder.seconds) * 1000, 3),
+                                 "response_bytes": size}})
+        check_budget(view, recorder.queries)
+        return response
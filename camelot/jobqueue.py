@@ -0,0 +1,93 @@
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.db import connection
+import multiprocessing
+from .logs import log_exception
+
+"""
+Pluggable job queue for work that should not hold up a request, e.g. generating photo derivatives
+
+Backends, chosen with settings.JOB_QUEUE_BACKEND:
+ - "sync": run the job right away in the calling process (default, used by the tests)
+ - "process": run the job in a local pool of worker processes, no external broker required
+
+Jobs must be module level functions with picklable arguments, and must not touch the database.
+The on_success callback runs in the web process once the job is done and may use the database,
+on_failure gets the exception instead if the job raised or its worker died.
+"""
+
+
+class SyncBackend:
+    def submit(self, func, *args, on_success=None, on_failure=None):
+        try:
+            result = func(*args)
+        except Exception as e:
+            log_exception(__name__, e)
+            if on_failure is not None:
+                on_failure(e)
+            return
+        if on_success is not None:
+            on_success(result)
+
+
+class ProcessPoolBackend:
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = None
+
+    def submit(self, func, *args, on_success=None, on_failure=None):
+        # create the pool lazily so that every gunicorn worker gets its own after forking
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                mp_context=multiprocessing.get_context('fork'))
+        future = self.executor.submit(func, *args)
+        future.add_done_callback(lambda f: self._done(f, on_success, on_failure))
+
+    @staticmethod
+    def _done(future, on_success, on_failure):
+        """
+        Runs on the pool's management thread, which has its own database connection
+        """
+        try:
+            if future.exception() is not None:
+                log_exception(__name__, future.exception())
+                if on_failure is not None:
+                    on_failure(future.exception())
+            elif on_success is not None:
+                on_success(future.result())
+        except Exception as e:
+            log_exception(__name__, e)
+        finally:
+            connection.close()
+
+
+_backend = None
+
+
+def get_backend():
+    """
+    Return the job queue backend configured in settings, created once per process
+    :return: backend object with a submit() method
+    """
+    global _backend
+    if _backend is None:
+        name = getattr(settings, 'JOB_QUEUE_BACKEND', 'sync')
+        if name == 'sync':
+            _backend = SyncBackend()
+        elif name == 'process':
+            _backend = ProcessPoolBackend(getattr(settings, 'JOB_QUEUE_WORKERS', 2))
+        else:
+            raise ValueError("Unknown job queue backend {}".format(name))
+    return _backend
+
+
+def submit_job(func, *args, on_success=None, on_failure=None):
+    """
+    Queue a job on the configured backend
+    :param func: module level function to run
+    :param args: picklable arguments for func
+    :param on_success: optional callable taking the job's return value
+    :param on_failure: optional callable taking the exception the job failed with
+    :return: None
+    """
+    get_backend().submit(func, *args, on_success=on_success, on_failure=on_failure)
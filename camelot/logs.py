@@ -1,24 +1,129 @@
+from contextvars import ContextVar
+from django.utils.functional import empty
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, WatchedFileHandler
+import atexit
+import json
 import logging
+import queue
 import traceback
 
+"""
+Logging helpers, the handlers themselves are configured once by settings.LOGGING
+
+Request threads only put records on a queue, QueueingFileHandler writes them to disk on a listener thread.
+RequestFilter stamps each record with the id of the request and user it was logged from,
+JsonFormatter writes one JSON object per line.
+"""
+
+# the request being handled, set by instrumentation.InstrumentationMiddleware
+_request = ContextVar('camelot_log_request', default=None)
+_request_id = ContextVar('camelot_log_request_id', default=None)
+
+
+def set_request(request, requestid):
+    """
+    Attach log records from the current context to a request
+    :param request: the request being handled
+    :param requestid: id of the request, also returned in the X-Request-ID header
+    :return: tokens for reset_request()
+    """
+    return _request.set(request), _request_id.set(requestid)
+
+
+def reset_request(tokens):
+    request, requestid = tokens
+    _request.reset(request)
+    _request_id.reset(requestid)
+
+
+def _current_user_id():
+    request = _request.get()
+    user = getattr(request, 'user', None)
+    # request.user is loaded lazily, logging must not be what queries it
+    if user is None or getattr(user, '_wrapped', None) is empty:
+        return None
+    return user.id
+
+
+class RequestFilter(logging.Filter):
+    """
+    Add request_id and user_id to every record, None outside of a request
+    Runs in the thread that logs, before the record is queued
+    """
+    def filter(self, record):
+        record.request_id = _request_id.get()
+        record.user_id = _current_user_id()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record, a dict passed as extra={'data': ...} is merged in
+    """
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, 'request_id', None),
+            "user_id": getattr(record, 'user_id', None),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        entry.update(getattr(record, 'data', {}))
+        return json.dumps(entry, default=str)
+
+
+class QueueingFileHandler(QueueHandler):
+    """
+    Queue records for a file handler running on its own thread, so logging never waits on the disk
+    The file is only opened when the first record is written
+    :param filename: log file
+    :param maxBytes: rotate when the file reaches this size, 0 to leave rotation to logrotate
+    :param backupCount: number of rotated files to keep
+    """
+    def __init__(self, filename, maxBytes=0, backupCount=0):
+        super().__init__(queue.SimpleQueue())
+        if maxBytes:
+            target = RotatingFileHandler(filename, maxBytes=maxBytes, backupCount=backupCount, delay=True)
+        else:
+            # reopens the file when logrotate moves it, safe with many worker processes
+            target = WatchedFileHandler(filename, delay=True)
+        self.listener = QueueListener(self.queue, target)
+        self.listener.start()
+        self.stopped = False
+        # write out what is still queued when the process exits
+        atexit.register(self.stop)
+
+    def stop(self):
+        if not self.stopped:
+            self.stopped = True
+            self.listener.stop()
+            for handler in self.listener.handlers:
+                handler.close()
+
+    def close(self):
+        self.stop()
+        super().close()
+
+
+def return_logger(name, fname=None):
+    """
+    Return a logger, kept for old callers, handlers are no longer added here
+    :param name: logger name
+    :param fname: ignored, files are chosen in settings.LOGGING
+    :return: logger
+    """
+    return logging.getLogger(name)
+
 
 def return_def_logger(name):
-    return return_logger(name, "/var/log/www-data/spam.log")
+    return return_logger(name)
 
 
 def return_ex_logger(name):
-    return return_logger(name, "/var/log/www-data/exceptions.log")
-
-
-def return_logger(name, fname):
-    log = logging.getLogger(name)
-    log.setLevel(logging.ERROR)
-    fh = logging.FileHandler(fname)
-    fh.setLevel(logging.DEBUG)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    fh.setFormatter(formatter)
-    log.addHandler(fh)
-    return log
+    return return_logger(name)
 
 
 def log_msg():
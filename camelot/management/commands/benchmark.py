@@ -0,0 +1,76 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+import django
+import json
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+from ...benchmark import generate_dataset, run_benchmarks
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=settings.BASE_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = ("Benchmark the main pages against synthetic data, in a throwaway test database and directory, "
+            "and write the results as JSON")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--degree', type=int, default=3, help="friends made by each new user")
+        parser.add_argument('--albums', type=int, default=2, help="average albums per user")
+        parser.add_argument('--photos', type=int, default=4, help="average photos per album")
+        parser.add_argument('--requests', type=int, default=100, help="timed requests per page")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', default="benchmark.json")
+
+    def handle(self, *args, **options):
+        output = os.path.abspath(options['output'])
+        log = lambda message: self.stdout.write(message)
+
+        # DEBUG would keep every query of the data generation in memory
+        setup_test_environment(debug=False)
+        olddb = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        olddir = os.getcwd()
+        try:
+            with tempfile.TemporaryDirectory() as workdir:
+                # photos are written relative to the working directory
+                os.chdir(workdir)
+                start = time.perf_counter()
+                data = generate_dataset(users=options['users'], degree=options['degree'],
+                                        albums=options['albums'], photos=options['photos'],
+                                        seed=options['seed'], log=log)
+                generated = time.perf_counter() - start
+                results = run_benchmarks(data, requests=options['requests'], seed=options['seed'], log=log)
+        finally:
+            os.chdir(olddir)
+            connection.creation.destroy_test_db(olddb, verbosity=0)
+            teardown_test_environment()
+
+        report = {
+            "commit": _git_commit(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "database": connection.vendor,
+            "parameters": {key: options[key] for key in
+                           ('users', 'degree', 'albums', 'photos', 'requests', 'seed')},
+            "dataset": {"users": len(data.userids), "albums": len(data.albumids), "photos": len(data.photoids),
+                        "seconds": round(generated, 1)},
+            # ru_maxrss is in KiB on linux
+            "max_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "results": results,
+        }
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        self.stdout.write("Wrote {}".format(output))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from ...constants import ORPHAN_MIN_AGE, REAPER_BATCH_SIZE
+from ...reaper import reap_files, sweep_orphans
+from ...uploadsessions import expire_sessions
+
+
+class Command(BaseCommand):
+    help = ("Delete the files of deleted photos and expired upload sessions, "
+            "and with --sweep any photo files that no photo uses")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sweep', action='store_true', help="also look for orphaned files on disk")
+        parser.add_argument('--dry-run', action='store_true', help="with --sweep, only list the orphaned files")
+        parser.add_argument('--min-age', type=int, default=ORPHAN_MIN_AGE,
+                            help="seconds a file must have been unused to be swept")
+        parser.add_argument('--batch-size', type=int, default=REAPER_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        if not options['dry_run']:
+            self.stdout.write("Expired {} upload sessions".format(expire_sessions()))
+        if options['sweep']:
+            orphans = sweep_orphans(min_age=options['min_age'], dry_run=options['dry_run'],
+                                    batch_size=options['batch_size'])
+            for path in orphans:
+                self.stdout.write(path)
+            self.stdout.write("Found {} orphaned files".format(len(orphans)))
+            if options['dry_run']:
+                return
+        deleted = reap_files(batch_size=options['batch_size'])
+        self.stdout.write("Deleted {} files".format(deleted))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from ...models import Profile
+from ...friendfeed import rebuild_feed
+
+
+class Command(BaseCommand):
+    help = "Rebuild the materialized home feed of every profile, migration 0027 fills it for existing photos"
+
+    def handle(self, *args, **options):
+        count = 0
+        for profile in Profile.objects.all().iterator():
+            rebuild_feed(profile)
+            count += 1
+        self.stdout.write("Rebuilt feeds for {} profiles".format(count))
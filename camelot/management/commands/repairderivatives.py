@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from ...constants import DERIVATIVE_MAX_ATTEMPTS, DERIVATIVE_RETRY_AGE
+from ...controllers.albumcontroller import retry_derivatives
+from ...jobqueue import SyncBackend
+from ...models import PhotoBlob
+
+
+class Command(BaseCommand):
+    help = ("Generate the thumbnail and mid size image of photos still processing because their job failed "
+            "or was lost, e.g. from a systemd timer")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age', type=int, default=DERIVATIVE_RETRY_AGE,
+                            help="seconds since an unfinished job was queued before it is tried again")
+        parser.add_argument('--max-attempts', type=int, default=DERIVATIVE_MAX_ATTEMPTS)
+
+    def handle(self, *args, **options):
+        # run in this process, so the jobs are done before the command exits
+        digests = retry_derivatives(min_age=options['min_age'], max_attempts=options['max_attempts'],
+                                    submit=SyncBackend().submit)
+        ready = PhotoBlob.objects.filter(sha256__in=digests, ready=True).count()
+        self.stdout.write("Generated derivatives for {} of {} files".format(ready, len(digests)))
+        abandoned = PhotoBlob.objects.filter(ready=False, attempts__gte=options['max_attempts']).count()
+        if abandoned:
+            self.stdout.write("Gave up on {} files after {} attempts".format(abandoned, options['max_attempts']))
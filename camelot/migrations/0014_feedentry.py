@@ -0,0 +1,27 @@
+# Generated by Django 4.2.4 on 2026-10-17 23:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('camelot', '0013_auto_20180728_0250'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeedEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pub_date', models.DateTimeField(verbose_name='date published')),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='feedentries', to='camelot.profile')),
+                ('photo', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='camelot.photo')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['owner', '-pub_date', '-photo'], name='camelot_fee_owner_i_40db7b_idx')],
+                'unique_together': {('owner', 'photo')},
+            },
+        ),
+    ]
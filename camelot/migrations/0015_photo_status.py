@@ -0,0 +1,18 @@
+# Generated by Django 4.2.4 on 2026-10-17 23:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('camelot', '0014_feedentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photo',
+            name='status',
+            field=models.IntegerField(default=2),
+        ),
+    ]
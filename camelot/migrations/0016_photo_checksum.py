@@ -0,0 +1,35 @@
+# Generated by Django 4.2.4 on 2026-10-17 23:40
+
+from django.db import migrations, models
+import hashlib
+
+
+def create_checksums(apps, schema_editor):
+    photos = apps.get_model('camelot', 'Photo')
+    for photo in photos.objects.all():
+        digest = hashlib.sha256()
+        try:
+            with open(photo.filename, 'rb') as rawpic:
+                for chunk in iter(lambda: rawpic.read(1024 * 1024), b''):
+                    digest.update(chunk)
+        except FileNotFoundError:
+            # photos without a file keep the weak etag
+            continue
+        photo.checksum = digest.hexdigest()
+        photo.save(update_fields=['checksum'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('camelot', '0015_photo_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photo',
+            name='checksum',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.RunPython(create_checksums, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.4 on 2026-10-17 23:46
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('camelot', '0016_photo_checksum'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='album',
+            name='cover',
+            field=models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='camelot.photo'),
+        ),
+    ]
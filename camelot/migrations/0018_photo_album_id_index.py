@@ -0,0 +1,17 @@
+# Generated by Django 4.2.4 on 2026-10-17 23:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('camelot', '0017_album_cover'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='photo',
+            index=models.Index(fields=['album', 'id'], name='camelot_pho_album_i_c1a374_idx'),
+        ),
+    ]
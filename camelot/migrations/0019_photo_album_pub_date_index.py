@@ -0,0 +1,17 @@
+# Generated by Django 4.2.4 on 2026-10-17 23:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('camelot', '0018_photo_album_id_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='photo',
+            index=models.Index(fields=['album', 'pub_date', 'id'], name='camelot_pho_album_i_0d957c_idx'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 4.2.4 on 2026-10-17 23:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_links(apps, schema_editor):
+    friendships = apps.get_model('camelot', 'Friendship')
+    friendlinks = apps.get_model('camelot', 'FriendLink')
+    links = []
+    for friendship in friendships.objects.all().iterator():
+        links.append(friendlinks(friendship=friendship, profile_id=friendship.requester_id,
+                                 friend_id=friendship.requestee_id, confirmed=friendship.confirmed))
+        links.append(friendlinks(friendship=friendship, profile_id=friendship.requestee_id,
+                                 friend_id=friendship.requester_id, confirmed=friendship.confirmed))
+    # a reversed duplicate friendship would collide here, keep the first one
+    friendlinks.objects.bulk_create(links, batch_size=500, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('camelot', '0019_photo_album_pub_date_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FriendLink',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('confirmed', models.BooleanField(default=False)),
+                ('friend', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='friendof', to='camelot.profile')),
+                ('friendship', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='links', to='camelot.friendship')),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='friendlinks', to='camelot.profile')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['profile', 'confirmed', 'friend'], name='camelot_fri_profile_3d975e_idx')],
+                'unique_together': {('profile', 'friend')},
+            },
+        ),
+        migrations.RunPython(create_links, migrations.RunPython.noop),
+    ]
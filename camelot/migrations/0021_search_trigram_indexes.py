@@ -0,0 +1,46 @@
+from django.db import migrations
+
+"""
+Trigram indexes for profile search, see camelot/usersearch.py
+Postgres only, other databases search with the in memory fallback
+"""
+
+FORWARD = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE EXTENSION IF NOT EXISTS unaccent",
+    # unaccent() is only stable, expression indexes need an immutable function
+    "CREATE OR REPLACE FUNCTION camelot_unaccent(text) RETURNS text AS "
+    "$$ SELECT public.unaccent('public.unaccent'::regdictionary, $1) $$ "
+    "LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT",
+    "CREATE INDEX IF NOT EXISTS camelot_profile_dname_trgm ON camelot_profile "
+    "USING gin (UPPER(camelot_unaccent(dname)) gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS camelot_user_username_trgm ON auth_user "
+    "USING gin (UPPER(camelot_unaccent(username)) gin_trgm_ops)",
+]
+
+BACKWARD = [
+    "DROP INDEX IF EXISTS camelot_user_username_trgm",
+    "DROP INDEX IF EXISTS camelot_profile_dname_trgm",
+    "DROP FUNCTION IF EXISTS camelot_unaccent(text)",
+]
+
+
+def _run(statements):
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor != 'postgresql':
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('camelot', '0020_friendlink'),
+    ]
+
+    operations = [
+        migrations.RunPython(_run(FORWARD), _run(BACKWARD)),
+    ]
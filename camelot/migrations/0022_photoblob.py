@@ -0,0 +1,22 @@
+# Generated by Django 4.2.4 on 2026-10-18 00:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('camelot', '0021_search_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PhotoBlob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('refcount', models.IntegerField(default=0)),
+                ('ready', models.BooleanField(default=False)),
+            ],
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.4 on 2026-10-18 00:39
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('camelot', '0022_photoblob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileTombstone',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(db_index=True, max_length=200)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
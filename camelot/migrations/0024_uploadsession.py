@@ -0,0 +1,27 @@
+# Generated by Django 4.2.4 on 2026-10-18 00:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('camelot', '0023_filetombstone'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=200)),
+                ('size', models.BigIntegerField()),
+                ('received', models.BigIntegerField(default=0)),
+                ('expires', models.DateTimeField(db_index=True)),
+                ('album', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='camelot.album')),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='camelot.profile')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.4 on 2026-10-18 01:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('camelot', '0024_uploadsession'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photo',
+            name='name',
+            field=models.CharField(blank=True, default='', max_length=200),
+        ),
+    ]
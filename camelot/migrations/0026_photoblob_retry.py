@@ -0,0 +1,29 @@
+# Generated by Django 4.2.4 on 2026-10-18 01:19
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('camelot', '0025_photo_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photoblob',
+            name='attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='photoblob',
+            name='failed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='photoblob',
+            name='queued',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
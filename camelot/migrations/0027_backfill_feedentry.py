@@ -0,0 +1,68 @@
+# Generated by Django 4.2.4 on 2026-10-18 10:12
+
+from django.db import migrations
+from django.db.models import Q
+from ..constants import ALBUM_PUBLIC, ALBUM_ALLFRIENDS, ALBUM_GROUPS
+
+# photos per bulk insert, each photo is one row per viewer
+BACKFILL_PHOTOS = 100
+
+
+def fill_feeds(apps, schema_editor):
+    """
+    Write the feed rows of every photo uploaded before the feed table existed
+    Same rules as friendfeed.refresh_album_feed(), with the historical models
+    """
+    albums = apps.get_model('camelot', 'Album')
+    photos = apps.get_model('camelot', 'Photo')
+    profiles = apps.get_model('camelot', 'Profile')
+    friendlinks = apps.get_model('camelot', 'FriendLink')
+    friendgroups = apps.get_model('camelot', 'FriendGroup')
+    feedentries = apps.get_model('camelot', 'FeedEntry')
+
+    for album in albums.objects.filter(photo__isnull=False).distinct().iterator():
+        viewers = profiles.objects.all()
+        if album.accesstype != ALBUM_PUBLIC:
+            contributorids = albums.contributors.through.objects.filter(album=album).values('profile')
+            allowed = Q(id=album.owner_id) | Q(id__in=contributorids)
+            if album.accesstype == ALBUM_ALLFRIENDS:
+                allowed |= Q(id__in=friendlinks.objects.filter(Q(profile=album.owner_id) | Q(profile__in=contributorids),
+                                                               confirmed=True).values('friend'))
+            elif album.accesstype == ALBUM_GROUPS:
+                allowed |= Q(id__in=friendgroups.members.through.objects.filter(friendgroup__albumgroup=album)
+                             .values('profile'))
+            viewers = viewers.filter(allowed)
+
+        uploaderids = photos.objects.filter(album=album, uploader__isnull=False)\
+            .order_by().values_list('uploader', flat=True).distinct()
+        for uploaderid in uploaderids:
+            audience = Q(id=uploaderid) | Q(id__in=friendlinks.objects.filter(profile=uploaderid, confirmed=True)
+                                                .values('friend'))
+            viewerids = list(viewers.filter(audience).values_list('id', flat=True))
+
+            uploads = photos.objects.filter(album=album, uploader=uploaderid).values_list('id', 'pub_date')
+            batch = []
+            for photoid, pub_date in uploads.iterator():
+                batch.append((photoid, pub_date))
+                if len(batch) == BACKFILL_PHOTOS:
+                    write_entries(feedentries, batch, viewerids)
+                    batch = []
+            write_entries(feedentries, batch, viewerids)
+
+
+def write_entries(feedentries, photos, viewerids):
+    # rows written by an earlier manage.py rebuildfeeds are left alone
+    feedentries.objects.bulk_create([feedentries(owner_id=viewerid, photo_id=photoid, pub_date=pub_date)
+                                     for photoid, pub_date in photos for viewerid in viewerids],
+                                    batch_size=500, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('camelot', '0026_photoblob_retry'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_feeds, migrations.RunPython.noop),
+    ]
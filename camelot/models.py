@@ -1,12 +1,16 @@
-from django.db import models
+from collections import Counter
+from django.db import models, transaction
+from django.db.models import F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import User
-from django.db.models.signals import post_delete
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
 from django.utils import timezone
-from os import unlink
+import os
+import uuid
 from .constants import *
 from .constants2 import *
-from .logs import log_exception
+from .photostorage import get_store
 
 """
 I want to add a unique constraint to User
@@ -21,6 +25,33 @@ We will need to do several things for work around this, and eventually we want t
 """
 
 
+class ProfileQuerySet(models.QuerySet):
+    def can_view(self, album):
+        """
+        Filter profiles down to the ones with permission to view album
+        This is the reverse of AlbumQuerySet.visible_to(), used to find who a new photo fans out to
+        :param album: album to check
+        :return: queryset of profiles
+        """
+        if album.accesstype == ALBUM_PUBLIC:
+            return self.all()
+
+        contributorids = Album.contributors.through.objects.filter(album=album).values('profile')
+        allowed = Q(id=album.owner_id) | Q(id__in=contributorids)
+
+        if album.accesstype == ALBUM_ALLFRIENDS:
+            # friends of the owner or of any contributor, from the FriendLink rows like visible_to()
+            friendids = FriendLink.objects.filter(Q(profile=album.owner_id) | Q(profile__in=contributorids),
+                                                  confirmed=True).values('friend')
+            allowed |= Q(id__in=friendids)
+
+        elif album.accesstype == ALBUM_GROUPS:
+            ingroup = FriendGroup.members.through.objects.filter(friendgroup__albumgroup=album).values('profile')
+            allowed |= Q(id__in=ingroup)
+
+        return self.filter(allowed)
+
+
 class Profile(models.Model):
     """
     one to one relationship with User
@@ -32,6 +63,8 @@ class Profile(models.Model):
     # display name
     dname = models.CharField(max_length=MAXDISPLAYNAME, default="")
 
+    objects = ProfileQuerySet.as_manager()
+
     def __str__(self):
         """
         This will now be how we manage the distinction between displayname and username
@@ -43,6 +76,18 @@ class Profile(models.Model):
             return self.dname
 
 
+class FriendshipQuerySet(models.QuerySet):
+    def friend_ids(self, profile, confirmed=True):
+        """
+        Profile ids of everyone on the other side of a friendship with profile
+        Answered from the FriendLink adjacency rows, a single index range scan
+        :param profile: profile to find friends of
+        :param confirmed: if False, return pending friendships instead
+        :return: queryset of profile ids, usable as a subquery
+        """
+        return FriendLink.objects.filter(profile=profile, confirmed=confirmed).values('friend')
+
+
 # investigate constraints
 # there should never be more than one of these for a given relationship
 # including requester and requestee reversed
@@ -59,10 +104,38 @@ class Friendship(models.Model):
     confirmed = models.BooleanField(default=False)
     #created = models.DateTimeField('friends since')
 
+    objects = FriendshipQuerySet.as_manager()
+
     def __str__(self):
         return str(self.requester) + "->" + str(self.requestee) + " : " + str(self.confirmed)
 
 
+class FriendLink(models.Model):
+    """
+    Symmetric adjacency for Friendship, two rows per friendship, one from each side
+    Maintained by the post_save receiver below, deleting the Friendship deletes its rows
+    Lookups by profile never need to look at both directions
+    """
+    class Meta:
+        unique_together = ('profile', 'friend')
+        indexes = [models.Index(fields=['profile', 'confirmed', 'friend'])]
+    friendship = models.ForeignKey(Friendship, on_delete=models.CASCADE, related_name='links')
+    profile = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name='friendlinks')
+    friend = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name='friendof')
+    confirmed = models.BooleanField(default=False)
+
+
+@receiver(post_save, sender=Friendship)
+def sync_friend_links(sender, instance, **kwargs):
+    """
+    Keep the FriendLink rows of a friendship in step with it
+    """
+    for profile, friend in ((instance.requester_id, instance.requestee_id),
+                            (instance.requestee_id, instance.requester_id)):
+        FriendLink.objects.update_or_create(profile_id=profile, friend_id=friend,
+                                            defaults={'friendship': instance, 'confirmed': instance.confirmed})
+
+
 class FriendGroup(models.Model):
     name = models.CharField(max_length=GROUPNAMELEN)
     owner = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name="groupowner")
@@ -73,6 +146,49 @@ class FriendGroup(models.Model):
         return str(self.name)
 
 
+class AlbumQuerySet(models.QuerySet):
+    def visible_to(self, profile):
+        """
+        Filter albums down to the ones that profile has permission to view
+        This is the set based version of albumcontroller.has_permission_to_view(),
+        the whole check runs as subqueries so the number of queries does not depend on
+        the number of albums, friends, or groups
+        :param profile: viewing profile, None if not logged in
+        :return: queryset of albums
+        """
+        visible = Q(accesstype=ALBUM_PUBLIC)
+        if profile is None:
+            return self.filter(visible)
+
+        contributors = Album.contributors.through.objects
+
+        # owner and contributors can always view
+        visible |= Q(owner=profile) | Q(id__in=contributors.filter(profile=profile).values('album'))
+
+        # all friends of the owner or any contributor
+        friendids = Friendship.objects.friend_ids(profile)
+        visible |= Q(accesstype=ALBUM_ALLFRIENDS) & (
+            Q(owner__in=friendids) | Q(id__in=contributors.filter(profile__in=friendids).values('album')))
+
+        # member of any group attached to the album
+        ingroup = Album.groups.through.objects.filter(friendgroup__members=profile).values('album')
+        visible |= Q(accesstype=ALBUM_GROUPS) & Q(id__in=ingroup)
+
+        return self.filter(visible)
+
+    def with_cover(self, rotate=False):
+        """
+        Annotate each album with cover_photo_id, the id of the photo to show for the album
+        An explicitly chosen cover wins, otherwise the newest photo, or a random one if rotate is set
+        The choice is a correlated subquery, so covers for any number of albums cost no extra queries
+        :param rotate: pick a random photo on every query instead of the newest
+        :return: queryset of albums
+        """
+        photos = Photo.objects.filter(album=OuterRef('pk'))
+        photos = photos.order_by('?') if rotate else photos.order_by('-pub_date', '-id')
+        return self.annotate(cover_photo_id=Coalesce('cover', Subquery(photos.values('id')[:1])))
+
+
 class Album(models.Model):
     name = models.CharField(max_length=MAX_ALBUM_NAME_LEN)
     description = models.CharField(max_length=300)
@@ -83,13 +199,25 @@ class Album(models.Model):
     accesstype = models.IntegerField(default=ALBUM_ALLFRIENDS)
     # we'll need to check that these are only groups owned by our contributors
     groups = models.ManyToManyField(FriendGroup, related_name="albumgroup")
+    # photo chosen by the owner to represent the album, see AlbumQuerySet.with_cover()
+    cover = models.ForeignKey('Photo', default=None, null=True, blank=True, on_delete=models.SET_NULL,
+                              related_name="+")
+
+    objects = AlbumQuerySet.as_manager()
 
     def __str__(self):
         return self.name
 
 
 class Photo(models.Model):
+    class Meta:
+        # neighbour lookups in albumcontroller.get_photo_neighbours() seek on (album, id),
+        # album pages from get_photos_page() on (album, pub_date, id)
+        indexes = [models.Index(fields=['album', 'id']), models.Index(fields=['album', 'pub_date', 'id'])]
+
     filename = models.CharField(max_length=200, default='')
+    # file name the photo was uploaded with, empty for photos from before it was recorded
+    name = models.CharField(max_length=200, default='', blank=True)
     thumb = models.CharField(max_length=200, null=False)
     midsize = models.CharField(max_length=200, null=False)
     description = models.CharField(max_length=MAXPHOTODESC)
@@ -102,27 +230,183 @@ class Photo(models.Model):
     # image mime type for full size image (mid and thumbs are png)
     imgtype = models.CharField(max_length=50, null=False)
     exiforientation = models.IntegerField(default=None, null=True, blank=True)
+    # PHOTO_PROCESSING until the thumbnail and mid size images have been generated
+    status = models.IntegerField(default=PHOTO_READY)
+    # sha256 of the original file, used as a strong etag
+    checksum = models.CharField(max_length=64, default='', blank=True)
+
+
+class PhotoBlobQuerySet(models.QuerySet):
+    def acquire(self, digests):
+        """
+        Add references to the stored files with these hashes, creating rows for new ones
+        The rows stay locked until the transaction ends, so the files can't be released meanwhile
+        :param digests: list of hex sha256 of the originals, once per reference
+        :return: dict of hash to blob, refcount includes the new references
+        """
+        counts = Counter(digests)
+        blobs = {}
+        # a row deleted by a concurrent release() is only missing once that commits, create it again
+        while len(blobs) < len(counts):
+            missing = sorted(set(counts) - set(blobs))
+            self.bulk_create([PhotoBlob(sha256=digest) for digest in missing], ignore_conflicts=True)
+            # locked in hash order so that concurrent uploads can't deadlock
+            blobs.update((blob.sha256, blob) for blob in
+                         self.select_for_update().filter(sha256__in=missing).order_by('sha256'))
+        for digest, blob in blobs.items():
+            blob.refcount += counts[digest]
+        self.bulk_update(list(blobs.values()), ['refcount'])
+        return blobs
+
+    def release(self, digests):
+        """
+        Drop references to the stored files with these hashes, a row is deleted with its last reference
+        :param digests: list of hex sha256 of the originals, once per reference
+        :return: set of the hashes that lost their last reference, their files should be deleted
+        """
+        counts = Counter(digests)
+        if not counts:
+            return set()
+        with transaction.atomic():
+            # locked in hash order, like acquire()
+            blobs = list(self.select_for_update().filter(sha256__in=list(counts)).order_by('sha256'))
+            released = {blob.sha256 for blob in blobs if blob.refcount <= counts[blob.sha256]}
+            kept = [blob for blob in blobs if blob.sha256 not in released]
+            for blob in kept:
+                blob.refcount -= counts[blob.sha256]
+            self.bulk_update(kept, ['refcount'])
+            self.filter(sha256__in=released).delete()
+        return released
+
+
+class PhotoBlob(models.Model):
+    """
+    An original in the content addressed photo store and its derivatives, see photostorage.py
+    Shared by every Photo with the same checksum and a filename in the store
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    # number of photos using the files
+    refcount = models.IntegerField(default=0)
+    # the thumbnail and mid size image have been generated
+    ready = models.BooleanField(default=False)
+    # the last attempt at generating them failed, see albumcontroller.retry_derivatives()
+    failed = models.BooleanField(default=False)
+    # when they were last queued, and how many times
+    queued = models.DateTimeField(default=timezone.now)
+    attempts = models.IntegerField(default=0)
+
+    objects = PhotoBlobQuerySet.as_manager()
+
+
+class FileTombstone(models.Model):
+    """
+    A file to delete, written in the transaction that deletes its photo
+    reaper.py deletes the file and then the row, so deleting photos never waits on the disk
+    """
+    path = models.CharField(max_length=200, db_index=True)
+    created = models.DateTimeField(default=timezone.now)
+
+
+class UploadSession(models.Model):
+    """
+    A resumable upload, the data received so far is kept in a part file on the data partition
+    See uploadsessions.py, the part file is handed to the reaper when the session is deleted
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(Profile, on_delete=models.CASCADE)
+    album = models.ForeignKey(Album, on_delete=models.CASCADE)
+    # file name given by the client
+    name = models.CharField(max_length=200)
+    # announced size of the whole file and bytes received so far
+    size = models.BigIntegerField()
+    received = models.BigIntegerField(default=0)
+    # pushed back by every chunk
+    expires = models.DateTimeField(db_index=True)
+
+    @property
+    def path(self):
+        return "{}/{}.part".format(UPLOAD_SESSION_DIR, self.id.hex)
+
+
+class FeedEntry(models.Model):
+    """
+    Materialized home feed, one row for each photo a profile should see in their feed
+    Maintained on write by the functions in friendfeed.py so reading the feed is a single index scan
+    """
+    class Meta:
+        unique_together = ('owner', 'photo')
+        indexes = [models.Index(fields=['owner', '-pub_date', '-photo'])]
+    owner = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name="feedentries")
+    photo = models.ForeignKey(Photo, on_delete=models.CASCADE)
+    # copy of photo.pub_date so that the feed can be ordered without a join
+    pub_date = models.DateTimeField('date published')
+
+
+def release_photo_files(files):
+    """
+    Record the files of deleted photos as tombstones, the reaper removes them after commit
+    Files in the photo store are shared, they are only deleted with the last photo using them
+    :param files: iterable of (filename, thumb, midsize) of the photos
+    :return: None
+    """
+    # reaper.py imports the models
+    from .reaper import schedule_reap_on_commit
+
+    store = get_store()
+    paths = []
+    digests = []
+    for filename, thumb, midsize in files:
+        digest = store.digest_of(filename)
+        if digest is None:
+            # photos from before the photo store have files of their own
+            paths += [filename, thumb, midsize]
+        else:
+            digests.append(digest)
+    for digest in PhotoBlob.objects.release(digests):
+        paths += store.paths(digest)
+
+    paths = [path for path in paths if path]
+    if paths:
+        FileTombstone.objects.bulk_create([FileTombstone(path=path) for path in paths])
+        schedule_reap_on_commit()
+
+
+@receiver(pre_delete, sender=Album)
+def delete_album_files(sender, instance, *args, origin=None, **kwargs):
+    """
+    Release the files of every photo of an album being deleted, in one go
+    Only for an album deleted by itself, when it goes with its owner each photo is handled by delete_photo_file()
+    """
+    if origin is instance:
+        release_photo_files(Photo.objects.filter(album=instance).values_list('filename', 'thumb', 'midsize'))
 
 
 @receiver(post_delete, sender=Photo)
-def delete_photo_file(sender, instance, *args, **kwargs):
+def delete_photo_file(sender, instance, *args, origin=None, **kwargs):
     """
-    Receiver to delete the file on disk when we delete a photo from database.
+    Receiver to delete the files on disk when we delete a photo from database.
+    The paths are recorded as tombstones in the deleting transaction, see release_photo_files()
     :param sender:
     :param instance:
     :param args:
+    :param origin: what delete() was called on
     :param kwargs:
     :return:
     """
-    try:
-        unlink(instance.filename)
-    except FileNotFoundError as e:
-        log_exception(__name__, e)
-    try:
-        unlink(instance.thumb)
-    except FileNotFoundError as e:
-        log_exception(__name__, e)
-    try:
-        unlink(instance.midsize)
-    except FileNotFoundError as e:
-        log_exception(__name__, e)
+    if isinstance(origin, Album):
+        # already released by delete_album_files()
+        return
+    release_photo_files([(instance.filename, instance.thumb, instance.midsize)])
+
+
+@receiver(post_delete, sender=UploadSession)
+def delete_upload_session_file(sender, instance, *args, **kwargs):
+    """
+    Hand the part file of a finished, aborted or expired upload to the reaper
+    Finished uploads usually have had their file moved into the photo store already
+    """
+    from .reaper import schedule_reap_on_commit
+
+    if os.path.exists(instance.path):
+        FileTombstone.objects.create(path=instance.path)
+        schedule_reap_on_commit()
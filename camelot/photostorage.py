@@ -0,0 +1,148 @@
+from django.conf import settings
+from os import makedirs, fsync, replace, chmod, unlink
+import hashlib
+import os
+import re
+import tempfile
+from .constants import PHOTO_STORE_DIR, PHOTO_STORE_FANOUT, UPLOAD_CHUNK_SIZE, UPLOAD_TEMP_DIR
+
+"""
+Content addressed storage for photo files
+
+An original is stored once under the sha256 of its contents, however many albums it was uploaded to,
+and its thumbnail and mid size image are stored next to it, so they are generated once too.
+Files are sharded into directories by the leading hex digits of the hash, e.g. with a fan out of 2:
+    userphotos/store/ab/cd/abcd...ef
+    userphotos/store/ab/cd/abcd...ef.thumb.jpg
+    userphotos/store/ab/cd/abcd...ef.mid.jpg
+Photo.filename, thumb and midsize hold these paths, so views and file delivery are unchanged.
+The models.PhotoBlob row of a hash counts the photos using it, the files are handed to the reaper
+with the last one, see reaper.py.
+Photos uploaded before this store keep their old per user paths.
+
+Backends, chosen with settings.PHOTO_STORAGE_BACKEND:
+ - "local": files on the data partition below PHOTO_STORE_DIR (default)
+"""
+
+STORAGE_LOCAL = "local"
+
+# derivative name to file suffix
+VARIANTS = {"thumb": ".thumb.jpg", "mid": ".mid.jpg"}
+
+_DIGEST = re.compile(r'^[0-9a-f]{64}$')
+
+
+class LocalContentStore:
+    def __init__(self, root, fanout):
+        """
+        :param root: directory of the store
+        :param fanout: number of directory levels, each named by two hex digits of the hash
+        """
+        self.root = root
+        self.fanout = fanout
+
+    def path(self, digest, variant=None):
+        """
+        :param digest: hex sha256 of the original
+        :param variant: None for the original, or a key of VARIANTS
+        :return: path of the file
+        """
+        shards = [digest[2 * i:2 * i + 2] for i in range(self.fanout)]
+        return "/".join([self.root] + shards + [digest + VARIANTS.get(variant, "")])
+
+    def digest_of(self, path):
+        """
+        Inverse of path()
+        :param path: path of an original or derivative
+        :return: hex sha256, or None if the path is not in this store
+        """
+        if not path.startswith(self.root + "/"):
+            return None
+        digest = os.path.basename(path).split(".")[0]
+        if not _DIGEST.match(digest):
+            return None
+        return digest if path in self.paths(digest) else None
+
+    def spool(self, fi):
+        """
+        Get the contents of an uploaded file onto the data partition, hashing them on the way
+        Uploads streamed to disk by uploadhandlers.StreamingImageUploadHandler are used where they are
+        :param fi: file object
+        :return: tuple of (path of a file holding the contents, hex sha256, True if the file is ours to delete)
+        """
+        if hasattr(fi, 'temporary_file_path'):
+            # our upload handler hashes the file as it arrives
+            path = fi.temporary_file_path()
+            return path, getattr(fi, 'sha256', None) or file_checksum(path), False
+
+        makedirs(UPLOAD_TEMP_DIR, exist_ok=True)
+        fi.seek(0)
+        digest = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(suffix=".upload", dir=UPLOAD_TEMP_DIR, delete=False) as destination:
+            for chunk in iter(lambda: fi.read(UPLOAD_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                destination.write(chunk)
+            # the original must be on disk before we report success, derivatives can be regenerated from it
+            destination.flush()
+            fsync(destination.fileno())
+        return destination.name, digest.hexdigest(), True
+
+    def put(self, src, digest, owned):
+        """
+        Move a spooled file into the store, unless the same contents are already stored
+        Call with the PhotoBlob row of digest locked and its tombstones deleted, so that the files
+        can't be deleted meanwhile
+        :param src: path from spool()
+        :param digest: hex sha256 of src
+        :param owned: delete src if it is not needed
+        :return: True if the file was stored, False if it was a duplicate
+        """
+        dest = self.path(digest)
+        if os.path.isfile(dest):
+            if owned:
+                unlink(src)
+            # the orphan sweep leaves recently used files alone
+            os.utime(dest)
+            return False
+        makedirs(os.path.dirname(dest), exist_ok=True)
+        replace(src, dest)
+        chmod(dest, 0o644)
+        return True
+
+    def paths(self, digest):
+        """
+        :param digest: hex sha256 of the original
+        :return: list of the paths of an original and its derivatives
+        """
+        return [self.path(digest, variant) for variant in [None] + list(VARIANTS)]
+
+
+def file_checksum(path):
+    """
+    Hash a stored file without reading it into memory at once
+    :param path: path of the file
+    :return: hex sha256 of the file contents
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+_store = None
+
+
+def get_store():
+    """
+    Return the photo store configured in settings, created once per process
+    :return: store object
+    """
+    global _store
+    if _store is None:
+        name = getattr(settings, 'PHOTO_STORAGE_BACKEND', STORAGE_LOCAL)
+        if name == STORAGE_LOCAL:
+            _store = LocalContentStore(PHOTO_STORE_DIR, PHOTO_STORE_FANOUT)
+        else:
+            raise ValueError("Unknown photo storage backend {}".format(name))
+    return _store
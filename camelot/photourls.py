@@ -0,0 +1,56 @@
+from django.core import signing
+from django.shortcuts import reverse
+import time
+from .constants import PHOTO_READY, SIGNED_PHOTO_URL_LIFETIME, SIGNED_PHOTO_URL_BUCKET
+from .controllers.utilities import PermissionException
+
+"""
+Signed urls for thumbnails and mid size images
+
+Derivatives never change once generated, so a view that has already checked the viewer may see an album
+hands out urls signed with SECRET_KEY that grant access to one rendition until they expire.
+Serving a signed url needs no permission check and the response can be cached by the browser.
+The url carries the photo checksum, so it names exactly one file.
+"""
+
+SIGNED_VARIANTS = {"thumb": "show_thumb", "mid": "show_photo"}
+
+_signer = signing.Signer(salt="camelot.photourls")
+
+
+def sign_photo_url(photo, variant, now=None):
+    """
+    Mint a url for a photo rendition, the caller must have checked that the viewer may see the photo
+    Photos still being processed get the regular url, what we serve for them changes once the derivatives exist
+    :param photo: photo object
+    :param variant: "thumb" or "mid"
+    :param now: current timestamp, for tests
+    :return: url
+    """
+    if photo.status != PHOTO_READY or not photo.checksum:
+        return reverse(SIGNED_VARIANTS[variant], kwargs={'photoid': photo.id})
+
+    now = time.time() if now is None else now
+    # every url minted within the same bucket is identical, so the browser cache keeps hitting
+    expires = (int(now) // SIGNED_PHOTO_URL_BUCKET + 1) * SIGNED_PHOTO_URL_BUCKET + SIGNED_PHOTO_URL_LIFETIME
+    token = _signer.sign("{}.{}.{}.{}".format(photo.id, variant, photo.checksum[:16], expires))
+    return reverse("show_signed_photo", kwargs={'token': token})
+
+
+def unsign_photo_token(token, now=None):
+    """
+    Check a signed photo url token
+    :param token: token from the url
+    :param now: current timestamp, for tests
+    :return: (photo id, variant, checksum prefix, expiry timestamp)
+    """
+    try:
+        photoid, variant, checksum, expires = _signer.unsign(token).split(".")
+    except (signing.BadSignature, ValueError):
+        raise PermissionException("Invalid photo url")
+
+    now = time.time() if now is None else now
+    if int(expires) <= now or variant not in SIGNED_VARIANTS:
+        raise PermissionException("Expired photo url")
+
+    return int(photoid), variant, checksum, int(expires)
@@ -0,0 +1,273 @@
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+import logging
+import os
+import re
+import threading
+import time
+from .constants import ORPHAN_MIN_AGE, PREFIX, REAPER_BATCH_SIZE, UPLOAD_SESSION_DIR, UPLOAD_TEMP_DIR
+from .models import FileTombstone, Photo, PhotoBlob, UploadSession
+from .photostorage import get_store
+
+"""
+Background deletion of photo files
+
+Deleting a photo only records its files as FileTombstone rows, in the same transaction, see
+models.release_photo_files. After commit reap_files() deletes them in batches, a transaction per batch,
+and removes the directories of pre photo store uploads once they are empty.
+The tombstone rows stay locked while their files are deleted, an upload bringing back the same contents
+deletes the tombstones first, so it either waits for the batch or the files are never deleted.
+
+When the reaper runs, chosen with settings.FILE_REAPER:
+ - "sync": right after the deleting transaction commits, in the same request (default, used by the tests)
+ - "thread": in a background thread of the web process, the request returns as soon as it commits
+ - "command": only when manage.py reapfiles is run, e.g. from a systemd timer
+
+sweep_orphans() reconciles the disk against the database, files no photo uses are tombstoned and reaped.
+"""
+
+REAPER_SYNC = "sync"
+REAPER_THREAD = "thread"
+REAPER_COMMAND = "command"
+
+log = logging.getLogger(__name__)
+
+_HEX_ID = re.compile(r'^[0-9a-f]{32}$')
+
+# trees of the per user paths used before the photo store, userphotos/<user>/<album>/<photo>
+LEGACY_ROOTS = [PREFIX + "userphotos", PREFIX + "thumbs", PREFIX + "mid"]
+
+
+def reap_files(batch_size=REAPER_BATCH_SIZE):
+    """
+    Delete the file of every tombstone, then the tombstone
+    Files already gone count as deleted, files that can't be deleted keep their tombstone for the next run
+    :param batch_size: tombstones per transaction
+    :return: number of files deleted
+    """
+    deleted = 0
+    lastid = 0
+    while True:
+        dirs = set()
+        with transaction.atomic():
+            # other reapers skip the locked rows instead of waiting for them
+            batch = list(FileTombstone.objects.select_for_update(skip_locked=True).filter(id__gt=lastid)
+                         .order_by('id')[:batch_size])
+            if not batch:
+                return deleted
+            lastid = batch[-1].id
+
+            done = []
+            missing = 0
+            for tombstone in batch:
+                try:
+                    os.unlink(tombstone.path)
+                    deleted += 1
+                except FileNotFoundError:
+                    missing += 1
+                except OSError:
+                    log.exception("could not delete %s", tombstone.path)
+                    continue
+                done.append(tombstone.id)
+                dirs.add(os.path.dirname(tombstone.path))
+            FileTombstone.objects.filter(id__in=done).delete()
+
+        if missing:
+            log.info("%s of %s files to delete were already gone", missing, len(batch))
+        remove_empty_dirs(dirs)
+
+
+def remove_empty_dirs(dirs):
+    """
+    Remove directories of pre photo store uploads left empty, and their parents up to the top of the tree
+    The shard directories of the photo store are kept, they are reused
+    :param dirs: directories that files were deleted from
+    :return: None
+    """
+    # deepest first, so a user directory is looked at after its album directories
+    for path in sorted(dirs, key=len, reverse=True):
+        while _is_legacy_dir(path):
+            try:
+                with os.scandir(path) as entries:
+                    if any(True for _ in entries):
+                        break
+                os.rmdir(path)
+            except OSError:
+                # gone already, or something was added meanwhile
+                break
+            path = os.path.dirname(path)
+
+
+def _is_legacy_dir(path):
+    store = get_store()
+    for root in LEGACY_ROOTS:
+        if path.startswith(root + "/") and not path.startswith((store.root, UPLOAD_TEMP_DIR, UPLOAD_SESSION_DIR)):
+            return True
+    return False
+
+
+def _files_at_depth(top, depth, cutoff):
+    """
+    Walk a tree with os.scandir, yielding the files exactly depth directories below top
+    :param cutoff: only files last modified before this timestamp
+    """
+    try:
+        entries = list(os.scandir(top))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if depth and entry.is_dir(follow_symlinks=False):
+            yield from _files_at_depth(entry.path, depth - 1, cutoff)
+        elif not depth and entry.is_file(follow_symlinks=False) and entry.stat().st_mtime < cutoff:
+            yield entry.path
+
+
+def _stored_files(cutoff):
+    """
+    Every photo file on disk old enough to be swept, grouped by kind
+    :return: generator of (kind, path), kind is "store", "legacy", "upload" or "session"
+    """
+    store = get_store()
+    for path in _files_at_depth(store.root, store.fanout, cutoff):
+        yield "store", path
+    for root in LEGACY_ROOTS:
+        # only numbered user and album directories, the default profile picture lives in userphotos too
+        for path in _files_at_depth(root, 2, cutoff):
+            user, album = path[len(root) + 1:].split("/")[:2]
+            if user.isdigit() and album.isdigit():
+                yield "legacy", path
+    for path in _files_at_depth(UPLOAD_TEMP_DIR, 0, cutoff):
+        yield "upload", path
+    for path in _files_at_depth(UPLOAD_SESSION_DIR, 0, cutoff):
+        yield "session", path
+
+
+def _unreferenced(kind, paths):
+    """
+    :param kind: kind of the paths, see _stored_files()
+    :param paths: list of paths of one kind
+    :return: the paths that no photo uses
+    """
+    if kind == "upload":
+        # spooled uploads are moved into place within seconds
+        return paths
+    if kind == "session":
+        # part files are named by the id of their resumable upload session
+        ids = {path: os.path.basename(path).split(".")[0] for path in paths}
+        used = {sessionid.hex for sessionid in UploadSession.objects.filter(
+            id__in=[sessionid for sessionid in ids.values() if _HEX_ID.match(sessionid)]).values_list('id', flat=True)}
+        return [path for path in paths if ids[path] not in used]
+    if kind == "store":
+        store = get_store()
+        digests = {path: store.digest_of(path) for path in paths}
+        used = set(PhotoBlob.objects.filter(sha256__in=set(digests.values()) - {None})
+                   .values_list('sha256', flat=True))
+        return [path for path in paths if digests[path] not in used]
+    used = set()
+    for files in Photo.objects.filter(Q(filename__in=paths) | Q(thumb__in=paths) | Q(midsize__in=paths))\
+            .values_list('filename', 'thumb', 'midsize'):
+        used.update(files)
+    return [path for path in paths if path not in used]
+
+
+def sweep_orphans(min_age=ORPHAN_MIN_AGE, dry_run=False, batch_size=REAPER_BATCH_SIZE):
+    """
+    Find photo files on disk that no photo uses, left behind by crashes or by deletes from before the reaper,
+    and tombstone them
+    :param min_age: seconds since a file was last modified or reused, newer files may belong to an upload in progress
+    :param dry_run: only report the orphans
+    :param batch_size: paths looked up per query
+    :return: list of orphaned paths
+    """
+    cutoff = time.time() - min_age
+    orphans = []
+    batches = {}
+    for kind, path in _stored_files(cutoff):
+        batch = batches.setdefault(kind, [])
+        batch.append(path)
+        if len(batch) == batch_size:
+            orphans += _unreferenced(kind, batch)
+            batches[kind] = []
+    for kind, batch in batches.items():
+        if batch:
+            orphans += _unreferenced(kind, batch)
+
+    if not dry_run:
+        for i in range(0, len(orphans), batch_size):
+            batch = orphans[i:i + batch_size]
+            queued = set(FileTombstone.objects.filter(path__in=batch).values_list('path', flat=True))
+            FileTombstone.objects.bulk_create([FileTombstone(path=path) for path in batch if path not in queued])
+    return orphans
+
+
+class ReaperThread(threading.Thread):
+    """
+    Reap whenever woken up, one per web process
+    """
+    def __init__(self):
+        super().__init__(name="camelot-reaper", daemon=True)
+        self.wanted = threading.Event()
+
+    def run(self):
+        while True:
+            self.wanted.wait()
+            self.wanted.clear()
+            try:
+                reap_files()
+            except Exception:
+                log.exception("file reaper failed")
+            finally:
+                # the thread has its own database connection
+                connection.close()
+
+
+_thread = None
+_thread_lock = threading.Lock()
+
+
+class _ReapOnCommit:
+    """
+    on_commit callback running schedule_reap(), remembers whether it has run
+    """
+    def __init__(self):
+        self.done = False
+
+    def __call__(self):
+        self.done = True
+        schedule_reap()
+
+
+def schedule_reap_on_commit():
+    """
+    Run schedule_reap() once the current transaction commits
+    However many photos the transaction deletes, the reaper is only scheduled once
+    :return: None
+    """
+    conn = transaction.get_connection()
+    pending = getattr(conn, 'camelot_pending_reap', None)
+    # callbacks of a rolled back savepoint are dropped from run_on_commit, those must be registered again
+    if pending is not None and not pending.done and any(entry[1] is pending for entry in conn.run_on_commit):
+        return
+    conn.camelot_pending_reap = _ReapOnCommit()
+    transaction.on_commit(conn.camelot_pending_reap)
+
+
+def schedule_reap():
+    """
+    Run the reaper as configured by settings.FILE_REAPER, called once the deleting transaction has committed
+    :return: None
+    """
+    global _thread
+    mode = getattr(settings, 'FILE_REAPER', REAPER_SYNC)
+    if mode == REAPER_SYNC:
+        reap_files()
+    elif mode == REAPER_THREAD:
+        with _thread_lock:
+            # started lazily so that every gunicorn worker gets its own after forking
+            if _thread is None:
+                _thread = ReaperThread()
+                _thread.start()
+        _thread.wanted.set()
+    elif mode != REAPER_COMMAND:
+        raise ValueError("Unknown file reaper {}".format(mode))
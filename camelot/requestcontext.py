@@ -0,0 +1,118 @@
+from contextvars import ContextVar
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from .friendgraph import FriendGraph
+from .models import Album, Photo, Profile
+
+"""
+Request scoped identity map
+
+RequestContextMiddleware gives every request a RequestContext. Within it each Profile, Album and Photo
+is fetched from the database at most once by id, and every controller and form in the request shares
+the same instances and the same FriendGraph.
+Outside of a request (management commands, the job queue, tests using RequestFactory) there is no
+context and every lookup goes to the database as before.
+"""
+
+_current = ContextVar('camelot_request_context', default=None)
+
+
+class RequestContext:
+    def __init__(self):
+        self.instances = {}
+        self.friendgraph = FriendGraph()
+
+    def get(self, model, id, load):
+        """
+        Return the instance of model with the given id, loading it on first use
+        Failed lookups are not remembered
+        :param model: model class, the key of the map together with id
+        :param id: primary key
+        :param load: callable returning the instance, may raise model.DoesNotExist
+        :return: model instance
+        """
+        key = (model, int(id))
+        if key not in self.instances:
+            self.instances[key] = load()
+        return self.instances[key]
+
+    def forget(self, model, id):
+        self.instances.pop((model, id), None)
+
+
+def current_context():
+    """
+    :return: the RequestContext of the current request, or None outside of a request
+    """
+    return _current.get()
+
+
+def _cached(model, id, load):
+    context = _current.get()
+    if context is None:
+        return load()
+    return context.get(model, id, load)
+
+
+def get_profile(uid):
+    """
+    The profile of a user, loaded together with the user in one query
+    :param uid: user id
+    :return: profile, raises Profile.DoesNotExist
+    """
+    # profiles are keyed by user id, that is what the views and controllers pass around
+    return _cached(Profile, uid, lambda: Profile.objects.select_related('user').get(user_id=uid))
+
+
+def get_album(id):
+    """
+    :param id: album id
+    :return: album, raises Album.DoesNotExist
+    """
+    return _cached(Album, id, lambda: Album.objects.get(id=id))
+
+
+def get_photo(id):
+    """
+    :param id: photo id
+    :return: photo, raises Photo.DoesNotExist
+    """
+    return _cached(Photo, id, lambda: Photo.objects.get(id=id))
+
+
+def request_friendgraph():
+    """
+    :return: the FriendGraph shared by the current request, or a new one outside of a request
+    """
+    context = _current.get()
+    if context is None:
+        return FriendGraph()
+    return context.friendgraph
+
+
+@receiver(post_delete, sender=Album)
+@receiver(post_delete, sender=Photo)
+@receiver(post_delete, sender=Profile)
+def forget_deleted(sender, instance, **kwargs):
+    """
+    Deleted rows must not be handed out again later in the same request
+    """
+    context = _current.get()
+    if context is not None:
+        key = instance.user_id if sender is Profile else instance.id
+        context.forget(sender, key)
+
+
+class RequestContextMiddleware:
+    """
+    Give each request its own RequestContext
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = _current.set(RequestContext())
+        try:
+            return self.get_response(request)
+        finally:
+            _current.reset(token)
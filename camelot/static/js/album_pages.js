@@ -0,0 +1,44 @@
+// load further pages of an album as the user scrolls to the end of the gallery
+$(document).ready(function(){
+
+    var loadmore = document.getElementById('loadmore');
+    if (!loadmore) {
+        return;
+    }
+
+    var loading = false;
+
+    function loadNextPage() {
+        var cursor = loadmore.dataset.next;
+        if (loading || !cursor) {
+            return;
+        }
+        loading = true;
+
+        $.ajax({
+            url: window.location.pathname,
+            data: {'after': cursor},
+            success: function(html, status, xhr) {
+                $('#albumphotos').append(html);
+                loadmore.dataset.next = xhr.getResponseHeader('X-Next-Cursor') || '';
+                if (!loadmore.dataset.next) {
+                    observer.disconnect();
+                }
+            },
+            error: function(xhr) {
+                console.log('failed to load photos: ' + xhr.status);
+            },
+            complete: function() {
+                loading = false;
+            }
+        });
+    }
+
+    var observer = new IntersectionObserver(function(entries) {
+        if (entries[0].isIntersecting) {
+            loadNextPage();
+        }
+    }, {rootMargin: '400px'});
+    observer.observe(loadmore);
+
+});
@@ -1,7 +1,8 @@
 $(document).ready(function(){
 
     // todo: currently multiple inputs can be opened at once, desired behavior?
-    $('.edit-desc').click(promptForDesc);
+    // delegated, so photos appended by album_pages.js are editable too
+    $(document).on('click', '.edit-desc', promptForDesc);
 
 });
 
@@ -57,7 +58,6 @@ function promptForDesc() {
 
 function createSpanRestore(t) {
     var spanRestore = $("<span class='edit-desc'></span>");
-    spanRestore.click(promptForDesc);
     spanRestore.text(t);
     return spanRestore;
 }
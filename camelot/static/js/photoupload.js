@@ -1,3 +1,9 @@
+// photos are sent in batches to the batch upload api, a few batches at a time
+// keep BATCH_FILES at or below UPLOAD_BATCH_MAX_FILES in constants.py
+var BATCH_FILES = 10;
+var BATCH_BYTES = 50 * 1024 * 1024;
+var CONCURRENT_BATCHES = 3;
+
 $(document).ready(function(){
 
     // submit photos via API calls
@@ -18,28 +24,67 @@ $(document).ready(function(){
         mySpan.innerHTML = "Uploading...";
         myAnchor.parentNode.replaceChild(mySpan, myAnchor);
 
-        // upload photos
-        var set_of_promises = Array();
-        photofiles.forEach(function (file) {
-            console.log("uploading " + String(file));
-    	    set_of_promises.push(uploadPhoto(file, csrftoken, albumid));
-        });
+        var batches = makeBatches(photofiles);
+        var uploaded = 0;
+        var failures = [];
+
+        function progress(result) {
+            uploaded += result.photos.length;
+            result.rejected.forEach(function (file) {
+                failures.push(file.name + ": " + file.error);
+            });
+            mySpan.innerHTML = "Uploading... " + uploaded + " of " + photofiles.length;
+        }
+
+        // each worker sends one batch at a time until none are left
+        function worker() {
+            var batch = batches.shift();
+            if (batch === undefined) {
+                return Promise.resolve();
+            }
+            return uploadBatch(batch, csrftoken, albumid).then(progress, function (reason) {
+                batch.forEach(function (file) {
+                    failures.push(file.name + ": " + reason);
+                });
+            }).then(worker);
+        }
+
+        var workers = Array();
+        for (var i = 0; i < CONCURRENT_BATCHES; i++) {
+            workers.push(worker());
+        }
 
         // wait for all uploads to complete
-        Promise.all(set_of_promises).then(function(values) {
-            // all AJAX requests are successfully finished
-            // "values" is array containing AJAX responses of all requests
+        Promise.all(workers).then(function() {
             console.log("all uploads have finished");
-            window.location.href = '/album/' + albumid + '/';
-        }).catch(function(reason) {
-            // one of the AJAX calls failed
-            console.log("A photo failed to upload");
-            alert(reason);
+            if (failures.length > 0) {
+                alert("Some photos failed to upload:\n" + failures.join("\n"));
+            }
             window.location.href = '/album/' + albumid + '/';
         });
     });
 });
 
+// split files into batches of at most BATCH_FILES files and, unless a single file is larger, BATCH_BYTES bytes
+function makeBatches(files) {
+    var batches = Array();
+    var batch = Array();
+    var bytes = 0;
+    files.forEach(function (file) {
+        if (batch.length > 0 && (batch.length === BATCH_FILES || bytes + file.size > BATCH_BYTES)) {
+            batches.push(batch);
+            batch = Array();
+            bytes = 0;
+        }
+        batch.push(file);
+        bytes += file.size;
+    });
+    if (batch.length > 0) {
+        batches.push(batch);
+    }
+    return batches;
+}
+
 // probably wont use this but keeping for now
 function DuplicateIn() {
 
@@ -54,27 +99,30 @@ function DuplicateIn() {
     alert('One or Two fields are empty. Please fill up all fields');
 }
 
-function uploadPhoto(file, token, album_id) {
+function uploadBatch(files, token, album_id) {
     return new Promise(function(resolve, reject) {
         var formData = new FormData();
         var xhr = new XMLHttpRequest();
 
         xhr.onreadystatechange = function() {
                 if (xhr.readyState === 4) {
-                    if (xhr.status === 201) {
-                        console.log('successful photo upload');
-                        resolve('successful photo upload');
+                    // 400 is returned when every file of the batch was rejected, with the reasons
+                    if (xhr.status === 201 || (xhr.status === 400 && xhr.responseText.indexOf('"rejected"') !== -1)) {
+                        console.log('uploaded batch of ' + files.length);
+                        resolve(JSON.parse(xhr.responseText));
                     } else {
-                        console.log('failed to upload photo');
+                        console.log('failed to upload batch');
                         console.log(xhr.status);
                         console.log(xhr.responseText);
-                        reject('A photo failed to upload: ' + xhr.status);
+                        reject('upload failed with status ' + xhr.status);
                     }
                 }
             }
 
-        formData.set('image', file);
-        xhr.open("POST", '/api/upload/' + album_id);
+        files.forEach(function (file) {
+            formData.append('images', file);
+        });
+        xhr.open("POST", '/api/upload/' + album_id + '/batch');
         xhr.setRequestHeader("X-CSRFToken", token);
         xhr.send(formData);
     });
@@ -1,20 +1,13 @@
 from datetime import datetime
 
-class photomock:
-    def __init__(self, uploader, album, pub_date):
-        self.uploader = uploader
-        self.pub_date = pub_date
-        self.album = album
-
 class profilecontrolmock:
-    def get_feed(self):
-        feed = [
-            photomock("testuser1", "testalbum1", datetime(2012, 9, 16)),
-            photomock("testuser1", "testalbum1", datetime(2012, 9, 16)),
-            photomock("testuser1", "testalbum2", datetime(2012, 9, 16)),
-            photomock("testuser2", "testalbum1", datetime(2012, 9, 16)),
-            photomock("testuser2", "testalbum3", datetime(2012, 8, 14)),
-            photomock("testuser3", "testalbum3", datetime(2012, 8, 14))
+    def get_feed_summary(self, limit=None, before=None):
+        summary = [
+            (datetime(2012, 9, 16).date(), "testuser1", "testalbum1", 2, datetime(2012, 9, 16, 12)),
+            (datetime(2012, 9, 16).date(), "testuser1", "testalbum2", 1, datetime(2012, 9, 16, 11)),
+            (datetime(2012, 9, 16).date(), "testuser2", "testalbum1", 1, datetime(2012, 9, 16, 10)),
+            (datetime(2012, 8, 14).date(), "testuser2", "testalbum3", 1, datetime(2012, 8, 14, 12)),
+            (datetime(2012, 8, 14).date(), "testuser3", "testalbum3", 1, datetime(2012, 8, 14, 11))
         ]
-        return feed
+        return summary[:limit]
 
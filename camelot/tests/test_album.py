@@ -1,9 +1,13 @@
+from django.db import DatabaseError, connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.test.client import RequestFactory
 from django.shortcuts import reverse
 from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.utils import timezone
 from PIL import Image
-from ..models import Album, Photo
+from ..models import Album, Photo, PhotoBlob
 from ..controllers.albumcontroller import *
 from ..controllers.groupcontroller import groupcontroller
 from ..controllers.utilities import *
@@ -12,9 +16,15 @@ from ..view.usermgmt import activate_user_no_check
 from .helperfunctions import complete_add_friends
 from ..constants import *
 from ..constants2 import *
+from datetime import timedelta
+import hashlib
+from io import StringIO
+import io
+import json
 import os
 import shutil
 from unittest import mock
+import zipfile
 
 
 class AlbumControllerTests(TestCase):
@@ -126,9 +136,16 @@ class AlbumControllerTests(TestCase):
             assert myphoto.uploader == self.u.profile
             assert myphoto.album == myalbum
             assert myphoto.description == "generic description"
-            assert myphoto.filename == "userphotos/1/1/1"
-            assert myphoto.thumb == "thumbs/1/1/1.jpg"
-            assert myphoto.midsize == "mid/1/1/1.jpg"
+            with open('../camelot/tests/resources/testimage.jpg', 'rb') as fi:
+                digest = hashlib.sha256(fi.read()).hexdigest()
+            assert myphoto.checksum == digest
+            assert myphoto.filename == "userphotos/store/{}/{}/{}".format(digest[:2], digest[2:4], digest)
+            assert myphoto.thumb == myphoto.filename + ".thumb.jpg"
+            assert myphoto.midsize == myphoto.filename + ".mid.jpg"
+
+            # derivatives were generated by the (synchronous) job queue
+            myphoto.refresh_from_db()
+            assert myphoto.status == PHOTO_READY
 
             # test file existence
             assert os.path.isfile(myphoto.filename)
@@ -151,6 +168,294 @@ class AlbumControllerTests(TestCase):
         #with open('wishlist.doc') as fp:
         #    c.post('/customers/wishes/', {'name': 'fred', 'attachment
 
+    def test_photo_processing_state(self):
+        """
+        Until the derivative job has run, a photo is processing and views serve the original
+        """
+        if not os.path.exists(self.testdir):
+            os.makedirs(self.testdir)
+        os.chdir(self.testdir)
+
+        myalbum = self.albumcontrol.create_album("processing test", "lalala")
+
+        try:
+            with open('../camelot/tests/resources/testimage.jpg', 'rb') as fi:
+                with mock.patch('camelot.controllers.albumcontroller.submit_job') as submit:
+                    myphoto = self.albumcontrol.add_photo_to_album(myalbum.id, "processing", fi)
+                    assert submit.called
+
+            myphoto.refresh_from_db()
+            assert myphoto.status == PHOTO_PROCESSING
+            assert os.path.isfile(myphoto.filename)
+            assert not os.path.isfile(myphoto.thumb)
+
+            request = self.factory.get(reverse("show_thumb", kwargs={'photoid': myphoto.id}))
+            request.user = self.u
+            response = return_photo_file_http(request, photoid=myphoto.id, thumb=True)
+            self.assertEqual(response.status_code, 200)
+            with open(myphoto.filename, 'rb') as original:
+                assert response.getvalue() == original.read()
+
+            # run the job ourselves
+            make_photo_derivatives(myphoto.filename, [(myphoto.thumb, THUMBHEIGHT), (myphoto.midsize, MIDHEIGHT)])
+            mark_blob_ready(myphoto.checksum)
+            myphoto.refresh_from_db()
+            assert myphoto.status == PHOTO_READY
+            assert os.path.isfile(myphoto.thumb)
+
+        finally:
+            os.chdir("..")
+            shutil.rmtree(self.testdir)
+
+    def test_repair_derivatives(self):
+        """
+        Photos whose derivative job failed or was lost are repaired by manage.py repairderivatives
+        """
+        if not os.path.exists(self.testdir):
+            os.makedirs(self.testdir)
+        os.chdir(self.testdir)
+
+        myalbum = self.albumcontrol.create_album("repair test", "lalala")
+
+        try:
+            with open('../camelot/tests/resources/testimage.jpg', 'rb') as fi:
+                with mock.patch('camelot.controllers.albumcontroller.make_photo_derivatives', side_effect=OSError):
+                    failed = self.albumcontrol.add_photo_to_album(myalbum.id, "failed", fi)
+            with open('../camelot/tests/resources/exifrotatedimg.jpg', 'rb') as fi:
+                # the worker went away, the job never reports back
+                with mock.patch('camelot.controllers.albumcontroller.submit_job'):
+                    lost = self.albumcontrol.add_photo_to_album(myalbum.id, "lost", fi)
+
+            blob = PhotoBlob.objects.get(sha256=failed.checksum)
+            assert blob.failed and not blob.ready
+            self.assertEqual(blob.attempts, 1)
+            failed.refresh_from_db()
+            assert failed.status == PHOTO_PROCESSING
+
+            # failed jobs are retried right away, lost ones once they have had time to finish
+            out = StringIO()
+            call_command('repairderivatives', stdout=out)
+            assert "Generated derivatives for 1 of 1 files" in out.getvalue()
+            failed.refresh_from_db()
+            assert failed.status == PHOTO_READY
+            assert os.path.isfile(failed.thumb)
+            assert not PhotoBlob.objects.get(sha256=failed.checksum).failed
+
+            PhotoBlob.objects.filter(sha256=lost.checksum).update(queued=timezone.now() - timedelta(hours=1))
+            with mock.patch('camelot.controllers.albumcontroller.make_photo_derivatives', side_effect=OSError):
+                for attempt in range(DERIVATIVE_MAX_ATTEMPTS):
+                    call_command('repairderivatives', stdout=StringIO())
+            # given up on after too many attempts
+            out = StringIO()
+            call_command('repairderivatives', stdout=out)
+            assert "Generated derivatives for 0 of 0 files" in out.getvalue()
+            assert "Gave up on 1 files" in out.getvalue()
+            lost.refresh_from_db()
+            assert lost.status == PHOTO_PROCESSING
+
+        finally:
+            os.chdir("..")
+            shutil.rmtree(self.testdir)
+
+    def test_duplicate_uploads_share_files(self):
+        """
+        The same image uploaded to several albums is stored and processed once
+        """
+        if not os.path.exists(self.testdir):
+            os.makedirs(self.testdir)
+        os.chdir(self.testdir)
+
+        album1 = self.albumcontrol.create_album("dedup 1", "lalala")
+        album2 = self.albumcontrol.create_album("dedup 2", "lalala")
+
+        try:
+            with open('../camelot/tests/resources/testimage.jpg', 'rb') as fi:
+                with mock.patch('camelot.controllers.albumcontroller.submit_job') as submit:
+                    photo1 = self.albumcontrol.add_photo_to_album(album1.id, "first", fi)
+                    photo2 = self.albumcontrol.add_photo_to_album(album2.id, "second", fi)
+                    self.assertEqual(submit.call_count, 2)
+
+                # both wait on the derivatives of the one file
+                assert photo1.filename == photo2.filename
+                assert photo1.status == photo2.status == PHOTO_PROCESSING
+                make_photo_derivatives(photo1.filename, [(photo1.thumb, THUMBHEIGHT), (photo1.midsize, MIDHEIGHT)])
+                mark_blob_ready(photo1.checksum)
+                photo1.refresh_from_db()
+                photo2.refresh_from_db()
+                assert photo1.status == photo2.status == PHOTO_READY
+
+                # later copies are ready right away
+                with mock.patch('camelot.controllers.albumcontroller.submit_job') as submit:
+                    photo3 = self.albumcontrol.add_photo_to_album(album2.id, "third", fi)
+                    assert not submit.called
+                assert photo3.status == PHOTO_READY
+                assert photo3.thumb == photo1.thumb
+
+            self.assertEqual(PhotoBlob.objects.get(sha256=photo1.checksum).refcount, 3)
+            self.assertEqual(len(os.listdir(os.path.dirname(photo1.filename))), 3)
+            # nothing was left behind in the upload directory
+            self.assertEqual(os.listdir(UPLOAD_TEMP_DIR), [])
+
+            # the store only deletes what it stored
+            store = get_store()
+            assert store.digest_of(photo1.thumb) == photo1.checksum
+            assert store.digest_of("userphotos/1/1/1") is None
+            assert store.digest_of("userphotos/store/00/00/" + photo1.checksum) is None
+
+            # deleting an album only drops its references
+            assert self.albumcontrol.delete_album(album2)
+            self.assertEqual(PhotoBlob.objects.get(sha256=photo1.checksum).refcount, 1)
+            assert os.path.isfile(photo1.midsize)
+
+        finally:
+            os.chdir("..")
+            shutil.rmtree(self.testdir)
+
+    def test_failed_insert_leaves_no_files(self):
+        """
+        Files brought into the store by an upload whose insert fails are removed, files already there are kept
+        """
+        if not os.path.exists(self.testdir):
+            os.makedirs(self.testdir)
+        os.chdir(self.testdir)
+
+        myalbum = self.albumcontrol.create_album("failed insert", "lalala")
+
+        try:
+            with open('../camelot/tests/resources/testimage.jpg', 'rb') as fi:
+                existing = self.albumcontrol.add_photo_to_album(myalbum.id, "first", fi)
+
+            with open('../camelot/tests/resources/testimage.jpg', 'rb') as f1, \
+                    open('../camelot/tests/resources/exifrotatedimg.jpg', 'rb') as f2:
+                with mock.patch.object(Photo.objects, 'bulk_create', side_effect=DatabaseError):
+                    with self.assertRaises(DatabaseError):
+                        self.albumcontrol.add_photos_to_album(myalbum.id, [("again", f1), ("new", f2)])
+                f2.seek(0)
+                newdigest = hashlib.sha256(f2.read()).hexdigest()
+
+            assert os.path.isfile(existing.filename)
+            assert not os.path.exists(get_store().path(newdigest))
+            self.assertFalse(PhotoBlob.objects.filter(sha256=newdigest).exists())
+            self.assertEqual(PhotoBlob.objects.get(sha256=existing.checksum).refcount, 1)
+            self.assertEqual(Photo.objects.filter(album=myalbum).count(), 1)
+            self.assertEqual(os.listdir(UPLOAD_TEMP_DIR), [])
+
+        finally:
+            os.chdir("..")
+            shutil.rmtree(self.testdir)
+
+    def test_photo_conditional_and_range_requests(self):
+        """
+        Full size downloads have a strong etag from the file hash, Last-Modified and byte ranges
+        """
+        if not os.path.exists(self.testdir):
+            os.makedirs(self.testdir)
+        os.chdir(self.testdir)
+
+        myalbum = self.albumcontrol.create_album("range test", "lalala")
+
+        try:
+            with open('../camelot/tests/resources/testimage.jpg', 'rb') as fi:
+                myphoto = self.albumcontrol.add_photo_to_album(myalbum.id, "range", fi)
+                fi.seek(0)
+                original = fi.read()
+            assert myphoto.checksum == hashlib.sha256(original).hexdigest()
+
+            def get(**headers):
+                request = self.factory.get(reverse("show_photo_full", kwargs={'photoid': myphoto.id}), **headers)
+                request.user = self.u
+                return return_photo_file_http(request, photoid=myphoto.id, mid=False)
+
+            response = get()
+            self.assertEqual(response.status_code, 200)
+            etag = response['ETag']
+            self.assertEqual(etag, '"{}-full"'.format(myphoto.checksum))
+            self.assertEqual(response['Accept-Ranges'], "bytes")
+            self.assertEqual(int(response['Content-Length']), len(original))
+            assert response.getvalue() == original
+
+            # revalidation with the strong etag skips the permission check
+            request = self.factory.get(reverse("show_photo_full", kwargs={'photoid': myphoto.id}),
+                                       HTTP_IF_NONE_MATCH=etag)
+            request.user = self.u2
+            self.assertEqual(return_photo_file_http(request, photoid=myphoto.id, mid=False).status_code, 304)
+
+            # but a user without access and without the etag does not get the photo
+            request = self.factory.get(reverse("show_photo_full", kwargs={'photoid': myphoto.id}))
+            request.user = self.u2
+            self.albumcontrol.set_accesstype(myalbum, ALBUM_PRIVATE)
+            self.assertRaises(PermissionException, return_photo_file_http, request, photoid=myphoto.id, mid=False)
+
+            response = get(HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+            self.assertEqual(response.status_code, 304)
+
+            # resume a download
+            response = get(HTTP_RANGE="bytes=100-")
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response['Content-Range'], "bytes 100-{}/{}".format(len(original) - 1, len(original)))
+            assert response.getvalue() == original[100:]
+
+            response = get(HTTP_RANGE="bytes=10-19", HTTP_IF_RANGE=etag)
+            self.assertEqual(response.status_code, 206)
+            assert response.getvalue() == original[10:20]
+
+            # the file changed since the client's copy, send all of it
+            response = get(HTTP_RANGE="bytes=10-19", HTTP_IF_RANGE='"stale"')
+            self.assertEqual(response.status_code, 200)
+            assert response.getvalue() == original
+
+            response = get(HTTP_RANGE="bytes={}-".format(len(original)))
+            self.assertEqual(response.status_code, 416)
+
+        finally:
+            os.chdir("..")
+            shutil.rmtree(self.testdir)
+
+    def test_signed_photo_urls(self):
+        """
+        Thumbnail urls minted by display_album are served without a permission check and cached by the browser
+        """
+        if not os.path.exists(self.testdir):
+            os.makedirs(self.testdir)
+        os.chdir(self.testdir)
+
+        myalbum = self.albumcontrol.create_album("signed url test", "lalala")
+
+        try:
+            with open('../camelot/tests/resources/testimage.jpg', 'rb') as fi:
+                myphoto = self.albumcontrol.add_photo_to_album(myalbum.id, "signed", fi)
+
+            request = self.factory.get(reverse("show_album", kwargs={'id': myalbum.id}))
+            request.user = self.u
+            with mock.patch("camelot.view.album.render") as render:
+                display_album(request, myalbum.id)
+            thumb_url = render.call_args[0][2]['photos'][0].thumb_url
+            assert thumb_url.startswith("/photo/s/")
+
+            # the client is logged in as a user who cannot see the private album, the signed url still works
+            self.albumcontrol.set_accesstype(myalbum, ALBUM_PRIVATE)
+            self.assertEqual(self.client.get(reverse("show_thumb", kwargs={'photoid': myphoto.id})).status_code, 404)
+
+            response = self.client.get(thumb_url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("immutable", response['Cache-Control'])
+            self.assertIn("private", response['Cache-Control'])
+            with open(myphoto.thumb, 'rb') as f:
+                assert response.getvalue() == f.read()
+
+            # tampering with the url invalidates the signature
+            self.assertEqual(self.client.get(thumb_url.replace("thumb", "mid")).status_code, 404)
+
+            # a signature that is still valid for a file or photo that is gone is a 404 as well
+            os.remove(myphoto.thumb)
+            self.assertEqual(self.client.get(thumb_url).status_code, 404)
+            assert self.albumcontrol.delete_photo(myphoto)
+            self.assertEqual(self.client.get(thumb_url).status_code, 404)
+
+        finally:
+            os.chdir("..")
+            shutil.rmtree(self.testdir)
+
     def test_add_image_to_other_user_album_controller(self):
         """
         User should not be able to add image to another user's album
@@ -233,10 +538,10 @@ class AlbumControllerTests(TestCase):
                 contribphoto1 = self.albumcontrol2.add_photo_to_album(myalbum.id, "contrib uploaded 1", fi)
                 contribphoto2 = self.albumcontrol2.add_photo_to_album(myalbum.id, "contrib uploaded 2", fi)
 
-            # files exist
-            assert os.path.isfile('userphotos/1/1/1')
-            assert os.path.isfile('userphotos/2/1/2')
-            assert os.path.isfile('userphotos/2/1/3')
+            # the same image is stored once
+            assert ownerphoto.filename == contribphoto1.filename == contribphoto2.filename
+            assert os.path.isfile(ownerphoto.filename)
+            assert PhotoBlob.objects.get(sha256=ownerphoto.checksum).refcount == 3
 
             # cannot delete any photo as non logged in user
             # todo: add user privilege escalation
@@ -252,8 +557,14 @@ class AlbumControllerTests(TestCase):
             # can delete contributor photo as owner
             assert self.albumcontrol.delete_photo(contribphoto2)
 
-            # can delete owner photo as owner
-            assert self.albumcontrol.delete_photo(ownerphoto)
+            # still in use by the owner's photo
+            assert os.path.isfile(ownerphoto.filename)
+            assert os.path.isfile(ownerphoto.thumb)
+            assert PhotoBlob.objects.get(sha256=ownerphoto.checksum).refcount == 1
+
+            # can delete owner photo as owner, the reaper deletes the files once the delete commits
+            with self.captureOnCommitCallbacks(execute=True):
+                assert self.albumcontrol.delete_photo(ownerphoto)
 
             assert (ownerphoto, contribphoto1, contribphoto2) not in self.albumcontrol.get_photos_for_album(myalbum)
 
@@ -263,9 +574,10 @@ class AlbumControllerTests(TestCase):
             self.assertRaises(Photo.DoesNotExist, contribphoto2.refresh_from_db)
 
             # check that files have actually been deleted on disk
-            assert not os.path.isfile('userphotos/1/1/1')
-            assert not os.path.isfile('userphotos/2/1/2')
-            assert not os.path.isfile('userphotos/2/1/3')
+            assert not os.path.isfile(ownerphoto.filename)
+            assert not os.path.isfile(ownerphoto.thumb)
+            assert not os.path.isfile(ownerphoto.midsize)
+            assert not PhotoBlob.objects.filter(sha256=ownerphoto.checksum).exists()
 
         finally:
             # clean up
@@ -294,22 +606,23 @@ class AlbumControllerTests(TestCase):
                 contribphoto2 = self.albumcontrol2.add_photo_to_album(myalbum.id, "contrib uploaded 2", fi)
 
             # image files exist
-            assert os.path.isfile('userphotos/1/1/1')
-            assert os.path.isfile('userphotos/2/1/2')
-            assert os.path.isfile('userphotos/2/1/3')
+            assert os.path.isfile(ownerphoto.filename)
+            assert os.path.isfile(contribphoto1.filename)
+            assert os.path.isfile(contribphoto2.filename)
 
             # non owner cannot delete
             self.assertRaises(PermissionException, self.albumcontrol2.delete_album, myalbum)
             # owner can delete
-            assert self.albumcontrol.delete_album(myalbum)
+            with self.captureOnCommitCallbacks(execute=True):
+                assert self.albumcontrol.delete_album(myalbum)
 
             # myalbum no longer exists
             self.assertRaises(Album.DoesNotExist, myalbum.refresh_from_db)
 
             # image files no longer exist
-            assert not os.path.isfile('userphotos/1/1/1')
-            assert not os.path.isfile('userphotos/2/1/2')
-            assert not os.path.isfile('userphotos/2/1/3')
+            assert not os.path.isfile(ownerphoto.filename)
+            assert not os.path.isfile(contribphoto1.filename)
+            assert not os.path.isfile(contribphoto2.filename)
 
         # todo: apply this finally pattern to other file opening unit tests
         finally:
@@ -386,11 +699,122 @@ class AlbumControllerTests(TestCase):
         assert testgroup2 in testalbum.groups.all()
         assert len(testalbum.groups.all()) == 2
 
+    def test_add_groups_view(self):
+        """
+        Groups already on the album are skipped, the album's groups are looked up once per request
+        """
+        testalbum = self.albumcontrol.create_album("group view test", "lalala")
+        groups = [self.groupcontrol.create("view group {}".format(i)) for i in range(4)]
+        self.albumcontrol.add_group_to_album(testalbum, groups[0])
+
+        def post(selected):
+            request = self.factory.post(reverse("add_album_groups", kwargs={'albumid': testalbum.id}),
+                                        {'idname': [group.id for group in selected]})
+            request.user = self.u
+            return add_groups(request, testalbum.id)
+
+        with CaptureQueriesContext(connection) as small:
+            self.assertEqual(post(groups[:2]).status_code, 302)
+        self.assertEqual(set(testalbum.groups.all()), set(groups[:2]))
+        with CaptureQueriesContext(connection) as large:
+            self.assertEqual(post(groups).status_code, 302)
+        self.assertEqual(set(testalbum.groups.all()), set(groups))
+
+        # only the additions themselves grow with the number of groups
+        lookups = lambda queries: [query for query in queries if query['sql'].startswith("SELECT")
+                                   and "camelot_album_groups" in query['sql']]
+        self.assertEqual(len(lookups(large)), len(lookups(small)))
+        # and the album's feed is recomputed once, not once per group
+        refreshes = [query for query in large if query['sql'].startswith("DELETE")
+                     and "camelot_feedentry" in query['sql']]
+        self.assertEqual(len(refreshes), 1)
+
     def test_remove_image_from_album(self):
         pass
 
     def test_download_album(self):
-        pass
+        """
+        The originals of an album are streamed as a zip, with a manifest of names and descriptions
+        """
+        if not os.path.exists(self.testdir):
+            os.makedirs(self.testdir)
+        os.chdir(self.testdir)
+
+        myalbum = self.albumcontrol.create_album("download test", "lalala")
+        url = reverse("download_album", kwargs={'albumid': myalbum.id})
+
+        try:
+            photos = []
+            for description, name in [("first", "testimage.jpg"), ("second", "testimage.jpg"),
+                                      ("rotated", "exifrotatedimg.jpg")]:
+                with open('../camelot/tests/resources/' + name, 'rb') as fi:
+                    photos.append(self.albumcontrol.add_photo_to_album(myalbum.id, description, fi))
+            # from before upload names were recorded
+            Photo.objects.filter(id=photos[2].id).update(name='')
+
+            # the client is logged in as a user who can't see the album
+            self.assertEqual(self.client.get(url).status_code, 404)
+            self.albumcontrol.set_accesstype(myalbum, ALBUM_PUBLIC)
+
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], "application/zip")
+            self.assertIn('attachment; filename="download test.zip"', response['Content-Disposition'])
+            assert response.streaming
+            chunks = list(response.streaming_content)
+            # the large photo was sent in pieces
+            assert max(len(chunk) for chunk in chunks) < DOWNLOAD_CHUNK_SIZE + 4096
+
+            with zipfile.ZipFile(io.BytesIO(b"".join(chunks))) as zf:
+                self.assertIsNone(zf.testzip())
+                names = ["testimage.jpg", "testimage (2).jpg", "{}.jpg".format(photos[2].id)]
+                self.assertEqual(zf.namelist(), names + ["manifest.json"])
+                for name, photo in zip(names, photos):
+                    self.assertEqual(zf.getinfo(name).compress_type, zipfile.ZIP_STORED)
+                    with open(photo.filename, 'rb') as f:
+                        self.assertEqual(zf.read(name), f.read())
+                manifest = json.loads(zf.read("manifest.json"))
+
+            self.assertEqual(manifest['album'], "download test")
+            self.assertEqual([(p['file'], p['name'], p['description']) for p in manifest['photos']],
+                             [(names[0], "testimage.jpg", "first"), (names[1], "testimage.jpg", "second"),
+                              (names[2], "", "rotated")])
+            self.assertEqual(manifest['photos'][0]['uploader'], "testuser")
+
+        finally:
+            os.chdir("..")
+            shutil.rmtree(self.testdir)
+
+    def test_download_album_zip64(self):
+        """
+        Archives past the zip limits use zip64, simulated by lowering the limit
+        """
+        if not os.path.exists(self.testdir):
+            os.makedirs(self.testdir)
+        os.chdir(self.testdir)
+
+        myalbum = self.albumcontrol.create_album("zip64 test", "lalala")
+        myalbum.accesstype = ALBUM_PUBLIC
+        myalbum.save()
+
+        try:
+            with open('../camelot/tests/resources/testimage.jpg', 'rb') as fi:
+                myphoto = self.albumcontrol.add_photo_to_album(myalbum.id, "big", fi)
+
+            with mock.patch("zipfile.ZIP64_LIMIT", 1024):
+                response = self.client.get(reverse("download_album", kwargs={'albumid': myalbum.id}))
+                data = b"".join(response.streaming_content)
+
+            with zipfile.ZipFile(io.BytesIO(data)) as zf:
+                self.assertIsNone(zf.testzip())
+                # the zip64 extra field, header id 1
+                self.assertEqual(zf.getinfo("testimage.jpg").extra[:2], b"\x01\x00")
+                with open(myphoto.filename, 'rb') as f:
+                    self.assertEqual(zf.read("testimage.jpg"), f.read())
+
+        finally:
+            os.chdir("..")
+            shutil.rmtree(self.testdir)
 
     def test_remove_contributor_from_album(self):
         pass
@@ -447,6 +871,182 @@ class AlbumControllerTests(TestCase):
         # owner can view
         assert self.albumcontrol.has_permission_to_view(testalbum)
 
+    def test_visible_to(self):
+        """
+        Album.objects.visible_to() must agree with has_permission_to_view() for every access type
+        """
+        testalbum = self.albumcontrol.create_album("visibility test", "testing visibility")
+        testgroup = self.groupcontrol.create("test group")
+        self.albumcontrol.add_group_to_album(testalbum, testgroup)
+
+        def check(profile, expected):
+            control = albumcontroller(profile.user.id) if profile else self.albumcontrol3
+            assert (testalbum in Album.objects.visible_to(profile)) == expected
+            assert control.has_permission_to_view(testalbum) == expected
+            assert (testalbum in control.filter_visible([testalbum])) == expected
+
+        for accesstype in ACCESSTYPES.keys():
+            self.albumcontrol.set_accesstype(testalbum, accesstype)
+            check(self.u.profile, True)
+            check(self.u2.profile, accesstype == ALBUM_PUBLIC)
+            check(None, accesstype == ALBUM_PUBLIC)
+
+        complete_add_friends(self.u.id, self.u2.id)
+        self.groupcontrol.add_member(testgroup.id, self.u2.profile)
+        for accesstype in ACCESSTYPES.keys():
+            self.albumcontrol.set_accesstype(testalbum, accesstype)
+            check(self.u2.profile, accesstype != ALBUM_PRIVATE)
+
+        self.albumcontrol.add_contributor_to_album(testalbum, self.u2.profile)
+        check(self.u2.profile, True)
+
+    def test_visible_to_friend_of_contributor(self):
+        """
+        All friends access type extends to friends of contributors
+        """
+        credentials = {'username': 'testuser3', 'email': 'user3@test.com', 'password': 'secret'}
+        u3 = User.objects.create_user(**credentials)
+        activate_user_no_check(u3)
+
+        testalbum = self.albumcontrol.create_album("contrib friends", "testing visibility")
+        complete_add_friends(self.u.id, self.u2.id)
+        complete_add_friends(self.u2.id, u3.id)
+
+        assert testalbum not in Album.objects.visible_to(u3.profile)
+        self.albumcontrol.add_contributor_to_album(testalbum, self.u2.profile)
+        assert testalbum in Album.objects.visible_to(u3.profile)
+
+    def test_return_albums_query_count(self):
+        """
+        Listing albums costs the same number of queries no matter how many albums there are
+        """
+        for i in range(10):
+            album = self.albumcontrol.create_album("album {}".format(i), "query count")
+            self.albumcontrol.set_accesstype(album, (i % ALBUM_PRIVATE) + 1)
+        complete_add_friends(self.u.id, self.u2.id)
+
+        with self.assertNumQueries(1):
+            albums = self.albumcontrol2.return_albums(self.u.profile)
+        assert len(albums) == 6
+
+    def test_album_covers(self):
+        """
+        Covers for all listed albums come from one query, an explicit cover wins over the newest photo
+        """
+        albums = [self.albumcontrol.create_album("cover test {}".format(i), "lalala") for i in range(3)]
+        now = timezone.now()
+        photos = [Photo.objects.create(album=album, uploader=self.u.profile, description=str(i),
+                                       pub_date=now + timedelta(minutes=i))
+                  for album in albums[:2] for i in range(3)]
+
+        with mock.patch("camelot.controllers.albumcontroller.ALBUM_COVER_ROTATE", False):
+            listed = self.albumcontrol.return_albums(covers=True)
+        with self.assertNumQueries(1):
+            self.albumcontrol.load_covers(listed)
+        covers = {album.id: album.coverphoto for album in listed}
+        self.assertEqual(covers, {albums[0].id: photos[2], albums[1].id: photos[5], albums[2].id: None})
+
+        # only the owner can choose the cover
+        assert not self.albumcontrol2.set_album_cover(photos[0])
+        assert self.albumcontrol.set_album_cover(photos[0])
+
+        listed = self.albumcontrol.return_albums(covers=True)
+        self.albumcontrol.load_covers(listed)
+        assert {album.id: album.coverphoto for album in listed}[albums[0].id] == photos[0]
+
+        # deleting the cover falls back to the remaining photos
+        photos[0].delete()
+        listed = self.albumcontrol.return_albums(covers=True)
+        self.albumcontrol.load_covers(listed)
+        assert {album.id: album.coverphoto for album in listed}[albums[0].id] in photos[1:3]
+
+        # the view signs a thumbnail url for each cover
+        request = self.factory.get(reverse("show_albums", kwargs={'userid': self.u.id}))
+        request.user = self.u
+        with mock.patch("camelot.view.album.render") as render:
+            display_albums(request, self.u.id)
+        rendered = {album.id: album for album in render.call_args[0][2]['albums']}
+        assert rendered[albums[1].id].cover_url
+        assert not hasattr(rendered[albums[2].id], 'cover_url')
+
+    def test_photo_neighbours(self):
+        """
+        Previous and next wrap around the album and take one query whatever the album size
+        """
+        myalbum = self.albumcontrol.create_album("neighbour test", "lalala")
+        otheralbum = self.albumcontrol.create_album("other album", "lalala")
+        photos = []
+        for i in range(5):
+            photos.append(Photo.objects.create(album=myalbum, uploader=self.u.profile, description=str(i)))
+            # photos of another album in between must be skipped
+            Photo.objects.create(album=otheralbum, uploader=self.u.profile, description=str(i))
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.albumcontrol.get_photo_neighbours(photos[2]), (photos[1].id, photos[3].id))
+        self.assertEqual(self.albumcontrol.get_photo_neighbours(photos[0]), (photos[4].id, photos[1].id))
+        self.assertEqual(self.albumcontrol.get_photo_neighbours(photos[4]), (photos[3].id, photos[0].id))
+
+        single = Photo.objects.create(album=self.albumcontrol.create_album("single", "lalala"),
+                                      uploader=self.u.profile, description="alone")
+        self.assertEqual(self.albumcontrol.get_photo_neighbours(single), (single.id, single.id))
+
+        request = self.factory.get(reverse("present_photo", kwargs={'photoid': photos[0].id}))
+        request.user = self.u
+        with mock.patch("camelot.view.album.render") as render:
+            display_photo(request, photos[0].id)
+        context = render.call_args[0][2]
+        self.assertEqual((context['previous'], context['next']), (photos[4].id, photos[1].id))
+        self.assertEqual(len(context['prefetch_urls']), 2)
+
+    def test_get_photos_page(self):
+        """
+        Album pages follow a (pub_date, id) cursor, photos sharing a timestamp are neither skipped nor repeated
+        """
+        myalbum = self.albumcontrol.create_album("page test", "lalala")
+        now = timezone.now()
+        # pairs of photos with the same timestamp
+        Photo.objects.bulk_create([Photo(album=myalbum, uploader=self.u2.profile, description=str(i),
+                                         pub_date=now + timedelta(seconds=i // 2)) for i in range(7)])
+        expected = list(Photo.objects.filter(album=myalbum).order_by('pub_date', 'id'))
+
+        seen = []
+        cursor = None
+        while True:
+            with self.assertNumQueries(1):
+                photos, cursor = self.albumcontrol.get_photos_page(myalbum, after=cursor, limit=3)
+            seen += photos
+            if cursor is None:
+                break
+        self.assertEqual(seen, expected)
+
+        # album owner may edit all descriptions, the uploader only their own
+        with self.assertNumQueries(0):
+            self.albumcontrol.set_desc_edit_perm(myalbum, seen)
+        assert all(photo.desc_edit_perm for photo in seen)
+        self.albumcontrol2.set_desc_edit_perm(myalbum, seen)
+        assert all(photo.desc_edit_perm for photo in seen)
+        albumcontroller(self.u.id).set_desc_edit_perm(Album(owner=self.u2.profile), seen)
+        assert not any(photo.desc_edit_perm for photo in seen)
+
+        self.assertRaises(ValidationError, self.albumcontrol.get_photos_page, myalbum, after="nonsense")
+
+        # html pages after the first are fragments with the next cursor in a header
+        request = self.factory.get(reverse("show_album", kwargs={'id': myalbum.id}))
+        request.user = self.u
+        with mock.patch("camelot.controllers.albumcontroller.ALBUM_PAGE_SIZE", 3), \
+                mock.patch("camelot.view.album.render") as render:
+            display_album(request, myalbum.id)
+        self.assertEqual(render.call_args[0][1], 'camelot/showalbum.html')
+        self.assertEqual(render.call_args[0][2]['photos'], expected[:3])
+        self.assertEqual(render.call_args[0][2]['next'], encode_photo_cursor(expected[2]))
+
+        request = self.factory.get(reverse("show_album", kwargs={'id': myalbum.id}), {'after': encode_photo_cursor(expected[5])})
+        request.user = self.u
+        response = display_album(request, myalbum.id)
+        self.assertEqual(response['X-Next-Cursor'], '')
+        self.assertIn('value="{}"'.format(expected[6].id), response.content.decode())
+        self.assertNotIn('value="{}"'.format(expected[5].id), response.content.decode())
+
     def test_collate_owner_and_contrib(self):
         """
         Test collate_owner_and_contrib(), returns list of album owner and contributors
@@ -1,12 +1,23 @@
-from django.test import TestCase
+from django.conf import settings
+from django.middleware.csrf import _get_new_csrf_string
+from django.test import Client, TestCase
 from django.contrib.auth.models import User
+from django.db import connection
 from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
 from django.shortcuts import reverse
+from django.utils import timezone
+from datetime import timedelta
+from fcntl import flock, LOCK_EX
+import hashlib
 import json
 from json.decoder import JSONDecodeError
 import os
 import shutil
+from unittest import mock
 from ..controllers.albumcontroller import albumcontroller
+from ..constants import ALBUM_PAGE_SIZE, UPLOAD_TEMP_DIR
+from ..models import Photo, UploadSession
 from .helperfunctions import complete_add_friends
 from ..view.usermgmt import activate_user_no_check
 
@@ -41,44 +52,354 @@ class albumAPItests(TestCase):
 
         self.testdir = "testdir"
 
+    def use_testdir(self):
+        """
+        Run the test in testdir, so the photos it stores are removed afterwards
+        """
+        os.makedirs(self.testdir, exist_ok=True)
+        os.chdir(self.testdir)
+        self.addCleanup(shutil.rmtree, self.testdir)
+        self.addCleanup(os.chdir, "..")
+
     def test_photo_upload(self):
         """
         Test regular usage of photo upload via API
         :return:
         """
+        self.use_testdir()
         albumid = self.albumcontrol.create_album("album for test", "lalala").id
 
-        with open('camelot/tests/resources/testimage.jpg', 'rb') as f:
+        with open('../camelot/tests/resources/testimage.jpg', 'rb') as f:
             response = self.client.post(reverse("uploadphotoapi", kwargs={'id': albumid}), {'image': f}, enctype="multipart/form-data")
 
         data = json.loads(response.content.decode('utf-8'))
         self.assertEqual(data['id'], 1)
         self.assertEqual(response.status_code, 201)
 
+    def test_photo_upload_streamed_to_disk(self):
+        """
+        Uploads are spooled to the data partition and moved into place, not copied through memory
+        :return:
+        """
+        self.use_testdir()
+        albumid = self.albumcontrol.create_album("album for test", "lalala").id
+
+        with open('../camelot/tests/resources/testimage.jpg', 'rb') as f:
+            response = self.client.post(reverse("uploadphotoapi", kwargs={'id': albumid}), {'image': f})
+            f.seek(0)
+            original = f.read()
+
+        self.assertEqual(response.status_code, 201)
+        photo = Photo.objects.get(id=json.loads(response.content.decode('utf-8'))['id'])
+        with open(photo.filename, 'rb') as f:
+            self.assertEqual(f.read(), original)
+        # hashed on the way in by the upload handler
+        self.assertEqual(photo.checksum, hashlib.sha256(original).hexdigest())
+
+        # nothing is left behind in the spool directory
+        self.assertEqual(os.listdir(UPLOAD_TEMP_DIR), [])
+
+    def test_photo_upload_too_large(self):
+        """
+        The size limit is enforced while the upload is received
+        :return:
+        """
+        self.use_testdir()
+        albumid = self.albumcontrol.create_album("album for test", "lalala").id
+
+        with mock.patch("camelot.uploadhandlers.MAX_UPLOAD_SIZE", 1024):
+            with open('../camelot/tests/resources/testimage.jpg', 'rb') as f:
+                response = self.client.post(reverse("uploadphotoapi", kwargs={'id': albumid}), {'image': f})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Photo.objects.exists())
+
     def test_photo_upload_non_image(self):
         """
         Test upload of code via photo upload API, should not work
         todo: manually test
         :return:
         """
+        self.use_testdir()
         albumid = self.albumcontrol.create_album("album for test", "lalala").id
 
-        with open('camelot/tests/resources/notanimage.jpg', 'rb') as f:
-            with self.assertRaises(Exception):
-                response = self.client.post(reverse("uploadphotoapi", kwargs={'id': albumid}), {'image': f},
+        with open('../camelot/tests/resources/notanimage.jpg', 'rb') as f:
+            response = self.client.post(reverse("uploadphotoapi", kwargs={'id': albumid}), {'image': f},
                                         enctype="multipart/form-data")
 
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Photo.objects.exists())
+        self.assertEqual(os.listdir(UPLOAD_TEMP_DIR), [])
+
+    def test_photo_upload_rejected_with_csrf(self):
+        """
+        With csrf enforced the body is parsed by CsrfViewMiddleware, before the view
+        A rejected upload must still come back as a 400, not escape the middleware as a 500
+        :return:
+        """
+        self.use_testdir()
+        albumid = self.albumcontrol.create_album("album for test", "lalala").id
+        client = Client(enforce_csrf_checks=True)
+        client.login(username=self.credentials['username'], password=self.credentials['password'])
+        token = _get_new_csrf_string()
+        client.cookies[settings.CSRF_COOKIE_NAME] = token
+        url = reverse("uploadphotoapi", kwargs={'id': albumid})
+
+        with mock.patch("camelot.uploadhandlers.MAX_UPLOAD_SIZE", 1024):
+            with open('../camelot/tests/resources/testimage.jpg', 'rb') as f:
+                response = client.post(url, {'image': f, 'csrfmiddlewaretoken': token})
+        self.assertEqual(response.status_code, 400)
+
+        with open('../camelot/tests/resources/notanimage.jpg', 'rb') as f:
+            response = client.post(url, {'image': f, 'csrfmiddlewaretoken': token})
+        self.assertEqual(response.status_code, 400)
+
+        self.assertFalse(Photo.objects.exists())
+
+        # a valid upload still goes through, and the token is really checked
+        with open('../camelot/tests/resources/testimage.jpg', 'rb') as f:
+            response = client.post(url, {'image': f, 'csrfmiddlewaretoken': token})
+        self.assertEqual(response.status_code, 201)
+        with open('../camelot/tests/resources/testimage.jpg', 'rb') as f:
+            response = client.post(url, {'image': f})
+        self.assertEqual(response.status_code, 403)
+
+    def post_batch(self, albumid, names):
+        files = [open('../camelot/tests/resources/' + name, 'rb') for name in names]
+        try:
+            return self.client.post(reverse("uploadphotosapi", kwargs={'id': albumid}), {'images': files})
+        finally:
+            for f in files:
+                f.close()
+
+    def test_batch_photo_upload(self):
+        """
+        Many photos in one request, invalid files are reported without failing the rest
+        """
+        self.use_testdir()
+        albumid = self.albumcontrol.create_album("album for test", "lalala").id
+
+        response = self.post_batch(albumid, ["testimage.jpg", "notanimage.jpg", "exifrotatedimg.jpg"])
+
+        self.assertEqual(response.status_code, 201)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual([photo['name'] for photo in data['photos']], ["testimage.jpg", "exifrotatedimg.jpg"])
+        self.assertEqual([rejected['name'] for rejected in data['rejected']], ["notanimage.jpg"])
+        photos = Photo.objects.filter(album=albumid).order_by('id')
+        self.assertEqual([photo.id for photo in photos], [photo['id'] for photo in data['photos']])
+        for photo in photos:
+            assert os.path.isfile(photo.filename)
+        self.assertEqual(os.listdir(UPLOAD_TEMP_DIR), [])
+
+    def test_batch_photo_upload_queries(self):
+        """
+        The album, permissions and database writes are done once per batch, not once per photo
+        """
+        self.use_testdir()
+        albumid = self.albumcontrol.create_album("album for test", "lalala").id
+        # a first upload generates the derivatives, which are then shared by both batches
+        self.post_batch(albumid, ["testimage.jpg", "exifrotatedimg.jpg"])
+
+        with CaptureQueriesContext(connection) as small:
+            response = self.post_batch(albumid, ["testimage.jpg", "exifrotatedimg.jpg"])
+        self.assertEqual(response.status_code, 201)
+        with CaptureQueriesContext(connection) as large:
+            response = self.post_batch(albumid, ["testimage.jpg", "exifrotatedimg.jpg"] * 5)
+        self.assertEqual(response.status_code, 201)
+
+        self.assertEqual(len(large), len(small))
+        self.assertEqual(Photo.objects.filter(album=albumid).count(), 14)
+
+    def test_batch_photo_upload_rejected(self):
+        """
+        Nothing valid to store, or too many files at once
+        """
+        self.use_testdir()
+        albumid = self.albumcontrol.create_album("album for test", "lalala").id
+
+        response = self.post_batch(albumid, ["notanimage.jpg"])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(json.loads(response.content.decode('utf-8'))['rejected']), 1)
+
+        with mock.patch("camelot.view.api.albumapi.UPLOAD_BATCH_MAX_FILES", 2):
+            response = self.post_batch(albumid, ["testimage.jpg"] * 3)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Photo.objects.exists())
+
+    def test_batch_photo_upload_permission(self):
+        """
+        Only the owner and contributors can add photos, even if the album is visible
+        """
+        self.use_testdir()
+        albumid = self.albumcontrol2.create_album("album for test", "lalala").id
+
+        response = self.post_batch(albumid, ["testimage.jpg"])
+        self.assertEqual(response.status_code, 404)
+
+        complete_add_friends(self.u.id, self.u2.id)
+        response = self.post_batch(albumid, ["testimage.jpg"])
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(Photo.objects.exists())
+
+    def create_session(self, albumid, data):
+        response = self.client.post(reverse("uploadsessionapi", kwargs={'id': albumid}),
+                                    json.dumps({"name": "upload.jpg", "size": len(data)}),
+                                    content_type="application/json")
+        if response.status_code != 201:
+            return response, None
+        return response, json.loads(response.content.decode('utf-8'))
+
+    def put_chunk(self, sessionid, data, first, last=None, size="*"):
+        last = first + len(data) - 1 if last is None else last
+        return self.client.put(reverse("uploadsessionchunkapi", kwargs={'sessionid': sessionid}), data,
+                               content_type="application/octet-stream",
+                               HTTP_CONTENT_RANGE="bytes {}-{}/{}".format(first, last, size))
+
+    def test_resumable_upload(self):
+        """
+        Create a session, send chunks, resume after an interrupted chunk, finalize
+        """
+        self.use_testdir()
+        albumid = self.albumcontrol.create_album("album for test", "lalala").id
+        with open('../camelot/tests/resources/testimage.jpg', 'rb') as f:
+            data = f.read()
+
+        response, session = self.create_session(albumid, data)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(session['offset'], 0)
+        partfile = UploadSession.objects.get(id=session['id']).path
+
+        # too little to tell whether it is an image yet
+        response = self.put_chunk(session['id'], data[:100], 0, size=len(data))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['offset'], 100)
+
+        response = self.put_chunk(session['id'], data[100:10000], 100, size=len(data))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['offset'], 10000)
+
+        # the connection drops part way through the next chunk
+        response = self.put_chunk(session['id'], data[10000:15000], 10000, last=19999)
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['offset'], 15000)
+
+        # the file size must be the one the session was created with
+        response = self.put_chunk(session['id'], data[15000:], 15000, size=len(data) + 1)
+        self.assertEqual(response.status_code, 400)
+
+        # a chunk from the wrong offset is refused with the offset to resume from
+        response = self.put_chunk(session['id'], data[10000:], 10000)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['offset'], 15000)
+
+        # not everything has arrived yet
+        response = self.client.post(reverse("finalizeuploadsessionapi", kwargs={'sessionid': session['id']}))
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.get(reverse("uploadsessionchunkapi", kwargs={'sessionid': session['id']}))
+        offset = json.loads(response.content.decode('utf-8'))['offset']
+        response = self.put_chunk(session['id'], data[offset:], offset)
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['offset'], len(data))
+
+        response = self.client.post(reverse("finalizeuploadsessionapi", kwargs={'sessionid': session['id']}),
+                                    json.dumps({"description": "resumed"}), content_type="application/json")
+        self.assertEqual(response.status_code, 201)
+        photo = Photo.objects.get(id=json.loads(response.content.decode('utf-8'))['id'])
+        self.assertEqual(photo.description, "resumed")
+        self.assertEqual(photo.checksum, hashlib.sha256(data).hexdigest())
+        with open(photo.filename, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+        # the session is over and its part file was moved into the photo store
+        assert not UploadSession.objects.exists()
+        assert not os.path.exists(partfile)
+        response = self.client.get(reverse("uploadsessionchunkapi", kwargs={'sessionid': session['id']}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_resumable_upload_rejected(self):
+        """
+        Sessions need permission to add to the album, and a plausible image
+        """
+        self.use_testdir()
+        with open('../camelot/tests/resources/testimage.jpg', 'rb') as f:
+            data = f.read()
+
+        # not the owner or a contributor
+        otheralbumid = self.albumcontrol2.create_album("album for test", "lalala").id
+        response, session = self.create_session(otheralbumid, data)
+        self.assertEqual(response.status_code, 404)
+
+        albumid = self.albumcontrol.create_album("album for test", "lalala").id
+        with mock.patch("camelot.uploadsessions.MAX_UPLOAD_SIZE", 1024):
+            response, session = self.create_session(albumid, data)
+        self.assertEqual(response.status_code, 400)
+
+        # the header is checked once enough of the file has arrived, here all of it
+        notimage = b"not an image at all" * 100
+        response, session = self.create_session(albumid, notimage)
+        response = self.put_chunk(session['id'], notimage[:100], 0)
+        self.assertEqual(response.status_code, 200)
+        response = self.put_chunk(session['id'], notimage[100:], 100)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(UploadSession.objects.get(id=session['id']).received, 0)
+
+        # a chunk is already being written
+        response, session = self.create_session(albumid, data)
+        with open(UploadSession.objects.get(id=session['id']).path, 'rb') as f:
+            flock(f.fileno(), LOCK_EX)
+            response = self.put_chunk(session['id'], data, 0)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(UploadSession.objects.get(id=session['id']).received, 0)
+
+        # sessions belong to the user who created them
+        self.client.force_login(self.u2)
+        response = self.put_chunk(session['id'], data, 0)
+        self.assertEqual(response.status_code, 404)
+        response = self.client.delete(reverse("uploadsessionchunkapi", kwargs={'sessionid': session['id']}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_resumable_upload_expiry(self):
+        """
+        Abandoned sessions are removed with their data
+        """
+        self.use_testdir()
+        albumid = self.albumcontrol.create_album("album for test", "lalala").id
+        with open('../camelot/tests/resources/testimage.jpg', 'rb') as f:
+            data = f.read()
+
+        response, session = self.create_session(albumid, data)
+        self.put_chunk(session['id'], data[:10000], 0)
+        partfile = UploadSession.objects.get(id=session['id']).path
+        UploadSession.objects.filter(id=session['id']).update(expires=timezone.now() - timedelta(seconds=1))
+
+        response = self.put_chunk(session['id'], data[10000:], 10000)
+        self.assertEqual(response.status_code, 404)
+
+        # expired sessions are cleaned up whenever a new one starts
+        with self.captureOnCommitCallbacks(execute=True):
+            response, newsession = self.create_session(albumid, data)
+        newpartfile = UploadSession.objects.get(id=newsession['id']).path
+        assert not UploadSession.objects.filter(id=session['id']).exists()
+        assert not os.path.exists(partfile)
+
+        # and an abandoned one can be deleted right away
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete(reverse("uploadsessionchunkapi", kwargs={'sessionid': newsession['id']}))
+        self.assertEqual(response.status_code, 204)
+        assert not UploadSession.objects.exists()
+        assert not os.path.exists(newpartfile)
+
     def test_photo_description_update(self):
         """
         Test regular usage of photo description update via API
         :return:
         """
+        self.use_testdir()
         seconddesc = "this is the second description"
         payload = {"description": seconddesc}
 
         # set up test
         albumid = self.albumcontrol.create_album("album for test2", "lalala").id
-        with open('camelot/tests/resources/testimage.jpg', 'rb') as f:
+        with open('../camelot/tests/resources/testimage.jpg', 'rb') as f:
             newphoto = self.albumcontrol.add_photo_to_album(albumid, "this is the first description", f)
 
         # send request
@@ -97,13 +418,14 @@ class albumAPItests(TestCase):
         :return:
         todo: manually test
         """
+        self.use_testdir()
         injectstr = "; update from camelot_photo set description='oh hai';"
         payload = {"description": injectstr}
 
         # set up test
         albumid = self.albumcontrol.create_album("album sql inject test", "lalala").id
         # todo: set album to public
-        with open('camelot/tests/resources/testimage.jpg', 'rb') as f:
+        with open('../camelot/tests/resources/testimage.jpg', 'rb') as f:
             newphoto = self.albumcontrol.add_photo_to_album(albumid, "this is the first description", f)
             secondphoto = self.albumcontrol.add_photo_to_album(albumid, "this is the second description", f)
 
@@ -126,12 +448,13 @@ class albumAPItests(TestCase):
         Testing in unit test to isolate issue - seems to work in back end testing
         :return:
         """
+        self.use_testdir()
         str = "aslan"
         payload = {"description": str}
 
         # set up test
         albumid = self.albumcontrol.create_album("album", "lalala").id
-        with open('camelot/tests/resources/testimage.jpg', 'rb') as f:
+        with open('../camelot/tests/resources/testimage.jpg', 'rb') as f:
             newphoto = self.albumcontrol.add_photo_to_album(albumid, "", f)
 
         # send request
@@ -213,6 +536,27 @@ class albumAPItests(TestCase):
             os.chdir("..")
             shutil.rmtree(self.testdir)
 
+    def test_get_photos_paginated(self):
+        """
+        Large albums are returned one page at a time, 'next' is the cursor of the following page
+        """
+        testalbum = self.albumcontrol2.create_album("test1", "testgetphotos")
+        complete_add_friends(self.u.id, self.u2.id)
+        Photo.objects.bulk_create([Photo(album=testalbum, uploader=testalbum.owner, description=str(i))
+                                   for i in range(ALBUM_PAGE_SIZE + 1)])
+
+        response = self.client.get(reverse("getphotosapi", kwargs={'id': testalbum.id}))
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(len(data['photos']), ALBUM_PAGE_SIZE)
+        assert data['next']
+
+        response = self.client.get(reverse("getphotosapi", kwargs={'id': testalbum.id}), {'after': data['next']})
+        data2 = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(len(data2['photos']), 1)
+        self.assertIsNone(data2['next'])
+        self.assertEqual(sorted(photo['id'] for photo in data['photos'] + data2['photos']),
+                         list(Photo.objects.filter(album=testalbum).order_by('id').values_list('id', flat=True)))
+
     def test_get_photos_invalid_post(self):
         """
         Test the get photos for album api call, make a post request
@@ -0,0 +1,53 @@
+from django.test import TestCase
+from collections import Counter
+import os
+import random
+import shutil
+from ..benchmark import generate_dataset, run_benchmarks, summarize, _power_law_edges
+from ..models import Album, FriendLink, Photo, Profile
+
+
+class BenchmarkTests(TestCase):
+
+    """
+    The benchmark harness itself, at a tiny scale
+    """
+
+    def setUp(self):
+        self.testdir = "testdir"
+        os.makedirs(self.testdir, exist_ok=True)
+        os.chdir(self.testdir)
+
+    def tearDown(self):
+        os.chdir("..")
+        shutil.rmtree(self.testdir)
+
+    def test_power_law_edges(self):
+        edges = _power_law_edges(500, 2, random.Random(1))
+        # every user after the first few makes exactly 2 friends
+        self.assertEqual(len(edges), (500 - 3) * 2)
+        degrees = Counter(user for edge in edges for user in edge)
+        # a few popular users, most with close to the minimum
+        assert max(degrees.values()) > 20
+        assert sorted(degrees.values())[250] <= 4
+
+    def test_summarize(self):
+        summary = summarize([i / 1000 for i in range(1, 101)], [3] * 99 + [9], [2048])
+        self.assertEqual((summary['p50_ms'], summary['p95_ms']), (50, 95))
+        self.assertEqual((summary['queries_p50'], summary['queries_max']), (3, 9))
+        self.assertEqual(summary['peak_kib_max'], 2.0)
+
+    def test_generate_and_run(self):
+        data = generate_dataset(users=10, degree=2, albums=1, photos=1, seed=3)
+        self.assertEqual(Profile.objects.count(), 10)
+        self.assertEqual(Album.objects.count(), len(data.albumids))
+        self.assertEqual(Photo.objects.count(), len(data.photoids))
+        assert FriendLink.objects.exists()
+        for photo in Photo.objects.all():
+            assert os.path.exists(photo.filename)
+            assert os.path.exists(photo.thumb)
+
+        results = run_benchmarks(data, requests=2, memory_samples=1, seed=3)
+        assert {'user_home', 'display_albums'} <= set(results)
+        self.assertEqual(results['user_home']['requests'], 2)
+        assert results['user_home']['queries_p50'] > 0
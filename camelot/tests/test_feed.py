@@ -1,6 +1,16 @@
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User
 from .mocks import profilecontrolmock
-from ..friendfeed import generate_feed
+from .helperfunctions import complete_add_friends
+from ..friendfeed import generate_feed, fan_out_photo, rebuild_feed, refresh_album_feed
+from ..controllers.albumcontroller import albumcontroller
+from ..controllers.friendcontroller import friendcontroller
+from ..controllers.profilecontroller import profilecontroller
+from ..models import FeedEntry, Photo
+from ..view.usermgmt import activate_user_no_check
+from ..constants import *
 
 
 class FeedTests(TestCase):
@@ -9,3 +19,134 @@ class FeedTests(TestCase):
         testfeed = generate_feed(pcontrol)
 
         assert len(testfeed) == 5
+        assert testfeed[0][3] == 2
+        assert testfeed[4][0].endswith("days ago")
+
+        assert len(generate_feed(pcontrol, limit=3)) == 3
+
+
+class MaterializedFeedTests(TestCase):
+    """
+    The feed table must follow uploads, friendships and album permissions
+    """
+    def setUp(self):
+        self.users = []
+        for i in range(3):
+            u = User.objects.create_user(username='testuser{}'.format(i), email='user{}@test.com'.format(i),
+                                         password='secret')
+            activate_user_no_check(u)
+            self.users.append(u)
+        self.u, self.u2, self.u3 = self.users
+
+        complete_add_friends(self.u.id, self.u2.id)
+        self.albumcontrol2 = albumcontroller(self.u2.id)
+        self.album = self.albumcontrol2.create_album("feed album", "feed test")
+        self.profilecontrol = profilecontroller(self.u.id)
+
+    def add_photo(self, description):
+        # skip the file handling of add_photo_to_album, we only care about the feed rows
+        photo = Photo.objects.create(description=description, album=self.album, uploader=self.u2.profile,
+                                     imgtype="image/jpeg")
+        fan_out_photo(photo)
+        return photo
+
+    def test_fan_out(self):
+        photo = self.add_photo("hello")
+
+        assert photo in self.profilecontrol.get_feed()
+        assert photo in profilecontroller(self.u2.id).get_feed()
+        # not friends with the uploader
+        assert photo not in profilecontroller(self.u3.id).get_feed()
+
+    def test_album_permission_change(self):
+        photo = self.add_photo("hello")
+
+        self.albumcontrol2.set_accesstype(self.album, ALBUM_PRIVATE)
+        assert photo not in self.profilecontrol.get_feed()
+        # uploader still sees their own photo
+        assert photo in profilecontroller(self.u2.id).get_feed()
+
+        self.albumcontrol2.set_accesstype(self.album, ALBUM_ALLFRIENDS)
+        assert photo in self.profilecontrol.get_feed()
+
+    def test_refresh_album_feed(self):
+        """
+        Refreshing an album writes the same rows as rebuilding every feed, with one insert per uploader
+        """
+        complete_add_friends(self.u2.id, self.u3.id)
+        assert self.albumcontrol2.add_contributor_to_album(self.album, self.u3.profile)
+        photos = [self.add_photo("photo {}".format(i)) for i in range(3)]
+        photos.append(Photo.objects.create(description="contributed", album=self.album, uploader=self.u3.profile,
+                                           imgtype="image/jpeg"))
+
+        for accesstype in (ALBUM_PUBLIC, ALBUM_PRIVATE, ALBUM_ALLFRIENDS):
+            self.album.accesstype = accesstype
+            self.album.save()
+            with CaptureQueriesContext(connection) as queries:
+                refresh_album_feed(self.album)
+            inserts = [query for query in queries if query['sql'].startswith("INSERT")]
+            self.assertEqual(len(inserts), 2)
+
+            refreshed = set(FeedEntry.objects.values_list('owner', 'photo', 'pub_date'))
+            for u in self.users:
+                rebuild_feed(u.profile)
+            self.assertEqual(refreshed, set(FeedEntry.objects.values_list('owner', 'photo', 'pub_date')))
+
+        # u is a friend of the uploader u2 but not of the contributor u3
+        self.assertEqual(set(FeedEntry.objects.filter(owner=self.u.profile).values_list('photo', flat=True)),
+                         {photo.id for photo in photos[:3]})
+
+    def test_friendship_change(self):
+        photo = self.add_photo("hello")
+
+        friendcontroller(self.u.id).remove(self.u2.profile)
+        assert photo not in self.profilecontrol.get_feed()
+
+        complete_add_friends(self.u.id, self.u2.id)
+        assert photo in self.profilecontrol.get_feed()
+
+    def test_rebuild_matches_fan_out(self):
+        for i in range(5):
+            self.add_photo("photo {}".format(i))
+        before = set(FeedEntry.objects.filter(owner=self.u.profile).values_list('photo', flat=True))
+        rebuild_feed(self.u.profile)
+        after = set(FeedEntry.objects.filter(owner=self.u.profile).values_list('photo', flat=True))
+        assert before == after
+        assert len(after) == 5
+
+    def test_feed_pagination(self):
+        photos = [self.add_photo("photo {}".format(i)) for i in range(5)]
+        photos.reverse()
+
+        firstpage = self.profilecontrol.get_feed(limit=2)
+        assert firstpage == photos[:2]
+        cursor = (firstpage[-1].pub_date, firstpage[-1].id)
+        assert self.profilecontrol.get_feed(limit=2, before=cursor) == photos[2:4]
+
+        # one read of the feed table, regardless of the feed size
+        with self.assertNumQueries(1):
+            self.profilecontrol.get_feed(limit=FEED_LENGTH)
+
+    def test_feed_summary(self):
+        first = self.add_photo("first")
+        self.add_photo("second")
+        otheralbum = self.albumcontrol2.create_album("other album", "feed test")
+        Photo.objects.filter(id=first.id).update(album=otheralbum)
+        FeedEntry.objects.all().delete()
+        rebuild_feed(self.u.profile)
+
+        # grouping and the names we display come back in one query
+        with self.assertNumQueries(1):
+            summary = self.profilecontrol.get_feed_summary()
+        assert len(summary) == 2
+        assert sorted(row[3] for row in summary) == [1, 1]
+        assert set(str(row[2]) for row in summary) == {"feed album", "other album"}
+        assert str(summary[0][1]) == "testuser1"
+
+        feed = generate_feed(self.profilecontrol, limit=1)
+        assert len(feed) == 1
+        assert feed[0][0] == "today"
+
+        # continue from the cursor of the last row
+        cursor = (summary[0][0], summary[0][4])
+        assert self.profilecontrol.get_feed_summary(before=cursor) == summary[1:]
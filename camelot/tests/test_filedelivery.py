@@ -0,0 +1,48 @@
+from django.test import TestCase, override_settings
+from django.http import FileResponse
+from ..filedelivery import serve_file, parse_range
+import os
+
+TESTIMAGE = "camelot/tests/resources/testimage.jpg"
+
+
+class FileDeliveryTests(TestCase):
+
+    @override_settings(FILE_DELIVERY_BACKEND="django")
+    def test_django_backend(self):
+        response = serve_file(TESTIMAGE, "image/jpeg")
+        assert isinstance(response, FileResponse)
+        assert response['Content-Type'] == "image/jpeg"
+        assert int(response['Content-Length']) == os.path.getsize(TESTIMAGE)
+        with open(TESTIMAGE, "rb") as f:
+            assert response.getvalue() == f.read()
+
+    @override_settings(FILE_DELIVERY_BACKEND="x-accel-redirect", FILE_DELIVERY_ACCEL_PREFIX="/protected/")
+    def test_x_accel_redirect_backend(self):
+        response = serve_file("thumbs/1/2/3.jpg", "image/jpeg")
+        assert response['X-Accel-Redirect'] == "/protected/thumbs/1/2/3.jpg"
+        assert response['Content-Type'] == "image/jpeg"
+        assert response.content == b""
+
+    @override_settings(FILE_DELIVERY_BACKEND="x-sendfile")
+    def test_x_sendfile_backend(self):
+        response = serve_file("thumbs/1/2/3.jpg", "image/jpeg")
+        assert response['X-Sendfile'] == os.path.join(os.getcwd(), "thumbs/1/2/3.jpg")
+        assert response.content == b""
+
+    @override_settings(FILE_DELIVERY_BACKEND="carrier-pigeon")
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, serve_file, TESTIMAGE, "image/jpeg")
+
+    def test_parse_range(self):
+        assert parse_range("bytes=0-99", 1000) == (0, 99)
+        assert parse_range("bytes=900-", 1000) == (900, 999)
+        assert parse_range("bytes=-100", 1000) == (900, 999)
+        assert parse_range("bytes=900-2000", 1000) == (900, 999)
+        # several ranges and malformed headers are ignored, the whole file is served
+        assert parse_range("bytes=0-9,20-29", 1000) is None
+        assert parse_range("lines=0-9", 1000) is None
+        assert parse_range("bytes=9-0", 1000) is None
+        # unsatisfiable
+        assert parse_range("bytes=1000-", 1000) is False
+        assert parse_range("bytes=-0", 1000) is False
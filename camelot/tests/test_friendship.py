@@ -1,9 +1,12 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.core.cache import cache
 from django.contrib.auth.models import User
 from django.test.client import RequestFactory
 from django.shortcuts import reverse
 from ..controllers.friendcontroller import friendcontroller, are_friends
-from ..models import Friendship
+from ..models import Friendship, FriendLink
+from ..controllers.utilities import AlreadyExistsException
+from ..friendgraph import FriendGraph
 from .helperfunctions import complete_add_friends
 from ..view.usermgmt import activate_user_no_check
 from ..view import friend
@@ -156,6 +159,30 @@ class FriendshipTests(FriendGroupControllerTests):
         assert len(self.friendcontrol.return_friend_list(self.friend.profile)) == 1
         assert len(self.friendcontrol.return_friend_list(self.friend2.profile)) == 1
 
+    def test_friend_links(self):
+        """
+        Every friendship is mirrored by one FriendLink row from each side
+        """
+        def links():
+            return set(FriendLink.objects.values_list('profile', 'friend', 'confirmed'))
+
+        uid, fid = self.u.profile.id, self.friend.profile.id
+        self.friendcontrol.add(self.friend.profile)
+        self.assertEqual(links(), {(uid, fid, False), (fid, uid, False)})
+        self.assertRaises(AlreadyExistsException, self.otherfriendcontrol.add, self.u.profile)
+
+        self.otherfriendcontrol.confirm(self.u.profile)
+        self.assertEqual(links(), {(uid, fid, True), (fid, uid, True)})
+
+        # the friend list is a single query, users included
+        with self.assertNumQueries(1):
+            self.assertEqual([p.user.username for p in self.friendcontrol.return_friend_list(self.u.profile)],
+                             [self.friend.username])
+
+        # either side can remove the friendship
+        assert self.otherfriendcontrol.remove(self.u.profile)
+        self.assertEqual(links(), set())
+
     def test_filter_friends(self):
         pass
 
@@ -198,6 +225,76 @@ class FriendshipTests(FriendGroupControllerTests):
         qset = self.friendcontrol.findfriends(search4)
         assert len(qset) == 1
 
+    def test_find_friends_ranked(self):
+        # the closest match comes first, case and accents are ignored
+        self.assertEqual(self.friendcontrol.findfriends("TESTUSER")[0], self.u.profile)
+        self.friend2.profile.dname = "Zoë Crane"
+        self.friend2.profile.save()
+        self.assertEqual(self.friendcontrol.findfriends("zoe"), [self.friend2.profile])
+
+        # the users come along with the profiles
+        results = self.friendcontrol.findfriends("stuser")
+        with self.assertNumQueries(0):
+            names = [str(p) for p in results]
+        assert len(names) == 4
+
+    def test_find_friends_excludes_friends(self):
+        complete_add_friends(self.u.id, self.friend.id)
+        self.friendcontrol.add(self.friend2.profile)
+        results = self.friendcontrol.findfriends("test")
+        # pending friends are still found
+        self.assertEqual(set(results), {self.u.profile, self.friend2.profile, self.friend3.profile})
+
+    def test_find_friends_paged(self):
+        first = self.friendcontrol.findfriends("test", limit=3)
+        rest = self.friendcontrol.findfriends("test", limit=3, offset=3)
+        assert len(first) == 3
+        assert len(rest) == 1
+        self.assertEqual(set(first + rest), set(self.friendcontrol.findfriends("test")))
+
+
+class FriendGraphTests(FriendGroupControllerTests):
+
+    """
+    Friendship lookups answered from memory or the shared cache
+    """
+
+    def test_lookups_from_memory(self):
+        complete_add_friends(self.u.id, self.friend.id)
+        self.friendcontrol.add(self.friend2.profile)
+
+        graph = FriendGraph()
+        with self.assertNumQueries(1):
+            assert graph.are_friends(self.u.profile, self.friend.profile)
+            assert not graph.are_friends(self.u.profile, self.friend2.profile)
+            assert graph.are_friends(self.u.profile, self.friend2.profile, confirmed=False)
+            assert graph.are_friends_or_pending(self.u.profile, self.friend2.profile)
+            assert not graph.are_friends_or_pending(self.u.profile, self.friend3.profile)
+            self.assertEqual(graph.friends_among(self.u.profile, [self.friend3.profile, self.friend.profile,
+                                                                 self.friend2.profile]), [self.friend.profile])
+
+        # changes through the controller are seen by graphs that were already loaded
+        self.otherfriendcontrol2.confirm(self.u.profile)
+        assert graph.are_friends(self.u.profile, self.friend2.profile)
+        self.friendcontrol.remove(self.friend.profile)
+        assert not graph.are_friends(self.u.profile, self.friend.profile)
+
+    @override_settings(FRIENDGRAPH_CACHE='default')
+    def test_shared_cache(self):
+        cache.clear()
+        complete_add_friends(self.u.id, self.friend.id)
+
+        assert FriendGraph().are_friends(self.u.profile, self.friend.profile)
+        # a new request finds the adjacency in the cache
+        with self.assertNumQueries(0):
+            assert FriendGraph().are_friends(self.u.profile, self.friend.profile)
+
+        # removing the friendship bumps the version, so the cached entry is not used any more
+        self.friendcontrol.remove(self.friend.profile)
+        with self.assertNumQueries(1):
+            assert not FriendGraph().are_friends(self.u.profile, self.friend.profile)
+        cache.clear()
+
 
 class FriendViewTests(TestCase):
 
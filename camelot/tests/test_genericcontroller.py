@@ -1,7 +1,12 @@
 from django.test import TestCase
-from django.http import Http404
+from django.http import Http404, HttpResponse
 from django.contrib.auth.models import User
+from django.test.client import RequestFactory
+from ..controllers.albumcontroller import albumcontroller
+from ..controllers.friendcontroller import friendcontroller
 from ..controllers.genericcontroller import genericcontroller
+from ..models import Album
+from ..requestcontext import RequestContextMiddleware, current_context, get_album
 from ..view.usermgmt import activate_user_no_check
 
 
@@ -24,3 +29,45 @@ class GenericControllerTests(TestCase):
         activate_user_no_check(self.u)
         g = genericcontroller(self.u.id)
         assert g.uprofile == self.u.profile
+
+
+class RequestContextTests(TestCase):
+
+    """
+    Controllers created within one request share the profile and friend graph
+    """
+
+    def setUp(self):
+        self.u = User.objects.create_user(username='testuser', email='user@test.com', password='secret')
+        activate_user_no_check(self.u)
+
+    def test_shared_within_request(self):
+        def view(request):
+            with self.assertNumQueries(1):
+                first = albumcontroller(self.u.id)
+                second = friendcontroller(self.u.id)
+            assert first.uprofile is second.uprofile
+            assert first.friendgraph is second.friendgraph
+
+            # the album is fetched once, however many times it is asked for
+            album = first.create_album("context", "")
+            with self.assertNumQueries(1):
+                assert get_album(album.id) is get_album(album.id)
+
+            # deleted rows are forgotten
+            albumid = album.id
+            album.delete()
+            with self.assertRaises(Album.DoesNotExist):
+                get_album(albumid)
+            return HttpResponse()
+
+        RequestContextMiddleware(view)(RequestFactory().get('/'))
+
+    def test_no_context(self):
+        # outside of a request nothing is shared
+        assert current_context() is None
+        with self.assertNumQueries(2):
+            first = genericcontroller(self.u.id)
+            second = genericcontroller(self.u.id)
+        assert first.uprofile == second.uprofile
+        assert first.uprofile is not second.uprofile
@@ -3,7 +3,8 @@ from django.contrib.auth.models import User
 from django.shortcuts import reverse
 from .test_friendship import FriendGroupControllerTests
 from django.test.client import RequestFactory
-from ..controllers.groupcontroller import groupcontroller, is_in_group
+from ..controllers.albumcontroller import albumcontroller
+from ..controllers.groupcontroller import groupcontroller, is_in_group, is_in_groups, member_group_ids, album_group_ids
 from ..controllers.utilities import PermissionException
 from .helperfunctions import complete_add_friends
 from ..models import FriendGroup
@@ -169,6 +170,47 @@ class GroupControllerTests(FriendGroupControllerTests):
         self.groupcontrol.add_member(newgroup.id, self.friend.profile)
         assert is_in_group(newgroup, self.friend.profile)
 
+    def test_is_in_groups(self):
+        """
+        Membership of many groups is answered in one query
+        """
+        complete_add_friends(self.u.id, self.friend.id)
+        group1 = self.groupcontrol.create("Bulk 1")
+        group2 = self.groupcontrol.create("Bulk 2")
+        group3 = self.groupcontrol2.create("Bulk 3")
+        self.groupcontrol.add_member(group1.id, self.friend.profile)
+        self.groupcontrol2.add_member(group3.id, self.u.profile)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(is_in_groups([group1, group2, group3.id], self.friend.profile), {group1.id})
+        self.assertEqual(is_in_groups([group1, group2], None), set())
+        self.assertEqual(member_group_ids(self.u.profile), {group3.id})
+
+    def test_return_groups_of(self):
+        self.groupcontrol2.create("Bulk groups")
+        with self.assertNumQueries(1):
+            groups = self.groupcontrol.return_groups_of([self.u.profile, self.friend.profile])
+        self.assertEqual(groups[self.u.profile.id], list(self.groupcontrol.return_groups().order_by('id')))
+        self.assertEqual(len(groups[self.friend.profile.id]), 4)
+
+    def test_album_group_ids(self):
+        """
+        Access to many group restricted albums is a set intersection
+        """
+        complete_add_friends(self.u.id, self.friend.id)
+        albumcontrol = albumcontroller(self.u.id)
+        album1 = albumcontrol.create_album("groups 1", "")
+        album2 = albumcontrol.create_album("groups 2", "")
+        group = self.groupcontrol.create("Album group")
+        albumcontrol.add_group_to_album(album1, group)
+        self.groupcontrol.add_member(group.id, self.friend.profile)
+
+        with self.assertNumQueries(1):
+            groups = album_group_ids([album1, album2])
+        self.assertEqual(groups, {album1.id: {group.id}, album2.id: set()})
+        viewer = member_group_ids(self.friend.profile)
+        self.assertEqual([albumid for albumid in groups if groups[albumid] & viewer], [album1.id])
+
 
 class GroupViewTests(TestCase):
     def setUp(self):
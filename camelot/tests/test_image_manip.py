@@ -1,6 +1,13 @@
 from ..controllers.utilities import exif_rotate_image
+from ..controllers.albumcontroller import make_derivatives
+from ..constants import THUMBHEIGHT, MIDHEIGHT
+from ..datavalidation.validationfunctions import validate_image
+from django.core.exceptions import ValidationError
 from django.test import TestCase
 from PIL import Image
+import os
+import tempfile
+from unittest import mock
 
 
 class ImageManipulationTests(TestCase):
@@ -12,3 +19,49 @@ class ImageManipulationTests(TestCase):
         # no exif present
         # no rotation field in exif
         # exif rotations 1 - 8
+
+    def test_make_derivatives(self):
+        """
+        One decode produces every size, rotated according to exif
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            thumbname = os.path.join(tmpdir, "thumb.jpg")
+            midname = os.path.join(tmpdir, "mid.jpg")
+
+            # the original is a landscape 5312x2988 jpeg with exif orientation 6
+            with mock.patch("camelot.controllers.albumcontroller.Image.open", wraps=Image.open) as opener:
+                written = make_derivatives("camelot/tests/resources/exifrotatedimg.jpg",
+                                           [(thumbname, THUMBHEIGHT), (midname, MIDHEIGHT)])
+            opener.assert_called_once()
+
+            assert written[midname].size == (337, MIDHEIGHT)
+            assert written[thumbname].size == (101, THUMBHEIGHT)
+
+            for name, height in ((thumbname, THUMBHEIGHT), (midname, MIDHEIGHT)):
+                with Image.open(name) as img:
+                    assert img.format == "JPEG"
+                    assert img.size[1] == height
+                    # portrait after rotation
+                    assert img.size[0] < img.size[1]
+
+    def test_make_derivatives_small_image(self):
+        """
+        Images smaller than the target are not scaled up
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            midname = os.path.join(tmpdir, "mid.jpg")
+            written = make_derivatives("camelot/tests/resources/testimage.jpg", [(midname, MIDHEIGHT)])
+            assert written[midname].size == (270, 270)
+
+
+    def test_validate_image(self):
+        """
+        Anything PIL cannot open is a ValidationError, whether given as a path or a file object
+        """
+        validate_image("camelot/tests/resources/testimage.jpg")
+        with self.assertRaises(ValidationError):
+            validate_image("camelot/tests/resources/notanimage.jpg")
+        with open("camelot/tests/resources/notanimage.jpg", "rb") as f:
+            with self.assertRaises(ValidationError):
+                validate_image(f)
+            self.assertEqual(f.tell(), 0)
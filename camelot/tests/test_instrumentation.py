@@ -0,0 +1,117 @@
+from django.test import TestCase, override_settings
+from django.contrib.auth.models import User
+from django.shortcuts import reverse
+from django.utils import timezone
+from datetime import timedelta
+from unittest import mock
+from .. import instrumentation
+from ..controllers.albumcontroller import albumcontroller
+from ..friendfeed import fan_out_photo
+from ..instrumentation import QueryBudgetExceeded
+from ..models import Photo
+from .helperfunctions import complete_add_friends
+from ..view.usermgmt import activate_user_no_check
+
+
+class InstrumentationTests(TestCase):
+
+    """
+    Query budgets of the pages that list albums and photos, and the metrics they produce
+    """
+
+    def setUp(self):
+        self.credentials = {
+            'username': 'testuser',
+            'email': 'user@test.com',
+            'password': 'secret'}
+        self.u = User.objects.create_user(**self.credentials)
+        activate_user_no_check(self.u)
+        self.client.post('', self.credentials, follow=True)
+        instrumentation.reset()
+        self.friends = 0
+
+    def add_content(self, friends, albums, photos):
+        """
+        Give the logged in user some friends, each with albums of photos, visible in the feed
+        """
+        start = timezone.now() - timedelta(days=3)
+        for i in range(friends):
+            self.friends += 1
+            friend = User.objects.create_user(username="friend{}".format(self.friends),
+                                              email="f{}@test.com".format(self.friends), password='secret')
+            activate_user_no_check(friend)
+            complete_add_friends(self.u.id, friend.id)
+            albumcontrol = albumcontroller(friend.id)
+            for j in range(albums):
+                album = albumcontrol.create_album("album {}".format(j), "")
+                for k in range(photos):
+                    photo = Photo.objects.create(album=album, uploader=friend.profile, description="",
+                                                 imgtype="image/jpeg", checksum="0" * 64,
+                                                 pub_date=start + timedelta(hours=i * 24 + k))
+                    fan_out_photo(photo)
+        self.friendalbum = album
+        self.friend = friend
+
+    def queries(self, url):
+        with self.settings(QUERY_BUDGET_ENFORCE=False):
+            instrumentation.reset()
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return instrumentation._stats[response.resolver_match.url_name]['queries']
+
+    def test_budgets_do_not_grow(self):
+        """
+        The budgeted views run the same number of queries however much there is to show
+        """
+        self.add_content(1, 1, 1)
+        urls = lambda: [reverse("user_home"),
+                        reverse("show_albums", kwargs={'userid': self.friend.id}),
+                        reverse("getalbumsapi", kwargs={'userid': self.friend.id}),
+                        reverse("show_album", kwargs={'id': self.friendalbum.id}),
+                        reverse("getphotosapi", kwargs={'id': self.friendalbum.id})]
+        small = [self.queries(url) for url in urls()]
+
+        self.add_content(3, 3, 4)
+        large = [self.queries(url) for url in urls()]
+        self.assertEqual(small, large)
+
+        # and they are within budget
+        for url in urls():
+            self.client.get(url)
+
+    @override_settings(QUERY_BUDGET_ENFORCE=True)
+    def test_budget_enforced(self):
+        with mock.patch.dict(instrumentation.QUERY_BUDGETS, {'user_home': 1}):
+            with self.assertRaises(QueryBudgetExceeded):
+                self.client.get(reverse("user_home"))
+
+    @override_settings(QUERY_BUDGET_ENFORCE=False)
+    def test_budget_logged(self):
+        with mock.patch.dict(instrumentation.QUERY_BUDGETS, {'user_home': 1}):
+            with self.assertLogs('camelot.instrumentation', level='INFO') as logs:
+                response = self.client.get(reverse("user_home"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(logs.records[0].data['view'], "user_home")
+        self.assertEqual(logs.records[0].data['status'], 200)
+        assert any('its budget is 1' in line for line in logs.output)
+
+    @override_settings(METRICS_TOKEN="s3cret")
+    def test_metrics(self):
+        self.client.get(reverse("user_home"))
+        self.client.get(reverse("user_home"))
+        response = self.client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer s3cret")
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode('utf-8')
+        assert 'camelot_view_requests_total{view="user_home"} 2' in text
+        assert '# TYPE camelot_view_queries_total counter' in text
+
+        # not for the outside world, even when it arrives through the local reverse proxy
+        response = self.client.get(reverse("metrics"), REMOTE_ADDR='127.0.0.1')
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer guess")
+        self.assertEqual(response.status_code, 404)
+
+    def test_metrics_without_token(self):
+        # no scraper configured, an empty bearer token must not match
+        response = self.client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer ")
+        self.assertEqual(response.status_code, 404)
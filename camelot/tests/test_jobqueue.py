@@ -0,0 +1,41 @@
+from django.test import TestCase
+from ..jobqueue import SyncBackend, ProcessPoolBackend
+import threading
+
+
+def fail():
+    raise ValueError("job failed")
+
+
+class JobQueueTests(TestCase):
+
+    def test_sync_backend(self):
+        results = []
+        SyncBackend().submit(pow, 2, 10, on_success=results.append)
+        assert results == [1024]
+
+        # a failing job is logged, not raised, and only the failure callback runs
+        failures = []
+        SyncBackend().submit(fail, on_success=results.append, on_failure=failures.append)
+        assert results == [1024]
+        assert isinstance(failures[0], ValueError)
+
+    def test_process_pool_backend(self):
+        backend = ProcessPoolBackend(1)
+        results = []
+        done = threading.Event()
+
+        def callback(result):
+            results.append(result)
+            done.set()
+
+        try:
+            backend.submit(pow, 2, 10, on_success=callback)
+            assert done.wait(30)
+            done.clear()
+            backend.submit(fail, on_success=callback, on_failure=callback)
+            assert done.wait(30)
+        finally:
+            backend.executor.shutdown()
+        self.assertEqual(results[0], 1024)
+        assert isinstance(results[1], ValueError)
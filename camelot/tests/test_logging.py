@@ -1,6 +1,12 @@
-from ..logs import log_exception
+from ..logs import log_exception, JsonFormatter, QueueingFileHandler, RequestFilter, reset_request, set_request
+from django.contrib.auth.models import User
 from django.test import TestCase
+from django.test.client import RequestFactory
 from unittest import skip
+import json
+import logging
+import os
+import tempfile
 
 
 class LogTests(TestCase):
@@ -19,3 +25,53 @@ class LogTests(TestCase):
             lines = f.read().splitlines()
             last_line = lines[-2]
             assert last_line == "    1/0"
+
+    def test_log_exception_adds_no_handlers(self):
+        log = logging.getLogger(__name__)
+        handlers = list(log.handlers)
+        for i in range(3):
+            try:
+                1/0
+            except Exception as e:
+                assert log_exception(__name__, e)
+        self.assertEqual(log.handlers, handlers)
+
+    def test_queueing_file_handler(self):
+        """
+        Records are written as JSON lines by the listener thread, with the request they came from
+        """
+        with tempfile.TemporaryDirectory() as logdir:
+            filename = os.path.join(logdir, "test.log")
+            handler = QueueingFileHandler(filename, maxBytes=1024 * 1024, backupCount=1)
+            handler.setFormatter(JsonFormatter())
+            handler.addFilter(RequestFilter())
+            log = logging.getLogger("camelot.tests.queueing")
+            log.addHandler(handler)
+            try:
+                # nothing is opened until there is something to write
+                assert not os.path.exists(filename)
+
+                request = RequestFactory().get('/')
+                request.user = User(id=7)
+                tokens = set_request(request, "abc123")
+                try:
+                    log.warning("in a request", extra={'data': {'view': "test"}})
+                finally:
+                    reset_request(tokens)
+                log.warning("outside")
+            finally:
+                log.removeHandler(handler)
+                handler.close()
+
+            with open(filename) as f:
+                lines = [json.loads(line) for line in f]
+        self.assertEqual([line['message'] for line in lines], ["in a request", "outside"])
+        self.assertEqual((lines[0]['request_id'], lines[0]['user_id'], lines[0]['view']), ("abc123", 7, "test"))
+        self.assertEqual((lines[1]['request_id'], lines[1]['user_id']), (None, None))
+
+    def test_request_id(self):
+        response = self.client.get('/', HTTP_X_REQUEST_ID="proxy-id-1")
+        self.assertEqual(response['X-Request-ID'], "proxy-id-1")
+        # anything else is replaced
+        response = self.client.get('/', HTTP_X_REQUEST_ID="bad id\n")
+        self.assertRegex(response['X-Request-ID'], r'^[0-9a-f]{32}$')
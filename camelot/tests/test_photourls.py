@@ -0,0 +1,43 @@
+from django.test import TestCase
+from ..constants import PHOTO_PROCESSING, PHOTO_READY, SIGNED_PHOTO_URL_LIFETIME, SIGNED_PHOTO_URL_BUCKET
+from ..controllers.utilities import PermissionException
+from ..models import Photo
+from ..photourls import sign_photo_url, unsign_photo_token
+
+
+class PhotoUrlTests(TestCase):
+
+    def setUp(self):
+        self.photo = Photo(id=5, status=PHOTO_READY, checksum="ab" * 32)
+        self.now = 1700000000
+
+    def token(self, url):
+        return url.split("/")[-2]
+
+    def test_roundtrip(self):
+        url = sign_photo_url(self.photo, "thumb", now=self.now)
+        photoid, variant, checksum, expires = unsign_photo_token(self.token(url), now=self.now)
+        assert (photoid, variant) == (5, "thumb")
+        assert self.photo.checksum.startswith(checksum)
+        assert self.now + SIGNED_PHOTO_URL_LIFETIME < expires <= self.now + SIGNED_PHOTO_URL_LIFETIME + SIGNED_PHOTO_URL_BUCKET
+
+    def test_url_stable_within_bucket(self):
+        start = self.now - self.now % SIGNED_PHOTO_URL_BUCKET
+        assert sign_photo_url(self.photo, "mid", now=start) == \
+            sign_photo_url(self.photo, "mid", now=start + SIGNED_PHOTO_URL_BUCKET - 1)
+        assert sign_photo_url(self.photo, "mid", now=start) != \
+            sign_photo_url(self.photo, "mid", now=start + SIGNED_PHOTO_URL_BUCKET)
+
+    def test_expired(self):
+        token = self.token(sign_photo_url(self.photo, "thumb", now=self.now))
+        later = self.now + SIGNED_PHOTO_URL_LIFETIME + SIGNED_PHOTO_URL_BUCKET
+        self.assertRaises(PermissionException, unsign_photo_token, token, now=later)
+
+    def test_tampered(self):
+        token = self.token(sign_photo_url(self.photo, "thumb", now=self.now))
+        self.assertRaises(PermissionException, unsign_photo_token, token.replace("5.", "6.", 1), now=self.now)
+        self.assertRaises(PermissionException, unsign_photo_token, "garbage", now=self.now)
+
+    def test_processing_photo_not_signed(self):
+        self.photo.status = PHOTO_PROCESSING
+        assert sign_photo_url(self.photo, "thumb") == "/photo/5/thumb/"
@@ -0,0 +1,196 @@
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from io import StringIO
+import os
+import shutil
+import time
+from ..constants import UPLOAD_SESSION_DIR, UPLOAD_TEMP_DIR
+from ..controllers.albumcontroller import albumcontroller
+from ..models import FileTombstone, Photo, PhotoBlob
+from ..photostorage import get_store
+from ..reaper import reap_files, schedule_reap, sweep_orphans
+from ..view.usermgmt import activate_user_no_check
+
+
+def touch(path, age=0):
+    """
+    Create a file, last modified age seconds ago
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b"x")
+    os.utime(path, (time.time() - age, time.time() - age))
+
+
+@override_settings(FILE_REAPER="command")
+class ReaperTests(TestCase):
+
+    """
+    Deleting photos tombstones their files, the reaper deletes them
+    """
+
+    def setUp(self):
+        self.u = User.objects.create_user(username="reaper", email="reaper@test.com", password="secret")
+        activate_user_no_check(self.u)
+        self.albumcontrol = albumcontroller(self.u.id)
+        self.album = self.albumcontrol.create_album("reaper", "lalala")
+
+        self.testdir = "testdir"
+        os.makedirs(self.testdir, exist_ok=True)
+        os.chdir(self.testdir)
+
+    def tearDown(self):
+        os.chdir("..")
+        shutil.rmtree(self.testdir)
+
+    def legacy_photo(self, photoid):
+        """
+        A photo stored at the per user paths used before the photo store
+        """
+        paths = ["userphotos/1/{}/{}".format(self.album.id, photoid),
+                 "thumbs/1/{}/{}.jpg".format(self.album.id, photoid),
+                 "mid/1/{}/{}.jpg".format(self.album.id, photoid)]
+        for path in paths:
+            touch(path)
+        return Photo.objects.create(id=photoid, filename=paths[0], thumb=paths[1], midsize=paths[2],
+                                    album=self.album, uploader=self.u.profile, imgtype="image/jpeg")
+
+    def test_delete_records_tombstones(self):
+        photo = self.legacy_photo(5)
+        touch("userphotos/defaultprofile.png")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            assert self.albumcontrol.delete_photo(photo)
+
+        # nothing is deleted until the reaper runs
+        self.assertEqual(sorted(FileTombstone.objects.values_list('path', flat=True)),
+                         sorted([photo.filename, photo.thumb, photo.midsize]))
+        assert os.path.isfile(photo.filename)
+
+        self.assertEqual(reap_files(), 3)
+        assert not FileTombstone.objects.exists()
+        for path in (photo.filename, photo.thumb, photo.midsize):
+            assert not os.path.exists(path)
+        # the emptied album and user directories are gone, the top of each tree stays
+        for root in ("userphotos", "thumbs", "mid"):
+            assert not os.path.exists(root + "/1")
+            assert os.path.isdir(root)
+        assert os.path.isfile("userphotos/defaultprofile.png")
+
+    def test_reap_batches(self):
+        photos = [self.legacy_photo(i) for i in range(10, 15)]
+        other = "userphotos/1/{}/other".format(self.album.id)
+        touch(other)
+        with self.captureOnCommitCallbacks(execute=True):
+            assert self.albumcontrol.delete_album(self.album)
+        self.assertEqual(FileTombstone.objects.count(), 15)
+
+        # files already gone count as done
+        os.unlink(photos[0].thumb)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(reap_files(batch_size=4), 14)
+        # one delete per batch
+        self.assertEqual(sum(query['sql'].startswith("DELETE") for query in queries), 4)
+        assert not FileTombstone.objects.exists()
+        # directories still holding files are kept
+        assert os.path.isfile(other)
+        assert not os.path.exists("thumbs/1")
+
+    def album_of(self, names):
+        album = self.albumcontrol.create_album("reaper {}".format(len(names)), "lalala")
+        for name in names:
+            with open('../camelot/tests/resources/' + name, 'rb') as fi:
+                self.albumcontrol.add_photo_to_album(album.id, "", fi)
+        return album
+
+    def test_delete_album_in_bulk(self):
+        large = self.album_of(["testimage.jpg", "exifrotatedimg.jpg"] * 5)
+        small = self.album_of(["testimage.jpg"])
+        for i in range(40, 43):
+            self.legacy_photo(i)
+
+        with CaptureQueriesContext(connection) as queries:
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                assert self.albumcontrol.delete_album(large)
+        # the blobs of all ten photos are released together: a select, an update of the one still used by
+        # the small album and a delete of the other, and the reaper is scheduled once
+        self.assertEqual(len([query for query in queries if "camelot_photoblob" in query['sql']]), 3)
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(FileTombstone.objects.count(), 3)
+        self.assertEqual(PhotoBlob.objects.get().refcount, 1)
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            assert self.albumcontrol.delete_album(small)
+        self.assertEqual(len(callbacks), 1)
+        self.assertFalse(PhotoBlob.objects.exists())
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            assert self.albumcontrol.delete_album(self.album)
+        self.assertEqual(len(callbacks), 1)
+        # the originals and derivatives of both blobs, and the three files of each legacy photo
+        self.assertEqual(FileTombstone.objects.count(), 6 + 9)
+
+    def test_undeletable_file_keeps_tombstone(self):
+        os.makedirs("userphotos/1/1/7")
+        FileTombstone.objects.create(path="userphotos/1/1/7")
+        FileTombstone.objects.create(path="userphotos/1/1/8")
+        self.assertEqual(reap_files(batch_size=1), 0)
+        self.assertEqual(list(FileTombstone.objects.values_list('path', flat=True)), ["userphotos/1/1/7"])
+
+    def test_reupload_keeps_files(self):
+        with open('../camelot/tests/resources/testimage.jpg', 'rb') as fi:
+            photo = self.albumcontrol.add_photo_to_album(self.album.id, "first", fi)
+            assert self.albumcontrol.delete_photo(photo)
+            self.assertEqual(FileTombstone.objects.count(), 3)
+
+            # uploaded again before the reaper got to it
+            again = self.albumcontrol.add_photo_to_album(self.album.id, "again", fi)
+
+        assert not FileTombstone.objects.exists()
+        self.assertEqual(reap_files(), 0)
+        assert os.path.isfile(again.filename)
+        assert os.path.isfile(again.thumb)
+
+    def test_sweep_orphans(self):
+        with open('../camelot/tests/resources/testimage.jpg', 'rb') as fi:
+            photo = self.albumcontrol.add_photo_to_album(self.album.id, "kept", fi)
+        kept = self.legacy_photo(20)
+        for path in (photo.filename, photo.thumb, kept.filename, kept.thumb):
+            os.utime(path, (0, 0))
+
+        store = get_store()
+        orphans = [store.path("ab" * 32), store.path("ab" * 32, "thumb"), photo.thumb + ".tmp",
+                   "userphotos/1/{}/21".format(self.album.id), "mid/2/3/4.jpg", UPLOAD_TEMP_DIR + "/crashed.upload",
+                   UPLOAD_SESSION_DIR + "/{}.part".format("ef" * 16)]
+        for path in orphans:
+            touch(path, age=7200)
+        # too recent, may be an upload in progress
+        touch(store.path("cd" * 32), age=60)
+        touch("userphotos/defaultprofile.png", age=7200)
+
+        self.assertEqual(sorted(sweep_orphans(dry_run=True)), sorted(orphans))
+        assert not FileTombstone.objects.exists()
+
+        out = StringIO()
+        call_command('reapfiles', '--sweep', stdout=out)
+        assert "Found 7 orphaned files" in out.getvalue()
+        assert "Deleted 7 files" in out.getvalue()
+        for path in orphans:
+            assert not os.path.exists(path)
+        for path in (photo.filename, photo.thumb, kept.filename, kept.thumb, store.path("cd" * 32)):
+            assert os.path.isfile(path)
+
+    @override_settings(FILE_REAPER="sync")
+    def test_sync_reaper(self):
+        photo = self.legacy_photo(30)
+        with self.captureOnCommitCallbacks(execute=True):
+            assert self.albumcontrol.delete_photo(photo)
+        assert not os.path.exists(photo.filename)
+        assert not FileTombstone.objects.exists()
+
+    @override_settings(FILE_REAPER="nonsense")
+    def test_unknown_reaper(self):
+        self.assertRaises(ValueError, schedule_reap)
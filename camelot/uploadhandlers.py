@@ -0,0 +1,79 @@
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import TemporaryUploadedFile, UploadedFile
+from django.core.files.uploadhandler import SkipFile, TemporaryFileUploadHandler
+from django.template.defaultfilters import filesizeformat
+from io import BytesIO
+from os import makedirs, fsync
+from PIL import Image
+import hashlib
+import tempfile
+from .constants import MAX_UPLOAD_SIZE, UPLOAD_CHUNK_SIZE, UPLOAD_TEMP_DIR
+
+"""
+Stream photo uploads straight to disk
+The request body is written to a temporary file on the data partition in large chunks,
+the size limit and image header are checked as the data arrives so that we never hold
+a whole upload in memory
+"""
+
+
+class DataPartitionUploadedFile(TemporaryUploadedFile):
+    """
+    Temporary upload stored in UPLOAD_TEMP_DIR instead of the system temp directory,
+    so that add_photo_to_album() can rename it into place without copying
+    """
+    def __init__(self, name, content_type, size, charset, content_type_extra=None):
+        makedirs(UPLOAD_TEMP_DIR, exist_ok=True)
+        file = tempfile.NamedTemporaryFile(suffix=".upload", dir=UPLOAD_TEMP_DIR)
+        UploadedFile.__init__(self, file, name, content_type, size, charset, content_type_extra)
+
+
+class StreamingImageUploadHandler(TemporaryFileUploadHandler):
+    """
+    A file that fails the checks is skipped and kept in rejected as (file name, reason), for the view to report
+    Raising from here would escape CsrfViewMiddleware, which reads the body before the view is called
+    """
+    chunk_size = UPLOAD_CHUNK_SIZE
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.rejected = []
+
+    def new_file(self, *args, **kwargs):
+        super(TemporaryFileUploadHandler, self).new_file(*args, **kwargs)
+        self.file = DataPartitionUploadedFile(self.file_name, self.content_type, 0, self.charset,
+                                              self.content_type_extra)
+        self.digest = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        try:
+            if start + len(raw_data) > MAX_UPLOAD_SIZE:
+                raise ValidationError("Please keep file size under {}".format(filesizeformat(MAX_UPLOAD_SIZE)))
+
+            # the first chunk holds the image header, reject anything PIL does not recognise before we store the rest
+            if start == 0:
+                Image.open(BytesIO(raw_data)).close()
+        except ValidationError as e:
+            reason = e.messages[0]
+        except Exception:
+            reason = "Invalid image file"
+        else:
+            reason = None
+
+        if reason:
+            # closing the temporary file deletes it
+            self.file.close()
+            self.rejected.append((self.file_name, reason))
+            raise SkipFile()
+
+        self.digest.update(raw_data)
+        self.file.write(raw_data)
+
+    def file_complete(self, file_size):
+        # the file will be renamed into the photo store, make sure it is really on disk
+        self.file.flush()
+        fsync(self.file.fileno())
+        # sha256 of the contents, saves reading the file again to compute the photo checksum
+        self.file.sha256 = self.digest.hexdigest()
+        return super().file_complete(file_size)
+
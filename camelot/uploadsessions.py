@@ -0,0 +1,204 @@
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.template.defaultfilters import filesizeformat
+from django.utils import timezone
+from datetime import timedelta
+from fcntl import flock, LOCK_EX, LOCK_NB
+from os import fsync, makedirs, rename, unlink
+from os.path import isfile
+from PIL import Image
+from .constants import MAX_UPLOAD_SIZE, UPLOAD_CHUNK_SIZE, UPLOAD_SESSION_DIR, UPLOAD_SESSION_HEADER_BYTES, \
+    UPLOAD_SESSION_LIFETIME, UPLOAD_SESSION_MAX_CHUNK
+from .controllers.utilities import PermissionException
+from .datavalidation.validationfunctions import validate_image
+from .models import UploadSession
+
+"""
+Resumable uploads
+
+A client that may lose its connection uploads a photo in three steps:
+ - create_session() with the file name and size, after the usual album permission check
+ - write_chunk() for each piece of the file in order, a chunk can be sent again from the last
+   offset the server has, which the session reports, after a failure
+ - finalize_session() once every byte has arrived, the part file goes through the same
+   albumcontroller.add_photos_to_album() as any other upload and is renamed into the photo store
+Part files live in UPLOAD_SESSION_DIR on the data partition. Sessions not written to for
+UPLOAD_SESSION_LIFETIME are removed by expire_sessions(), run whenever a session is created
+and by manage.py reapfiles.
+"""
+
+
+class OffsetMismatch(Exception):
+    """
+    A chunk did not start where the data received so far ends
+    """
+    def __init__(self, expected):
+        super().__init__("Expected offset {}".format(expected))
+        self.expected = expected
+
+
+class SessionFile(File):
+    """
+    The finished part file, handed to add_photos_to_album() like an upload streamed to disk
+    so that it is renamed into the store rather than copied
+    """
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def _expiry():
+    return timezone.now() + timedelta(seconds=UPLOAD_SESSION_LIFETIME)
+
+
+def expire_sessions():
+    """
+    Delete the sessions not written to for UPLOAD_SESSION_LIFETIME, their part files go to the reaper
+    :return: number of sessions deleted
+    """
+    return UploadSession.objects.filter(expires__lt=timezone.now()).delete()[1].get(UploadSession._meta.label, 0)
+
+
+def create_session(albumcontrol, album, name, size):
+    """
+    Start a resumable upload
+    The caller must have checked that albumcontrol's user may add photos to album
+    :param albumcontrol: albumcontroller of the uploading user
+    :param album: album the photo will be added to
+    :param name: file name from the client
+    :param size: size of the whole file in bytes
+    :return: new UploadSession, raise ValidationError if the size is not acceptable
+    """
+    if not 0 < size <= MAX_UPLOAD_SIZE:
+        raise ValidationError("Please keep file size under {}".format(filesizeformat(MAX_UPLOAD_SIZE)))
+    expire_sessions()
+    makedirs(UPLOAD_SESSION_DIR, exist_ok=True)
+    session = UploadSession.objects.create(owner=albumcontrol.uprofile, album=album, name=name[:200], size=size,
+                                           expires=_expiry())
+    # an empty part file, chunks are written into it at their offsets
+    open(session.path, 'wb').close()
+    return session
+
+
+def get_session(albumcontrol, sessionid):
+    """
+    :param albumcontrol: albumcontroller of the uploading user
+    :param sessionid: id of the session
+    :return: the session, raise PermissionException if it is not the user's or no longer exists
+    """
+    try:
+        return UploadSession.objects.get(id=sessionid, owner=albumcontrol.uprofile, expires__gte=timezone.now())
+    except UploadSession.DoesNotExist:
+        raise PermissionException("No such upload session")
+
+
+def write_chunk(albumcontrol, sessionid, offset, length, stream, total=None):
+    """
+    Write one chunk of a resumable upload
+    The chunk is read from the client with no transaction open, a lock on the part file keeps two chunks
+    from being written at once and received is only moved forward if nothing else moved it meanwhile
+    :param albumcontrol: albumcontroller of the uploading user
+    :param sessionid: id of the session
+    :param offset: position of the chunk in the file
+    :param length: size of the chunk
+    :param stream: file like object to read the chunk from, read in UPLOAD_CHUNK_SIZE pieces
+    :param total: size of the whole file as given with the chunk, None if the client did not say
+    :return: the session, received is the offset of the next chunk,
+    raise OffsetMismatch if offset is not where the data so far ends or another chunk is being written
+    """
+    if not 0 < length <= UPLOAD_SESSION_MAX_CHUNK:
+        raise ValidationError("Please send chunks of at most {}".format(filesizeformat(UPLOAD_SESSION_MAX_CHUNK)))
+
+    session = get_session(albumcontrol, sessionid)
+    if total is not None and total != session.size:
+        raise ValidationError("File size does not match the upload session, expected {}".format(session.size))
+    if offset + length > session.size:
+        raise ValidationError("Chunk goes past the end of the file")
+
+    try:
+        f = open(session.path, 'r+b')
+    except FileNotFoundError:
+        # expired, or being finalized
+        raise PermissionException("No such upload session")
+
+    with f:
+        try:
+            flock(f.fileno(), LOCK_EX | LOCK_NB)
+        except BlockingIOError:
+            raise OffsetMismatch(session.received)
+
+        # another chunk may have been written between reading the session and taking the lock
+        session.refresh_from_db(fields=['received'])
+        if offset != session.received:
+            raise OffsetMismatch(session.received)
+
+        # anything after received is left over from a chunk that failed part way, overwrite it
+        f.seek(offset)
+        remaining = length
+        while remaining:
+            data = stream.read(min(remaining, UPLOAD_CHUNK_SIZE))
+            if not data:
+                break
+            f.write(data)
+            remaining -= len(data)
+        f.truncate()
+        # the received count must never get ahead of what is on disk
+        f.flush()
+        fsync(f.fileno())
+        received = f.tell()
+
+        # reject anything PIL does not recognise, like the upload handler, once enough has arrived to tell
+        checkat = min(session.size, UPLOAD_SESSION_HEADER_BYTES)
+        if offset < checkat <= received:
+            f.seek(0)
+            try:
+                Image.open(f).close()
+            except Exception:
+                f.truncate(0)
+                UploadSession.objects.filter(id=session.id, received=offset).update(received=0)
+                raise ValidationError("Invalid image file")
+
+        expires = _expiry()
+        # a single update, only moving received forward from where this chunk started
+        if not UploadSession.objects.filter(id=session.id, received=offset).update(received=received,
+                                                                                  expires=expires):
+            raise PermissionException("No such upload session")
+
+    session.received = received
+    session.expires = expires
+    return session
+
+
+def finalize_session(albumcontrol, sessionid, description=''):
+    """
+    Add the uploaded file to its album once every byte has arrived, and end the session
+    :param albumcontrol: albumcontroller of the uploading user
+    :param sessionid: id of the session
+    :param description: description of the photo
+    :return: the new photo, raise ValidationError if the file is incomplete or not a valid image
+    """
+    session = get_session(albumcontrol, sessionid)
+    if session.received != session.size:
+        raise ValidationError("Upload is incomplete, {} of {} bytes received".format(session.received, session.size))
+
+    # renaming the part file claims it, a second finalize of the same session finds nothing to rename
+    claimed = session.path + ".final"
+    try:
+        rename(session.path, claimed)
+    except FileNotFoundError:
+        raise ValidationError("Upload is already being finalized")
+
+    try:
+        validate_image(claimed)
+        with SessionFile(open(claimed, 'rb'), name=session.name) as fi:
+            photo = albumcontrol.add_photo_to_album(session.album_id, description, fi)
+    except Exception:
+        # give the file back to the session, it can be finalized again or expire
+        if isfile(claimed):
+            rename(claimed, session.path)
+        raise
+
+    session.delete()
+    # only left if the photo store already had the same contents
+    if isfile(claimed):
+        unlink(claimed)
+    return photo
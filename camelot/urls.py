@@ -2,7 +2,7 @@ from django.urls import path, re_path
 from django.conf.urls.static import static
 from django.conf import settings
 from django.contrib.auth import views as auth_views
-from .view import album, usermgmt, profile, friend, group
+from .view import album, usermgmt, profile, friend, group, internal
 from .view.api import albumapi
 
 urlpatterns = [
@@ -21,6 +21,7 @@ urlpatterns = [
     re_path(r'^photo/(?P<photoid>\d+)/$', album.return_photo_file_http, name="show_photo"),
     re_path(r'^photo/(?P<photoid>\d+)/thumb/$', album.return_photo_file_http, {'thumb': True}, name="show_thumb"),
     re_path(r'^photo/(?P<photoid>\d+)/fullsize/$', album.return_photo_file_http, {'mid': False}, name="show_photo_full"),
+    re_path(r'^photo/s/(?P<token>[\w.:\-]+)/$', album.return_signed_photo_file_http, name="show_signed_photo"),
     re_path(r'^profile/(?P<userid>\d+)/$', profile.show_profile, name="show_profile"),
     re_path(r'^space/(?P<username>[\w\-]+)/$', profile.show_profile_by_name, name="show_profile_name"),
     re_path(r'^profile/(?P<userid>\d+)/friends$', friend.view_friend_list, name="show_friends"),
@@ -37,10 +38,12 @@ urlpatterns = [
     re_path(r'^album/(?P<albumid>\d+)/add_groups$', album.add_groups, name="add_album_groups"),
     re_path(r'^album/(?P<albumid>\d+)/add_contributor$', album.add_contrib, name="add_album_contrib"),
     re_path(r'^album/(?P<photoid>\d+)/show_photo$', album.display_photo, name="present_photo"),
+    re_path(r'^album/photo/(?P<photoid>\d+)/set_cover$', album.set_album_cover, name="set_album_cover"),
     re_path(r'^profile/(?P<userid>\d+)/profilepic$', profile.return_raw_profile_pic, name="profile_pic"),
     re_path(r'^profile/photo/(?P<photoid>\d+)/set_profilepic$', profile.make_profile_pic, name="set_profile_pic"),
     re_path(r'^photo/(?P<photoid>\d+)/delete$', album.delete_photo, name="delete_photo"),
     re_path(r'^album/(?P<albumid>\d+)/delete$', album.delete_album, name="delete_album"),
+    re_path(r'^album/(?P<albumid>\d+)/download$', album.download_album, name="download_album"),
     re_path(r'^group/delete$', group.delete_group, name="delete_group"),
     path('search', friend.search, name="search"),
     re_path(r'^group/(?P<id>\d+)/manage$', group.manage_group, name="manage_group"),
@@ -51,9 +54,16 @@ urlpatterns = [
     re_path(r'^reset/(?P<uidb64>[0-9A-Za-z_\-]+)/(?P<token>[0-9A-Za-z]{1,13}-[0-9A-Za-z]{1,20})/$',
             auth_views.PasswordResetConfirmView.as_view(), name='password_reset_confirm'),
     re_path(r'^reset/done/$', auth_views.PasswordResetCompleteView.as_view(), name='password_reset_complete'),
+    path('internal/metrics', internal.metrics, name="metrics"),
 
     # the following are api end points
     re_path(r'^api/upload/(?P<id>\d+)$', albumapi.upload_photo, name='uploadphotoapi'),
+    re_path(r'^api/upload/(?P<id>\d+)/batch$', albumapi.upload_photos, name='uploadphotosapi'),
+    re_path(r'^api/upload/(?P<id>\d+)/session$', albumapi.create_upload_session, name='uploadsessionapi'),
+    re_path(r'^api/upload/session/(?P<sessionid>[0-9a-f\-]{32,36})$', albumapi.upload_session,
+            name='uploadsessionchunkapi'),
+    re_path(r'^api/upload/session/(?P<sessionid>[0-9a-f\-]{32,36})/finalize$', albumapi.finalize_upload_session,
+            name='finalizeuploadsessionapi'),
     re_path(r'^api/update/photo/desc/(?P<photoid>\d+)$', albumapi.update_photo_description, name='updatephotodescapi'),
     re_path(r'^api/(?P<userid>\d+)/getalbums$', album.display_albums, {'api': True}, name="getalbumsapi"),
     re_path(r'^api/album/(?P<id>\d+)/getphotos$', album.display_album, {'api': True}, name="getphotosapi"),
@@ -0,0 +1,151 @@
+import re
+import unicodedata
+from django.db import connection
+from django.db.models import F, FloatField, Func, Q, Value
+from django.db.models.functions import Greatest, Upper
+from .constants import SEARCH_PAGE_SIZE
+from .models import Friendship, Profile
+
+"""
+Profile search by display name and username
+
+Matching is a case and accent insensitive substring match, results are ranked by trigram similarity
+to the search string, best first.
+
+On postgres the match is answered by the GIN trigram indexes created in migration 0021, on the
+expression UPPER(camelot_unaccent(column)), and ranked with pg_trgm's similarity().
+On other databases (sqlite in development and the tests) the candidate rows are loaded and searched
+with TrigramIndex, which follows the same rules in python.
+"""
+
+
+def fold(text):
+    """
+    Fold a string for matching, strip accents and case
+    :param text: string to fold
+    :return: folded string
+    """
+    decomposed = unicodedata.normalize('NFKD', text)
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).upper()
+
+
+def trigrams(text):
+    """
+    Set of trigrams of a folded string, words are padded the way pg_trgm pads them
+    :param text: folded string
+    :return: set of three character strings
+    """
+    grams = set()
+    for word in re.findall(r'\w+', text):
+        padded = "  " + word + " "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def similarity(grams1, grams2):
+    """
+    Trigram similarity as computed by pg_trgm, shared trigrams over all trigrams
+    :param grams1: set of trigrams
+    :param grams2: set of trigrams
+    :return: float between 0 and 1
+    """
+    if not grams1 or not grams2:
+        return 0.0
+    return len(grams1 & grams2) / len(grams1 | grams2)
+
+
+class TrigramIndex:
+    """
+    In memory trigram index over (key, text, ...) rows, used when the database has no pg_trgm
+    """
+
+    def __init__(self, rows):
+        """
+        :param rows: iterable of tuples, the first item is the key, the rest are the texts to search
+        """
+        self.texts = {}
+        self.postings = {}
+        for key, *texts in rows:
+            folded = [fold(text) for text in texts]
+            self.texts[key] = [(text, trigrams(text)) for text in folded]
+            for text in folded:
+                # the substring trigrams, without word padding, narrow down substring matches
+                for i in range(len(text) - 2):
+                    self.postings.setdefault(text[i:i + 3], set()).add(key)
+
+    def search(self, searchstr):
+        """
+        Find the rows with a text containing the search string
+        :param searchstr: string to search for
+        :return: list of keys, most similar first
+        """
+        query = fold(searchstr)
+        if len(query) >= 3:
+            candidates = set.intersection(*(self.postings.get(query[i:i + 3], set())
+                                            for i in range(len(query) - 2)))
+        else:
+            candidates = self.texts.keys()
+
+        querygrams = trigrams(query)
+        ranked = []
+        for key in candidates:
+            texts = self.texts[key]
+            if any(query in text for text, _ in texts):
+                rank = max(similarity(querygrams, grams) for _, grams in texts)
+                ranked.append((-rank, key))
+        ranked.sort()
+        return [key for _, key in ranked]
+
+
+class Unaccent(Func):
+    # immutable wrapper around unaccent(), created in migration 0021 so it can be indexed
+    function = 'camelot_unaccent'
+
+
+class Similarity(Func):
+    function = 'similarity'
+    output_field = FloatField()
+
+
+def _pgsearch(profiles, searchstr, limit, offset):
+    """
+    Search with the pg_trgm indexes
+    """
+    pattern = fold(searchstr)
+    dname = Upper(Unaccent(F('dname')))
+    username = Upper(Unaccent(F('user__username')))
+    # the filters must spell out the indexed expressions for the planner to use the indexes
+    profiles = profiles.annotate(dnamekey=dname, usernamekey=username)\
+        .filter(Q(dnamekey__contains=pattern) | Q(usernamekey__contains=pattern))\
+        .annotate(rank=Greatest(Similarity(dname, Value(pattern)), Similarity(username, Value(pattern))))
+    return list(profiles.order_by('-rank', 'user__username')[offset:offset + limit])
+
+
+def _fallbacksearch(profiles, searchstr, limit, offset):
+    """
+    Search with a TrigramIndex built from the candidate rows
+    """
+    index = TrigramIndex(profiles.values_list('id', 'dname', 'user__username'))
+    ids = index.search(searchstr)[offset:offset + limit]
+    found = profiles.in_bulk(ids)
+    return [found[profileid] for profileid in ids]
+
+
+def search_profiles(searchstr, exclude_friends_of=None, limit=None, offset=0):
+    """
+    Find profiles by display name or username
+    :param searchstr: string to search for
+    :param exclude_friends_of: profile whose confirmed friends are left out of the results
+    :param limit: maximum number of results, defaults to SEARCH_PAGE_SIZE
+    :param offset: number of results to skip, for paging
+    :return: list of profiles, best match first, with their users joined in
+    """
+    if limit is None:
+        limit = SEARCH_PAGE_SIZE
+    profiles = Profile.objects.select_related('user')
+    if exclude_friends_of is not None:
+        profiles = profiles.exclude(id__in=Friendship.objects.friend_ids(exclude_friends_of))
+
+    if connection.vendor == 'postgresql':
+        return _pgsearch(profiles, searchstr, limit, offset)
+    return _fallbacksearch(profiles, searchstr, limit, offset)
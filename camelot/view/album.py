@@ -1,19 +1,25 @@
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.shortcuts import render, redirect
-from django.http import HttpResponse, Http404, JsonResponse
+from django.http import HttpResponse, Http404, JsonResponse, StreamingHttpResponse
 from django.forms import MultipleChoiceField
-from django.views.decorators.http import etag
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.template.loader import render_to_string
-from random import randint
+from django.utils.http import content_disposition_header
+import os
+import time
 from ..controllers.albumcontroller import albumcontroller, collate_owner_and_contrib
-from ..controllers.friendcontroller import are_friends
+from ..controllers.groupcontroller import album_group_ids
 from ..controllers.utilities import PermissionException
 from ..forms import AlbumCreateForm, EditAlbumAccesstypeForm, MyGroupSelectForm, AddContributorForm, DeleteConfirmForm
 from ..constants import *
 from ..controllers.utilities import *
+from ..albumarchive import stream_album_zip
+from ..friendfeed import refresh_album_feed
 from ..models import Profile, FriendGroup, Photo
 from ..logs import log_exception
+from ..filedelivery import serve_file
+from ..photourls import sign_photo_url, unsign_photo_token
 
 #def album_perm_check(func):
 #    """
@@ -69,16 +75,16 @@ def display_albums(request, userid, api=False):
     albumcontrol = albumcontroller(request.user.id)
 
     # get albums
-    albums = albumcontrol.return_albums(userid)
-    contrib = albumcontrol.return_albums(userid, contrib=True)
+    albums = albumcontrol.return_albums(userid, covers=not api)
+    contrib = albumcontrol.return_albums(userid, contrib=True, covers=not api)
 
-    # get an image for each album
-    for album in (albums+contrib):
-        photos = albumcontrol.get_photos_for_album(album)
-        if len(photos) > 0:
+    # get an image for each album, return_albums() has checked we may view them
+    if not api:
+        albumcontrol.load_covers(albums + contrib)
+        for album in (albums+contrib):
             # we check if this exists in the template and if not, render a default image
-            randindex = randint(0, len(photos)-1)
-            album.temp = photos[randindex].id
+            if album.coverphoto is not None:
+                album.cover_url = sign_photo_url(album.coverphoto, "thumb")
 
     # create dictionary to render
     retdict = {}
@@ -104,46 +110,51 @@ def display_albums(request, userid, api=False):
 
 def display_album(request, id, contribid=None, api=False):
     """
-    Display photos for album
+    Display photos for album, one page at a time
+    The GET parameter 'after' is the cursor of the page to show, it is returned as 'next' by the api
+    and in the X-Next-Cursor header when html pages are loaded by showalbum.html
     :param request:
     :param id: id of album (need to validate permissions)
     :param contribid: if we reached the page from a contributor's show albums page, back nav to contributor
     :param api: boolean for if we return a json response or not
     :return:
     """
+    if api and request.method != 'GET':
+        raise Http404
 
     albumcontrol = albumcontroller(request.user.id)
     album = albumcontrol.return_album(id)
-    # query db for photos in album
-    photos = list(albumcontrol.get_photos_for_album(album))
+    # query db for a page of photos in album
+    photos, nextcursor = albumcontrol.get_photos_page(album, after=request.GET.get('after'))
 
     # return for api
     if api:
-        if request.method == 'GET':
-            retdict = {}
-            retdict['photos'] = [{'id': photo.id, 'description': photo.description, 'pub_date': photo.pub_date, 'type': photo.imgtype } for photo in photos]
+        retdict = {}
+        retdict['photos'] = [{'id': photo.id, 'description': photo.description, 'pub_date': photo.pub_date, 'type': photo.imgtype } for photo in photos]
+        retdict['next'] = nextcursor
 
-            return JsonResponse(retdict, status=200)
-        else:
-            raise Http404
+        return JsonResponse(retdict, status=200)
 
     # return for html rendering
     else:
+        # do we allow description editing or not?
+        albumcontrol.set_desc_edit_perm(album, photos)
+        for photo in photos:
+            # get_photos_page() has checked that we may view the album, mint the cacheable url once here
+            photo.thumb_url = sign_photo_url(photo, "thumb")
+
+        # later pages are appended to the gallery by javascript
+        if 'after' in request.GET:
+            response = render(request, 'camelot/albumphotos.html', {'photos': photos})
+            response['X-Next-Cursor'] = nextcursor or ''
+            return response
+
         # for back link navigation to contributors
         # if the id provided is not valid, set to the album owner
         if not contribid or int(contribid) not in [x.id for x in collate_owner_and_contrib(album)]:
-            contribid = album.owner.id
+            contribid = album.owner_id
 
-        # do we allow description editing or not?
-        for photo in photos:
-            try:
-                albumcontrol.check_permission_to_update_photo_description(photo)
-                photo.desc_edit_perm = True
-            except PermissionException:
-                photo.desc_edit_perm = False
-                continue
-
-        retdict = {'photos': photos, 'album': album, 'contribid': contribid}
+        retdict = {'photos': photos, 'album': album, 'contribid': contribid, 'next': nextcursor}
 
         return render(request, 'camelot/showalbum.html', retdict)
 
@@ -164,20 +175,73 @@ def display_photo(request, photoid):
     if not albumcontrol.has_permission_to_view(photo.album):
         raise PermissionException
 
-    albumphotos = albumcontrol.get_photos_for_album(photo.album)
+    previous, following = albumcontrol.get_photo_neighbours(photo)
 
-    # find index of our photo in the queryset
-    i = list(albumphotos.values_list('id', flat=True)).index(int(photoid))
+    # the browser prefetches the neighbouring mid size images so flipping through the album is instant
+    neighbours = Photo.objects.only('id', 'status', 'checksum').in_bulk({previous, following} - {photo.id})
 
     retdict = {
-        'next': albumphotos[i+1].id if i < (len(albumphotos) - 1) else albumphotos[0].id,
-        'previous': albumphotos[i-1].id if i > 0 else albumphotos[(len(albumphotos)-1)].id,
-        'photo': photo
+        'next': following,
+        'previous': previous,
+        'photo': photo,
+        'mid_url': sign_photo_url(photo, "mid"),
+        'prefetch_urls': [sign_photo_url(neighbour, "mid") for neighbour in neighbours.values()]
     }
 
     return render(request, 'camelot/presentphoto.html', retdict)
 
 
+def return_signed_photo_file_http(request, token):
+    """
+    Serve a thumbnail or mid size image from a url minted by photourls.sign_photo_url()
+    The permission check happened when the url was minted, the signature and expiry are all we check here
+    :param request:
+    :param token: signed token from the url
+    :return: the image, cacheable by the browser until the url expires
+    """
+    photoid, variant, checksum, expires = unsign_photo_token(token)
+
+    try:
+        photo = Photo.objects.only('thumb', 'midsize', 'checksum', 'pub_date').get(id=photoid)
+    except Photo.DoesNotExist:
+        # deleted since the url was minted
+        raise PermissionException
+    if not photo.checksum.startswith(checksum):
+        raise PermissionException
+
+    etag = make_photo_etag(photo, variant)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        try:
+            response = serve_file(photo.thumb if variant == "thumb" else photo.midsize, "image/jpeg",
+                                  request=request, etag=etag)
+        except FileNotFoundError:
+            # the derivative is not generated yet, or was reaped along with the last photo using it
+            raise PermissionException
+    else:
+        response['ETag'] = etag
+
+    patch_cache_control(response, private=True, immutable=True, max_age=max(int(expires - time.time()), 0))
+    return response
+
+
+@login_required
+def set_album_cover(request, photoid):
+    """
+    Use a photo as the cover of its album
+    Like make_profile_pic this is a GET for now
+    :param request:
+    :param photoid: id of the photo to use
+    :return: redirect to the photo
+    """
+    albumcontrol = albumcontroller(request.user.id)
+    photo = albumcontrol.return_photo(photoid)
+    if albumcontrol.set_album_cover(photo):
+        return redirect("present_photo", photoid)
+    else:
+        raise PermissionException
+
+
 @login_required
 def add_photo(request, id):
     """
@@ -201,28 +265,25 @@ def add_photo(request, id):
     return render(request, 'camelot/uploadphoto.html', {'albumid': id})
 
 
-def make_photo_etag(request, *args, **kwargs):
+def make_photo_etag(photo, variant):
     """
-    Permission check and return etag for photo
-    :param request:
-    :param args:
-    :param kwargs:
-    :return: etag if has permission, else raise PermissionException
+    Return etag for one rendition of a photo
+    Photos never change once uploaded, so the hash of the original plus the rendition is a strong validator
+    :param photo: photo object
+    :param variant: which file we serve, "thumb", "mid" or "full"
+    :return: quoted etag
     """
-    photoid = kwargs.get('photoid')
-    albumcontrol = albumcontroller(request.user.id)
-    photo = albumcontrol.return_photo(int(photoid))
-    if not albumcontrol.has_permission_to_view(photo.album):
-        raise PermissionException
-    else:
-        return str(photo.pub_date)
+    if photo.checksum:
+        return '"{}-{}"'.format(photo.checksum, variant)
+    # photos whose original went missing before checksums existed
+    return 'W/"{}-{}"'.format(photo.pub_date.timestamp(), variant)
 
 
-@etag(make_photo_etag)
 def return_photo_file_http(request, photoid, thumb=False, mid=True):
     """
     wrapper to securely show a photo without exposing externally
     We must ensure the security of photo.filename, because if this can be messed with our whole filesystem could be vulnerable
+    Supports conditional requests (ETag, Last-Modified) and single byte Range requests
     :param request:
     :param photoid: id of photo
     :param thumb: If true display thumbnail image
@@ -230,28 +291,49 @@ def return_photo_file_http(request, photoid, thumb=False, mid=True):
     If both thumb and mid are false, display full size image
     :return:
     """
-    # Permission check moved to make_photo_etag()
-    # and the next two lines just got redundant... double db queries...
     albumcontrol = albumcontroller(request.user.id)
-    photo = albumcontrol.return_photo(photoid)
+    photo = albumcontrol.return_photo(int(photoid))
 
     # default to rendering midsize image
     name = photo.midsize
+    variant = "mid"
     # todo: handle conversion to jpeg of existing images in migration
     mime = "image/jpeg"
     if thumb:
         name = photo.thumb
+        variant = "thumb"
     elif not mid:
         name = photo.filename
+        variant = "full"
         mime = photo.imgtype
 
-    # we might want to enclose these withs in a try except block, but for now it is ok like this
-    #try:
-    with open(name, "rb") as f:
-        return HttpResponse(f.read(), content_type=mime)
-    # if we don't have a thumb, pass the whole image - it's an option
-    #except FileNotFoundError:
-        # todo: log
+    # derivatives are still being generated, the original is the best we have for now
+    # the variant is part of the etag so that browsers drop the original once the derivative exists
+    if photo.status != PHOTO_READY:
+        name = photo.filename
+        variant = "full"
+        mime = photo.imgtype
+
+    etag = make_photo_etag(photo, variant)
+
+    # a client presenting the strong etag already holds the file, so we can answer 304 without the permission check
+    if photo.checksum and 'HTTP_IF_NONE_MATCH' in request.META:
+        response = get_conditional_response(request, etag=etag)
+        if response is not None and response.status_code == 304:
+            response['ETag'] = etag
+            return response
+
+    if not albumcontrol.has_permission_to_view(photo.album):
+        raise PermissionException
+
+    last_modified = os.stat(name).st_mtime
+    response = get_conditional_response(request, etag=etag, last_modified=int(last_modified))
+    if response is not None:
+        if response.status_code == 304:
+            response['ETag'] = etag
+        return response
+
+    return serve_file(name, mime, request=request, etag=etag, last_modified=last_modified)
 
 
 @login_required
@@ -402,20 +484,20 @@ def add_groups(request, albumid):
         form = MyGroupSelectForm(request.user.id, MultipleChoiceField, request.POST)
 
         if form.is_valid():
-            groups = [FriendGroup.objects.get(id=int(x)) for x in form.cleaned_data['idname']]
+            # the album's groups are looked up once, not once per selected group
+            existing = album_group_ids([album])[album.id]
+            groups = FriendGroup.objects.filter(id__in=[int(x) for x in form.cleaned_data['idname']])\
+                .exclude(id__in=existing)
             for g in groups:
-                # redundant
                 # ok, error checking is in controller, let's let it do it's job
-                #if albumcontrol.uprofile != g.owner:
-                #    raise PermissionException
-                if g in album.groups.all():
-                    continue
-                else:
-                    try:
-                        # this assert may need to be handled at a higher level depending on what django does
-                        assert albumcontrol.add_group_to_album(album, g)
-                    except Exception as e:
-                        raise PermissionException
+                try:
+                    # this assert may need to be handled at a higher level depending on what django does
+                    assert albumcontrol.add_group_to_album(album, g, refresh_feed=False)
+                except Exception as e:
+                    raise PermissionException
+            # the feed is recomputed once for all the new groups
+            if groups:
+                refresh_album_feed(album)
 
         return redirect("manage_album", album.id)
 
@@ -444,17 +526,19 @@ def add_contrib(request, albumid):
         if form.is_valid():
             # should this db query be in a controller?  for now we will leave it as this
             contributors = [Profile.objects.get(id=int(x)) for x in form.cleaned_data['idname']]
+            # redundant with add_contributor_to_album() ?
+            if len(albumcontrol.friendgraph.friends_among(albumcontrol.uprofile, contributors)) != len(contributors):
+                raise PermissionException
+            added = False
             for c in contributors:
-                # redundant with add_contributor_to_album() ?
-                if not are_friends(c, albumcontrol.uprofile):
-                    raise PermissionException
 
                 if c in album.contributors.all():
                     continue
                 else:
                     try:
                         # this assert may need to be handled at a higher level depending on what django does
-                        assert albumcontrol.add_contributor_to_album(album, c)
+                        assert albumcontrol.add_contributor_to_album(album, c, refresh_feed=False)
+                        added = True
 
                         # notify the new contributor
                         try:
@@ -476,6 +560,10 @@ def add_contrib(request, albumid):
                     except Exception as e:
                         raise e
 
+            # the feed is recomputed once for all the new contributors
+            if added:
+                refresh_album_feed(album)
+
         return redirect("manage_album", album.id)
 
     # if not a post, we 404
@@ -483,4 +571,20 @@ def add_contrib(request, albumid):
 
 
 def download_album(request, albumid):
-    pass
+    """
+    Download every original photo of an album as a zip, with a manifest of names and descriptions
+    The archive is streamed while it is generated, see albumarchive.py
+    :param request:
+    :param albumid: id of the album
+    :return: streaming response with the zip
+    """
+    if request.method != 'GET':
+        raise Http404
+
+    albumcontrol = albumcontroller(request.user.id)
+    # permission is checked once here, the archive reads the photos of the album directly
+    album = albumcontrol.return_album(albumid)
+
+    response = StreamingHttpResponse(stream_album_zip(album), content_type="application/zip")
+    response['Content-Disposition'] = content_disposition_header(True, "{}.zip".format(album.name))
+    return response
@@ -1,14 +1,37 @@
 from django.http import HttpResponse, JsonResponse
 import json
-import io
+import re
 from django.contrib.auth.decorators import login_required
+from django.core.exceptions import ValidationError
 from django.http.response import Http404
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from ...constants import PHOTO_READY, UPLOAD_BATCH_MAX_FILES, UPLOAD_SESSION_MAX_CHUNK
 from ...controllers.albumcontroller import albumcontroller, collate_owner_and_contrib
 from ...controllers.utilities import *
 from ...datavalidation.validationfunctions import *
+from ...uploadhandlers import StreamingImageUploadHandler
+from ...uploadsessions import OffsetMismatch, create_session, finalize_session, get_session, write_chunk
 
+# Content-Range of a chunk of a resumable upload, the total may be left out as *
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
 
-@login_required
+
+def return_album_controller(userid, albumid):
+    """
+    Controller for a user who may add photos to an album
+    :param userid: id of the uploading user
+    :param albumid: id of the album
+    :return: albumcontroller, raise PermissionException if the user is not the album owner or a contributor
+    """
+    albumcontrol = albumcontroller(userid)
+    album = albumcontrol.return_album(albumid)
+    uploaders = collate_owner_and_contrib(album)
+    if albumcontrol.uprofile not in uploaders or albumcontrol.uprofile is None:
+        raise PermissionException
+    return albumcontrol
+
+
+@csrf_exempt
 def upload_photo(request, id):
     """
     Upload photo via API
@@ -17,24 +40,27 @@ def upload_photo(request, id):
     :param id: id of album to upload to
     :return: json response with id of photo
     """
+    # must be swapped in before anything reads the request body, csrf is checked afterwards by _upload_photo()
+    request.upload_handlers = [StreamingImageUploadHandler(request)]
+    return _upload_photo(request, id)
 
-    if request.method == 'POST':
 
-        def return_album_controller(userid, albumid):
-            albumcontrol = albumcontroller(userid)
-            album = albumcontrol.return_album(albumid)
-            uploaders = collate_owner_and_contrib(album)
-            if albumcontrol.uprofile not in uploaders or albumcontrol.uprofile is None:
-                raise PermissionException
-            return albumcontrol
+@csrf_protect
+@login_required
+def _upload_photo(request, id):
+    if request.method == 'POST':
 
         albumcontrol = return_album_controller(request.user.id, id)
 
-        rawimg = io.BytesIO()
-        rawimg.write(request.FILES['image'].read())
+        # the upload handler has streamed the image to a temporary file on disk,
+        # checking the size limit and image header on the way
+        rejected = request.upload_handlers[0].rejected
+        if rejected:
+            raise ValidationError(rejected[0][1])
+        rawimg = request.FILES.get('image')
+        if rawimg is None:
+            raise ValidationError("No image uploaded")
 
-        # todo: validate image, running into issues using bytesio object, no attrib size
-        # validate size
         # validate is image -> http://effbot.org/imagingbook/image.htm#tag-Image.Image.verify
         validate_image(rawimg)
 
@@ -45,6 +71,146 @@ def upload_photo(request, id):
         raise Http404
 
 
+@csrf_exempt
+def upload_photos(request, id):
+    """
+    Upload several photos via API in one request
+    Accept POSTed multipart request with up to UPLOAD_BATCH_MAX_FILES fields 'images' of raw image data
+    Files that are not valid images are rejected one by one, the rest are added to the album together
+    :param request:
+    :param id: id of album to upload to
+    :return: json response {"photos": [{"name", "id", "status"}], "rejected": [{"name", "error"}]},
+    201 if any photo was added, 400 if none
+    """
+    # must be swapped in before anything reads the request body, csrf is checked afterwards by _upload_photos()
+    request.upload_handlers = [StreamingImageUploadHandler(request)]
+    return _upload_photos(request, id)
+
+
+@csrf_protect
+@login_required
+def _upload_photos(request, id):
+    if request.method != 'POST':
+        raise Http404
+
+    albumcontrol = albumcontroller(request.user.id)
+    # raise PermissionException before looking at the files if the user can't see the album,
+    # whether they may add to it is checked once for the whole batch by add_photos_to_album()
+    albumcontrol.return_album(id)
+
+    images = request.FILES.getlist('images')
+    rejected = [{"name": name, "error": reason} for name, reason in request.upload_handlers[0].rejected]
+    if len(images) + len(rejected) > UPLOAD_BATCH_MAX_FILES:
+        raise ValidationError("Please send at most {} photos at once".format(UPLOAD_BATCH_MAX_FILES))
+
+    uploads = []
+    for image in images:
+        try:
+            validate_image(image)
+        except ValidationError as e:
+            rejected.append({"name": image.name, "error": e.messages[0]})
+        else:
+            uploads.append(image)
+
+    photos = albumcontrol.add_photos_to_album(id, [('', image) for image in uploads]) if uploads else []
+    results = [{"name": image.name, "id": photo.id,
+                "status": "ready" if photo.status == PHOTO_READY else "processing"}
+               for image, photo in zip(uploads, photos)]
+    return JsonResponse({"photos": results, "rejected": rejected}, status=201 if photos else 400)
+
+
+def upload_session_status(session):
+    """
+    :param session: UploadSession
+    :return: dict describing a resumable upload for the client, offset is where the next chunk must start
+    """
+    return {"id": str(session.id), "offset": session.received, "size": session.size,
+            "chunk_size": UPLOAD_SESSION_MAX_CHUNK, "expires": session.expires.isoformat()}
+
+
+@login_required
+def create_upload_session(request, id):
+    """
+    Start a resumable upload to an album, see uploadsessions.py
+    Accept POSTed json {"name": file name, "size": size of the file in bytes}
+    :param request:
+    :param id: id of album to upload to
+    :return: json response with the session, see upload_session_status(), 201 on success
+    """
+    if request.method != 'POST':
+        raise Http404
+
+    albumcontrol = return_album_controller(request.user.id, id)
+    try:
+        data = json.loads(request.body.decode('utf8'))
+        name = str(data['name'])
+        size = int(data['size'])
+    except (ValueError, KeyError, TypeError):
+        raise ValidationError("File name and size are required")
+
+    session = create_session(albumcontrol, albumcontrol.return_album(id), name, size)
+    return JsonResponse(upload_session_status(session), status=201)
+
+
+@login_required
+def upload_session(request, sessionid):
+    """
+    A resumable upload
+    GET: the state of the upload, a client that lost its connection resumes from the offset
+    PUT: the next chunk of the file as the raw request body, with a header Content-Range: bytes first-last/size
+    DELETE: abandon the upload
+    :param request:
+    :param sessionid: id of the session
+    :return: json response with the session, see upload_session_status(),
+    409 if a chunk does not start at the offset, 204 on DELETE
+    """
+    albumcontrol = albumcontroller(request.user.id)
+
+    if request.method == 'GET':
+        return JsonResponse(upload_session_status(get_session(albumcontrol, sessionid)))
+
+    elif request.method == 'PUT':
+        match = CONTENT_RANGE_RE.match(request.META.get('HTTP_CONTENT_RANGE', ''))
+        if not match or int(match.group(2)) < int(match.group(1)):
+            raise ValidationError("A Content-Range header is required")
+        first, last = int(match.group(1)), int(match.group(2))
+        total = None if match.group(3) == '*' else int(match.group(3))
+        try:
+            # the body is read from the request in pieces, never held in memory at once
+            session = write_chunk(albumcontrol, sessionid, first, last - first + 1, request, total)
+        except OffsetMismatch:
+            return JsonResponse(upload_session_status(get_session(albumcontrol, sessionid)), status=409)
+        return JsonResponse(upload_session_status(session))
+
+    elif request.method == 'DELETE':
+        get_session(albumcontrol, sessionid).delete()
+        return HttpResponse(status=204)
+
+    raise Http404
+
+
+@login_required
+def finalize_upload_session(request, sessionid):
+    """
+    Add the file of a finished resumable upload to its album
+    Accept POSTed json {"description": description of the photo}, or no body
+    :param request:
+    :param sessionid: id of the session
+    :return: json response with id and status of the photo, 201 on success
+    """
+    if request.method != 'POST':
+        raise Http404
+
+    description = ''
+    if request.content_type == 'application/json':
+        data = json.loads(request.body.decode('utf8'))
+        description = validate_photo_description(data.get('description', ''))
+
+    photo = finalize_session(albumcontroller(request.user.id), sessionid, description)
+    return JsonResponse({"id": photo.id, "status": "ready" if photo.status == PHOTO_READY else "processing"},
+                        status=201)
+
+
 @login_required
 def update_photo_description(request, photoid):
     """
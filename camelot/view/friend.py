@@ -2,6 +2,7 @@ from django.contrib.auth.decorators import login_required
 from django.shortcuts import render, redirect
 from ..controllers.friendcontroller import friendcontroller
 from ..controllers.utilities import get_profile_from_uid, AlreadyExistsException, AddSelfException
+from ..constants import SEARCH_PAGE_SIZE
 from ..forms import SearchForm
 
 @login_required
@@ -76,6 +77,10 @@ def search(request):
         if form.is_valid():
             friendcontrol = friendcontroller(request.user.id)
             searchtext = form.cleaned_data['searchtext']
-            results = friendcontrol.findfriends(searchtext)
-            retdict = {'results': results}
+            offset = form.cleaned_data['offset'] or 0
+            results = friendcontrol.findfriends(searchtext, offset=offset)
+            retdict = {'results': results, 'searchtext': searchtext}
+            # a full page means there may be more
+            if len(results) == SEARCH_PAGE_SIZE:
+                retdict['nextoffset'] = offset + SEARCH_PAGE_SIZE
             return render(request, 'camelot/searchresults.html', retdict)
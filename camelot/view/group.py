@@ -4,8 +4,8 @@ from django.forms import ChoiceField, MultipleChoiceField
 from django.http import Http404
 from django.contrib import messages
 
-from ..controllers.groupcontroller import groupcontroller, is_in_group, return_group_from_id
-from ..controllers.friendcontroller import are_friends
+from ..controllers.groupcontroller import groupcontroller, is_in_group, is_in_groups, return_group_from_id
+from ..requestcontext import request_friendgraph
 from ..controllers.utilities import get_profile_from_uid, AlreadyExistsException
 from ..forms import AddGroupForm, MyGroupSelectForm, ManageGroupMemberForm
 
@@ -151,8 +151,7 @@ def add_friend_to_group(request, userid):
     :return:
     """
     # check that the users are at least pending friends before rendering
-    if not (are_friends(get_profile_from_uid(request.user.id), get_profile_from_uid(userid), confirmed=True) \
-            or are_friends(get_profile_from_uid(request.user.id), get_profile_from_uid(userid), confirmed=False)):
+    if not request_friendgraph().are_friends_or_pending(get_profile_from_uid(request.user.id), get_profile_from_uid(userid)):
         raise Http404
 
     if request.method == 'POST':
@@ -165,9 +164,9 @@ def add_friend_to_group(request, userid):
 
             # list of group ids
             groups = [int(x) for x in form.cleaned_data['idname']]
+            alreadyin = is_in_groups(groups, profile)
             for groupid in groups:
-                group = return_group_from_id(groupid)
-                if is_in_group(group, profile):
+                if groupid in alreadyin:
                     pass
                 else:
                     try:
@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.http import Http404, HttpResponse
+from django.utils.crypto import constant_time_compare
+from ..instrumentation import prometheus_text
+
+
+def metrics(request):
+    """
+    Per view query counts and timings in the prometheus text format
+    Only for staff users and scrapers sending "Authorization: Bearer <METRICS_TOKEN>", everyone else gets a 404
+    The client address is not trusted, behind the reverse proxy every request comes from the proxy
+    :param request:
+    :return: text/plain response
+    """
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    authorized = token and constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), "Bearer " + token)
+    if not authorized and not request.user.is_staff:
+        raise Http404
+    return HttpResponse(prometheus_text(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -7,6 +7,7 @@ from ..controllers.utilities import PermissionException, get_profile_from_uid, g
 
 from ..forms import EditProfileForm
 from ..constants import PREFIX
+from ..filedelivery import serve_file
 
 
 def show_profile(request, userid):
@@ -63,9 +64,8 @@ def return_raw_profile_pic(request, userid):
     else:
         fname = PREFIX + "userphotos/defaultprofile.png"
 
-    with open(fname, "rb") as f:
-        # todo: check that this still works with default image
-        return HttpResponse(f.read(), content_type="image/jpeg")
+    # todo: check that this still works with default image
+    return serve_file(fname, "image/jpeg")
 
 
 @login_required
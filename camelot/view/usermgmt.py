@@ -16,6 +16,7 @@ from ..friendfeed import generate_feed
 from ..controllers.profilecontroller import profilecontroller
 from ..user_emailing import send_registration_email
 from ..logs import log_exception
+from ..constants import FEED_LENGTH
 import requests
 
 
@@ -67,7 +68,7 @@ def user_home(request):
     retdict = {
         "pendingreqs": len(friendcontroller(request.user.id).return_pending_requests()),
         "searchform": SearchForm(),
-        "feed": generate_feed(pcontrol)[:15]
+        "feed": generate_feed(pcontrol, limit=FEED_LENGTH)
     }
     return render(request, 'camelot/home.html', retdict)
 
@@ -49,6 +49,9 @@ After=network.target
 User=$USER
 Group=www-data
 WorkingDirectory=/home/$USER/camelot
+Environment=JOB_QUEUE_BACKEND=process
+Environment=FILE_DELIVERY_BACKEND=x-accel-redirect
+Environment=FILE_REAPER=thread
 ExecStart=/home/$USER/camelot/camelotvenv/bin/gunicorn --access-logfile - --workers 15 --bind unix:/var/gunicorn/camelot.sock projectcamelot.wsgi:application
 
 [Install]
@@ -61,6 +64,49 @@ sudo systemctl start gunicorn
 sudo systemctl enable gunicorn
 sudo systemctl status gunicorn
 
+# regenerate thumbnails whose background job failed or was lost in a restart
+cat > camelot-repair.service << EOF
+[Unit]
+Description=camelot repair of missing photo derivatives
+
+[Service]
+Type=oneshot
+User=$USER
+Group=www-data
+WorkingDirectory=/home/$USER/camelot
+ExecStart=/home/$USER/camelot/camelotvenv/bin/python manage.py repairderivatives
+EOF
+
+cat > camelot-repair.timer << EOF
+[Unit]
+Description=run camelot-repair every 15 minutes
+
+[Timer]
+OnBootSec=15min
+OnUnitActiveSec=15min
+
+[Install]
+WantedBy=timers.target
+EOF
+
+sudo mv camelot-repair.service camelot-repair.timer /etc/systemd/system/
+sudo systemctl enable --now camelot-repair.timer
+
+# the application logs are reopened by every gunicorn worker when logrotate moves them
+cat > camelot-logs << EOF
+/var/log/www-data/exceptions.log /var/log/www-data/camelot.json.log {
+    daily
+    rotate 14
+    compress
+    delaycompress
+    missingok
+    notifempty
+    create 0640 $USER www-data
+}
+EOF
+
+sudo mv camelot-logs /etc/logrotate.d/
+
 # to reload config after service file change:
 # sudo systemctl daemon-reload
 # sudo systemctl restart gunicorn
@@ -78,6 +124,12 @@ server {
         root /home/$USER/camelot/camelot;
     }
 
+    # photos are served by nginx after django has checked permissions (X-Accel-Redirect)
+    location /protected/ {
+        internal;
+        alias /home/$USER/camelot/;
+    }
+
     location / {
         include proxy_params;
         proxy_pass http://unix:/var/gunicorn/camelot.sock;